@@ -3,9 +3,10 @@ import asyncio
 import os
 import pathlib
 import re
-from typing import Dict, Union, List
+from typing import Dict, Union, List, Optional
 from helpers._utils import print_log
 from helpers.save_to_file import save_data_to_file
+from src.blindelephant.ScanJournal import ScanJournal
 
 
 async def cli():
@@ -31,6 +32,14 @@ async def cli():
                         default='output.json',
                         help='Path to saving result')
 
+    parser.add_argument('--journal',
+                        type=pathlib.Path,
+                        metavar='PATH',
+                        dest="journal_path",
+                        default=None,
+                        help='Journal finished app/plugin scans here and resume from it if it exists; '
+                             'removed once the result is saved')
+
     parser.add_argument('-v', '--venv',
                         action='store_true',
                         default=False,
@@ -98,8 +107,20 @@ async def scan_plugin(tool_base_command: str, target_url: str, web_app: str, plu
     return await _scan_base(tool_command=tool_command_plugin_scan)
 
 
-async def _web_app_processing(tool_base_command: str, target_url: str, web_app: str, app_dict: Dict) -> Dict:
-    web_app_data = await scan_web_app(tool_base_command=tool_base_command, target_url=target_url, web_app=web_app)
+async def _journaled(journal: Optional[ScanJournal], unit, scan) -> str:
+    if journal and unit in journal:
+        return journal[unit]
+    data = await scan()
+    if journal:
+        journal.record(unit, data)
+    return data
+
+
+async def _web_app_processing(tool_base_command: str, target_url: str, web_app: str, app_dict: Dict,
+                              journal: Optional[ScanJournal] = None) -> Dict:
+    web_app_data = await _journaled(journal, ("app", target_url, web_app),
+                                    lambda: scan_web_app(tool_base_command=tool_base_command, target_url=target_url,
+                                                         web_app=web_app))
     result = {
         'name': web_app,
         'data': web_app_data,
@@ -107,8 +128,9 @@ async def _web_app_processing(tool_base_command: str, target_url: str, web_app:
     }
 
     for plugin in app_dict[web_app]:
-        plugin_data = await scan_plugin(tool_base_command=tool_base_command, target_url=target_url, web_app=web_app,
-                                        plugin=plugin)
+        plugin_data = await _journaled(journal, ("plugin", target_url, web_app, plugin),
+                                       lambda: scan_plugin(tool_base_command=tool_base_command, target_url=target_url,
+                                                           web_app=web_app, plugin=plugin))
         result['plugins'].append(
             {
                 'name': plugin,
@@ -141,18 +163,24 @@ async def main():
     # [init_params]-[END]
 
     app_dict = await get_supported_items_list(tool_base_command=tool_base_command)
+    journal = None
+    if parsed_args.journal_path:
+        parsed_args.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        journal = ScanJournal(str(parsed_args.journal_path))
 
     result = []
     if not web_app:
         for web_app in app_dict.keys():
             app_data = await _web_app_processing(tool_base_command=tool_base_command, target_url=target_url,
                                                  web_app=web_app,
-                                                 app_dict=app_dict)
+                                                 app_dict=app_dict,
+                                                 journal=journal)
             result.append(app_data)
     else:
         app_data = await _web_app_processing(tool_base_command=tool_base_command, target_url=target_url,
                                              web_app=web_app,
-                                             app_dict=app_dict)
+                                             app_dict=app_dict,
+                                             journal=journal)
         result.append(app_data)
 
     import pprint
@@ -162,6 +190,9 @@ async def main():
     result_path = parsed_args.result_path
     await save_data_to_file(data=result, full_path=result_path)
     await print_log(f'Result saved at:{result_path}')
+    if journal:
+        journal.close()
+        os.remove(journal.filename)
     # [save_result]-[END]
     return
 
@@ -1,5 +1,9 @@
+import contextlib
 import os
 import re
+import shutil
+import tarfile
+import threading
 import time
 import urllib.error
 import urllib.error
@@ -7,6 +11,10 @@ import urllib.parse
 import urllib.parse
 import urllib.request
 import urllib.request
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from http.client import HTTPException
 from optparse import OptionParser
 
 from bs4 import BeautifulSoup
@@ -23,8 +31,178 @@ import blindelephant.DifferencesTables as DiffTables
 # TODO:
 # - Refactor to do away with the idea of the strainer; just call fetcher with a list of filename and
 # dl locations
-# - Sometimes zips come down empty (eg latest version of some wordpress plugins) -- detect
-# and reject these bogus new versions
+
+# Downloads running at once (over all hosts)
+DOWNLOAD_WORKERS = 4
+# Downloads running at once from one host (mirror), and seconds between the starts of two of them
+HOST_CONCURRENCY = 1
+HOST_DELAY = 1.5
+DOWNLOAD_CHUNK_SIZE = 2 ** 16
+DOWNLOAD_TIMEOUT = 60
+# Times an interrupted download is resumed before giving up until the next run
+DOWNLOAD_RETRIES = 2
+# Downloads in progress are kept under their final name plus this, and resumed from there
+PARTIAL_SUFFIX = ".part"
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz")
+
+
+class BadDownload(Exception):
+    """A downloaded file that is empty or not a readable archive"""
+
+
+class TruncatedDownload(BadDownload):
+    """A download that ended before the length announced by the server; it can be resumed"""
+
+
+class HostPoliteness(object):
+    """Per-host limits shared by the download threads: at most concurrency
+    downloads from a host at once, and delay seconds between the starts of
+    two downloads from it."""
+
+    def __init__(self, concurrency=HOST_CONCURRENCY, delay=HOST_DELAY):
+        self.concurrency = concurrency
+        self.delay = delay
+        self._slots = {}
+        self._nextStart = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def slot(self, host):
+        with self._lock:
+            semaphore = self._slots.setdefault(host, threading.Semaphore(self.concurrency))
+        with semaphore:
+            with self._lock:
+                now = time.time()
+                start = max(now, self._nextStart.get(host, now))
+                self._nextStart[host] = start + self.delay
+            time.sleep(start - now)
+            yield
+
+
+politeness = HostPoliteness()
+
+
+def _check_archive(path, filename):
+    """Raise BadDownload if the file at path (to be saved as filename) is
+    empty, or is a zip or tar archive that can't be read to the end or holds
+    no files."""
+    if os.path.getsize(path) == 0:
+        raise BadDownload("empty file")
+    name = filename.lower()
+    try:
+        if name.endswith(ZIP_SUFFIXES):
+            with zipfile.ZipFile(path) as archive:
+                corrupt = archive.testzip()  # reads every member, checking its CRC
+                if corrupt:
+                    raise BadDownload(f"corrupt member {corrupt}")
+                files = sum(1 for info in archive.infolist() if not info.is_dir())
+        elif name.endswith(TAR_SUFFIXES):
+            with tarfile.open(path) as archive:
+                # iterating reads (and decompresses) up to the last member, so truncated archives fail here
+                files = sum(1 for member in archive if member.isfile())
+        else:
+            return
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, OSError) as e:
+        raise BadDownload(f"unreadable archive: {e}")
+    if not files:
+        raise BadDownload("archive holds no files")
+
+
+def _download(url, path, chunkSize=DOWNLOAD_CHUNK_SIZE):
+    """Stream url to path, resuming (with a Range request) from what an
+    earlier, interrupted attempt left in path + PARTIAL_SUFFIX. The file
+    appears under path only once it is complete and passes _check_archive.
+    Returns its size."""
+    partPath = path + PARTIAL_SUFFIX
+    offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+    req = urllib.request.Request(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+    expected = None
+    try:
+        f = urllib.request.urlopen(req, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        # nothing left after offset: the partial file already holds all of it
+        if e.code != 416 or not offset:
+            raise
+    else:
+        with f:
+            contentRange = re.match(r"bytes (\d+)-", f.headers.get("Content-Range", ""))
+            if offset and (f.status != 206 or not contentRange or int(contentRange.group(1)) != offset):
+                offset = 0  # range not honoured; this is the whole file again
+            length = f.headers.get("Content-Length")
+            expected = offset + int(length) if length is not None else None
+            with open(partPath, "ab" if offset else "wb") as localFile:
+                shutil.copyfileobj(f, localFile, chunkSize)
+    size = os.path.getsize(partPath)
+    if expected is not None and size < expected:
+        raise TruncatedDownload(f"got {size} of {expected} bytes")
+    try:
+        _check_archive(partPath, os.path.basename(path))
+    except BadDownload:
+        os.remove(partPath)
+        raise
+    os.replace(partPath, path)
+    return size
+
+
+def _download_job(job):
+    url, path = job
+    host = urllib.parse.urlsplit(url).netloc
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        with politeness.slot(host):
+            print("Attempting to fetch:", url)
+            try:
+                size = _download(url, path)
+                print(f"Fetched {url} ({size} bytes)")
+                return True
+            except urllib.error.HTTPError as e:
+                print("HTTP Error:", e.code, url)
+                return False
+            except urllib.error.URLError as e:
+                print("URL Error:", e.reason, url)
+                return False
+            except TruncatedDownload as e:
+                print(f"Truncated download ({e}):", url)
+            except BadDownload as e:
+                print(f"Rejected download ({e}):", url)
+                return False
+            except (OSError, HTTPException) as e:
+                print(f"Interrupted download ({e!r}):", url)
+    # the partial file stays, so the next run resumes it
+    return False
+
+
+# Pool every download_files call uses while shared_downloads is active
+_shared_pool = None
+
+
+@contextlib.contextmanager
+def shared_downloads(workers=None):
+    """Run the downloads of every download_files call made meanwhile (eg by
+    fetchers running concurrently) in one pool of workers (default
+    DOWNLOAD_WORKERS), so that is the number of downloads running at once"""
+    global _shared_pool
+    with ThreadPoolExecutor(max_workers=workers or DOWNLOAD_WORKERS) as pool:
+        _shared_pool = pool
+        try:
+            yield
+        finally:
+            _shared_pool = None
+
+
+def download_files(jobs, workers=None):
+    """Download (url, localPath) jobs concurrently (workers at a time,
+    default DOWNLOAD_WORKERS, or in the pool of shared_downloads), within
+    the limits of politeness. Returns the local paths that were downloaded
+    completely."""
+    if _shared_pool is not None:
+        done = list(_shared_pool.map(_download_job, jobs))
+    else:
+        with ThreadPoolExecutor(max_workers=workers or DOWNLOAD_WORKERS) as pool:
+            done = list(pool.map(_download_job, jobs))
+    return [path for (url, path), ok in zip(jobs, done) if ok]
+
 
 # the soup strainer here isn't exactly what's described in the BeautifulSoup documentation
 # soupStrainerFunc is expected to consume a beautifulSoup object and produce a list of
@@ -63,25 +241,11 @@ def _fetch_template(appName, releasesUrl, soupStrainerFunc, downloadsPrefix="",
     # for f in availableFiles:
     #    print f
 
-    for v in sorted(newVers):
-        url = f"{downloadsPrefix}{v['href']}"
-        # throttle to not abuse remote server
-        time.sleep(1.5)
-        # TODO: add a check that we're not re
-        print("Attempting to fetch:", url)
-
-        req = urllib.request.Request(url)
-        try:
-            f = urllib.request.urlopen(req)
-            local_file_path = f'{Config.APPS_PATH}{appName}{plugins}/downloads/{v["filename"]}'
-            with open(local_file_path, "wb") as local_file:
-                local_file.write(f.read())
-        except urllib.error.HTTPError as e:
-            print("HTTP Error:", e.code, url)
-        except urllib.error.URLError as e:
-            print("URL Error:", e.reason, url)
-
-    return [v['filename'] for v in newVers]
+    # throttled per host (see politeness) so as not to abuse remote servers
+    downloaded = download_files([(f"{downloadsPrefix}{v['href']}",
+                                  f'{Config.APPS_PATH}{appName}{plugins}/downloads/{v["filename"]}')
+                                 for v in sorted(newVers, key=lambda v: v['filename'])])
+    return [os.path.basename(path) for path in downloaded]
 
 
 # Fetchers for currently supported apps not being released right now, sorry;
@@ -98,80 +262,150 @@ def fetch_example():
     return _fetch_template('appname', "http://example.com/releases", _example_strainer, "")
 
 
-def update_dbs(apps):
-    """Used to create .pkl files for any apps or declared plugins
-    supported but don't have an up-to-date pkl file. 
-    Takes a list of app names.
-    """
-    for app in apps:
-        if not os.access(Config.getDbPath(app), os.F_OK):
-            print(f"No db file available for app {app}. Creating it from {Config.getAppPath(app)}...")
+def _build_db(dbPath, basepath, versionDirectoryRegex, directoryExcludeRegex, fileExcludeRegex, memoryLimit=None):
+    """Compute the tables for the versions in basepath and save them to
+    dbPath, with indicator files picked from them (see
+    DiffTables.computeIndicatorFiles) as metadata."""
+    pathNodes, versionNodes, all_versions = DiffTables.computeTables(
+        basepath, versionDirectoryRegex, directoryExcludeRegex, fileExcludeRegex, memoryLimit=memoryLimit)
+    sizes = DiffTables.fileSizes(basepath, versionDirectoryRegex, directoryExcludeRegex, fileExcludeRegex)
+    metadata = {"indicatorFiles": DiffTables.computeIndicatorFiles(pathNodes, all_versions, sizes)}
+    DiffTables.saveTables(dbPath, pathNodes, versionNodes, all_versions, metadata)
 
-            pathNodes, versionNodes, all_versions = DiffTables.computeTables(
-                Config.getAppPath(app),
-                Config.APP_CONFIG[app]["versionDirectoryRegex"],
-                Config.APP_CONFIG[app]["directoryExcludeRegex"],
-                Config.APP_CONFIG[app]["fileExcludeRegex"])
 
-            DiffTables.saveTables(Config.getDbPath(app), pathNodes, versionNodes, all_versions)
-        else:
-            print(f"Found db file for app {app}", end=' ')
-            pathNodes, versionNodes, all_versions = DiffTables.loadTables(Config.getDbPath(app), False)
-
-            versInDb = len(all_versions)
-            versOnDisk = len([entry for entry in os.listdir(Config.getAppPath(app))
-                              if re.match(Config.APP_CONFIG[app]["versionDirectoryRegex"], entry)])
-
-            if versInDb != versOnDisk:
-                print(f"but it is out of date ({versInDb} versions in db, {versOnDisk} versions on disk). "
-                      f"Recreating it from {Config.getAppPath(app)}... ")
-
-                pathNodes, versionNodes, all_versions = DiffTables.computeTables(
-                    Config.getAppPath(app),
-                    Config.APP_CONFIG[app]["versionDirectoryRegex"],
-                    Config.APP_CONFIG[app]["directoryExcludeRegex"],
-                    Config.APP_CONFIG[app]["fileExcludeRegex"])
-
-                DiffTables.saveTables(Config.getDbPath(app), pathNodes, versionNodes, all_versions)
-            else:
-                print(".")
+def update_indicators(apps):
+    """Pick indicator files for the existing dbs of apps (and their plugins)
+    and store them in each db's metadata, without rebuilding the tables.
+    File sizes are taken from the app sources when they are available."""
+    for app in apps:
+        dbs = [(Config.getDbPath(app), Config.getAppPath(app), Config.APP_CONFIG[app]["versionDirectoryRegex"])]
+        if os.access(Config.getAppPluginPath(app), os.F_OK):
+            dbs += [(Config.getDbPath(app, plugin), Config.getAppPluginPath(app, plugin),
+                     plugin + Config.APP_CONFIG[app]["pluginsDirectoryRegex"])
+                    for plugin in sorted(os.listdir(Config.getAppPluginPath(app)))
+                    if os.path.isdir(Config.getAppPluginPath(app, plugin))]
+        for dbPath, basepath, versionDirectoryRegex in dbs:
+            if not os.access(dbPath, os.F_OK):
+                continue
+            pathNodes, versionNodes, all_versions = DiffTables.loadTables(dbPath, False)
+            sizes = None
+            if os.access(basepath, os.F_OK):
+                sizes = DiffTables.fileSizes(basepath, versionDirectoryRegex,
+                                             Config.APP_CONFIG[app]["directoryExcludeRegex"],
+                                             Config.APP_CONFIG[app]["fileExcludeRegex"])
+            indicatorFiles = DiffTables.computeIndicatorFiles(pathNodes, all_versions, sizes)
+            DiffTables.updateMetadata(dbPath, indicatorFiles=indicatorFiles)
+            print(f"{dbPath}: {indicatorFiles}")
+
+
+class DbJob(object):
+    """A DB to (re)build: where to save it, the sources to build it from and why"""
+
+    def __init__(self, name, dbPath, basepath, versionDirectoryRegex, directoryExcludeRegex, fileExcludeRegex,
+                 reason):
+        self.name = name
+        self.dbPath = dbPath
+        self.basepath = basepath
+        self.versionDirectoryRegex = versionDirectoryRegex
+        self.directoryExcludeRegex = directoryExcludeRegex
+        self.fileExcludeRegex = fileExcludeRegex
+        self.reason = reason
+
+    def size(self):
+        """Number of version directories to hash (to start the biggest builds first)"""
+        return len([entry for entry in os.listdir(self.basepath) if re.match(self.versionDirectoryRegex, entry)])
+
+
+def _stale_reason(name, dbPath, basepath, versionDirectoryRegex):
+    """Why the DB at dbPath needs (re)building from basepath, or None if it is up to date"""
+    if not os.access(dbPath, os.F_OK):
+        print(f"No db file available for {name}. Creating it from {basepath}...")
+        return "missing"
+    print(f"Found db file for {name}", end=' ')
+    pathNodes, versionNodes, all_versions = DiffTables.loadTables(dbPath, False)
+
+    versInDb = len(all_versions)
+    versOnDisk = len([entry for entry in os.listdir(basepath) if re.match(versionDirectoryRegex, entry)])
+
+    if versInDb != versOnDisk:
+        print(f"but it is out of date ({versInDb} versions in db, {versOnDisk} versions on disk). "
+              f"Recreating it from {basepath}... ")
+        return f"{versInDb} -> {versOnDisk} versions"
+    print(".")
+    return None
+
+
+def db_jobs(apps):
+    """Return a DbJob for every missing or out of date DB of apps and their
+    declared plugins. The DBs don't depend on each other, so the jobs can
+    run in any order."""
+    jobs = []
+    for app in apps:
+        appConfig = Config.APP_CONFIG[app]
+        reason = _stale_reason(f"app {app}", Config.getDbPath(app), Config.getAppPath(app),
+                               appConfig["versionDirectoryRegex"])
+        if reason:
+            jobs.append(DbJob(app, Config.getDbPath(app), Config.getAppPath(app), appConfig["versionDirectoryRegex"],
+                              appConfig["directoryExcludeRegex"], appConfig["fileExcludeRegex"], reason))
         if os.access(Config.getAppPluginPath(app), os.F_OK):
             for plugin in [p for p in sorted(os.listdir(Config.getAppPluginPath(app)))
                            if os.path.isdir(Config.getAppPluginPath(app, p))]:
-                if not os.access(Config.getDbPath(app, plugin), os.F_OK):
-                    print(f"No db file available for {app} plugin {plugin}. "
-                          f"Creating it from {Config.getAppPluginPath(app, plugin)}...")
-
-                    pathNodes, versionNodes, all_versions = DiffTables.computeTables(
-                        Config.getAppPluginPath(app, plugin),
-                        (plugin + Config.APP_CONFIG[app]["pluginsDirectoryRegex"]),
-                        "none",
-                        Config.APP_CONFIG[app]["fileExcludeRegex"])
-
-                    DiffTables.saveTables(Config.getDbPath(app, plugin), pathNodes, versionNodes, all_versions)
-
-                else:
-                    print(f"Found db file for {app} plugin {plugin}", end=' ')
-                    pathNodes, versionNodes, all_versions = DiffTables.loadTables(Config.getDbPath(app, plugin), False)
-
-                    versInDb = len(all_versions)
-                    versOnDisk = len([entry for entry in os.listdir(Config.getAppPluginPath(app, plugin))
-                                      if re.match(plugin + Config.APP_CONFIG[app]["pluginsDirectoryRegex"], entry)])
-
-                    if versInDb != versOnDisk:
-                        print(f"but it is out of date ({versInDb} versions in db, {versOnDisk} versions on disk). "
-                              f"Recreating it from {Config.getAppPluginPath(app, plugin)}... ")
-
-                        pathNodes, versionNodes, all_versions = DiffTables.computeTables(
-                            Config.getAppPluginPath(app, plugin),
-                            (plugin + Config.APP_CONFIG[app]["pluginsDirectoryRegex"]),
-                            Config.APP_CONFIG[app]["directoryExcludeRegex"],
-                            Config.APP_CONFIG[app]["fileExcludeRegex"])
-
-                        DiffTables.saveTables(Config.getDbPath(app, plugin), pathNodes, versionNodes, all_versions)
+                pluginPath = Config.getAppPluginPath(app, plugin)
+                versionDirectoryRegex = plugin + appConfig["pluginsDirectoryRegex"]
+                reason = _stale_reason(f"{app} plugin {plugin}", Config.getDbPath(app, plugin), pluginPath,
+                                       versionDirectoryRegex)
+                if reason:
+                    # new plugin dbs have always been built without the app's directory excludes
+                    jobs.append(DbJob(f"{app} plugin {plugin}", Config.getDbPath(app, plugin), pluginPath,
+                                      versionDirectoryRegex,
+                                      "none" if reason == "missing" else appConfig["directoryExcludeRegex"],
+                                      appConfig["fileExcludeRegex"], reason))
+    return jobs
+
+
+def _run_db_job(job, memoryLimit):
+    """Build one DbJob (in a worker process). Returns (seconds, error or None)."""
+    start = time.perf_counter()
+    try:
+        _build_db(job.dbPath, job.basepath, job.versionDirectoryRegex, job.directoryExcludeRegex,
+                  job.fileExcludeRegex, memoryLimit)
+    except Exception as e:
+        return time.perf_counter() - start, f"{type(e).__name__}: {e}"
+    return time.perf_counter() - start, None
+
+
+def update_dbs(apps, memoryLimit=None, workers=None):
+    """Used to create .pkl files for any apps or declared plugins
+    supported but don't have an up-to-date pkl file. 
+    Takes a list of app names. If memoryLimit (bytes) is given, DBs are
+    built with bounded memory (see DifferencesTables.computeTables); it is
+    the total for all the builds running at once, each getting its share.
 
-                    else:
-                        print(".")
+    The stale DBs are built by a pool of worker processes (default: one
+    per CPU), biggest first, and a summary is printed at the end. Returns
+    the number of DBs that failed to build.
+    """
+    start = time.perf_counter()
+    jobs = sorted(db_jobs(apps), key=DbJob.size, reverse=True)
+    results = []
+    if jobs:
+        workers = min(workers or os.cpu_count() or 1, len(jobs))
+        jobLimit = memoryLimit // workers if memoryLimit else None
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_run_db_job, job, jobLimit): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                seconds, error = future.result()
+                print(f"{'Failed to build' if error else 'Built'} {job.dbPath} in {seconds:.1f}s"
+                      + (f": {error}" if error else ""))
+                results.append((job, seconds, error))
+
+    failed = [r for r in results if r[2]]
+    print(f"\n{len(results) - len(failed)} dbs rebuilt, {len(failed)} failed, "
+          f"in {time.perf_counter() - start:.1f}s ({sum(r[1] for r in results):.1f}s of building)")
+    for job, seconds, error in sorted(results, key=lambda r: r[1], reverse=True):
+        print(f"  {seconds:8.1f}s  {job.name:40} {error or job.reason}")
+    return len(failed)
 
 
 if __name__ == '__main__':
@@ -183,14 +417,34 @@ if __name__ == '__main__':
     parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
     parser.add_option("-p", "--plugins", action="store_true", help="Fetch all plugins for the given app")
     parser.add_option("-u", "--update_dbs", action="store_true", help="Update databases (developer use only)")
+    parser.add_option("-i", "--indicators", action="store_true",
+                      help="Pick indicator files for existing databases from their contents (developer use only)")
+    parser.add_option("-w", "--workers", type='int', default=DOWNLOAD_WORKERS,
+                      help="Downloads running at once. Default: %default")
+    parser.add_option("--per-host", type='int', default=HOST_CONCURRENCY,
+                      help="Downloads running at once from one host. Default: %default")
+    parser.add_option("--delay", type='float', default=HOST_DELAY,
+                      help="Seconds between the starts of two downloads from one host. Default: %default")
+    parser.add_option("-j", "--jobs", type='int',
+                      help="Databases built at once (in separate processes). Default: one per CPU")
+    parser.add_option("-m", "--build-mb", type='int',
+                      help="Build databases with at most about this many MB of file records in memory (in "
+                           "total, shared by the builds running at once), spilling the rest to temporary files "
+                           "(for apps with very many versions)")
 
     (options, args) = parser.parse_args()
+    DOWNLOAD_WORKERS = options.workers
+    politeness = HostPoliteness(options.per_host, options.delay)
 
     if options.update_dbs:
         if len(args) < 1 or args[0] == "all":
             args = list(Config.APP_CONFIG.keys())
         print(args)
-        update_dbs(args)
+        update_dbs(args, options.build_mb * 2 ** 20 if options.build_mb else None, options.jobs)
+        quit()
+
+    if options.indicators:
+        update_indicators(list(Config.APP_CONFIG.keys()) if len(args) < 1 or args[0] == "all" else args)
         quit()
 
     if len(args) < 1:
@@ -199,10 +453,12 @@ if __name__ == '__main__':
         quit()
 
     if args[0] == "all":
-        for func in [s for s in sorted(globals().keys()) if s.startswith("fetch")]:
-            print(func)
-            time.sleep(2)
-            print(globals()[func]())
+        fetchers = [s for s in sorted(globals().keys()) if s.startswith("fetch")]
+        # apps are checked concurrently, but their downloads share one pool of options.workers; downloads from a
+        # shared mirror still respect its politeness limits
+        with shared_downloads(options.workers), ThreadPoolExecutor(max_workers=options.workers) as pool:
+            for func, fetched in zip(fetchers, pool.map(lambda func: globals()[func](), fetchers)):
+                print(func, fetched)
     elif f"fetch{args[0]}" in globals():
         print("Checking for new versions of", args[0])
         print(globals()[f"fetch{args[0]}"]())
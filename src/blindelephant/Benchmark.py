@@ -0,0 +1,373 @@
+"""Offline throughput benchmark for BlindElephant.
+
+Generates synthetic multi-version app (and plugin) source trees, builds
+fingerprint DBs from them with DifferencesTables.computeTables, serves one
+chosen version from a local MockServer and measures guess_apps, fingerprint,
+guess_plugins and Scanner.scan against it: wall time, requests, bytes, and
+requests per correct identification. Results are written as a json report
+that can be compared against a report from another commit with --compare.
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from distutils.version import LooseVersion
+from optparse import OptionParser
+
+import Configuration
+import DifferencesTables
+import FingerprintUtils
+import Fingerprinters
+import Loggers
+import MockServer
+import ProbeEngine
+import Scanner
+
+# Shape of the synthetic corpus
+NUM_APPS = 3
+NUM_VERSIONS = 20
+NUM_FILES = 80
+NUM_PLUGINS = 4
+NUM_PLUGIN_VERSIONS = 5
+
+# Files bundled identically into every app (think tinymce or mootools)
+SHARED_FILES = ["/lib/editor/editor.js", "/lib/editor/themes/simple.css", "/lib/js/mootools.js"]
+
+PLUGINS_ROOT = "/plugins/"
+# Scripts and stylesheets of a synthetic site linked from its landing page
+LANDING_PAGE_ASSETS = 3
+
+# name: MockServer options
+SCENARIOS = {"baseline": {},
+             "latency": {"latency": .01},
+             "soft404": {"soft_404": True},
+             "errors": {"error_rate": .05}}
+
+
+def _file_data(rng, app, path, revision, size):
+    data = [f"/* {app} {path} revision {revision} */\n"]
+    words = ["var", "function", "return", "this", "color", "margin", "if", "else", "null", "div"]
+    while sum(len(line) for line in data) < size:
+        data.append(" ".join(rng.choice(words) for _ in range(8)) + ";\n")
+    return "".join(data)
+
+
+def _write_version_tree(basepath, dirname, files):
+    for path, data in files.items():
+        local = os.path.join(basepath, dirname, *path.strip("/").split("/"))
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        with open(local, "w", newline="\n") as f:
+            f.write(data)
+
+
+def generate_app(basepath, app, num_versions, num_files, seed, shared_files=()):
+    """Write num_versions version directories named app-1.0, app-1.1, ... under
+    basepath. Files appear and disappear between versions and change content at
+    random points, like a real app's history. Returns the version strings.
+    """
+    rng = random.Random(f"{seed}:{app}")
+    versions = ["1.%d" % i for i in range(num_versions)]
+    dirs = ["js", "css", "images", "misc", "themes/default", "themes/classic"]
+    exts = ["js", "css", "gif", "txt", "html"]
+    plan = []
+    for n in range(num_files):
+        path = "/%s/%s_%d.%s" % (rng.choice(dirs), app, n, rng.choice(exts))
+        introduced = rng.randrange(num_versions) if rng.random() < .3 else 0
+        removed = rng.randrange(introduced + 1, num_versions + 1) if rng.random() < .1 else num_versions
+        changes = sorted(rng.sample(range(1, num_versions), rng.randint(0, min(5, num_versions - 1))))
+        plan.append((path, introduced, removed, changes, rng.randint(200, 4000)))
+    for path in shared_files:
+        plan.append((path, 0, num_versions, [num_versions // 2], 2000))
+
+    for i, version in enumerate(versions):
+        files = {}
+        for path, introduced, removed, changes, size in plan:
+            if introduced <= i < removed:
+                revision = len([c for c in changes if c <= i])
+                owner = "shared" if path in shared_files else app
+                files[path] = _file_data(random.Random(f"{seed}:{owner}:{path}:{revision}"), owner, path,
+                                         revision, size)
+        _write_version_tree(basepath, f"{app}-{version}", files)
+    return versions
+
+
+def build_corpus(workdir, seed=0, num_apps=NUM_APPS, num_versions=NUM_VERSIONS, num_files=NUM_FILES,
+                 num_plugins=NUM_PLUGINS, num_plugin_versions=NUM_PLUGIN_VERSIONS):
+    """Generate sources for num_apps synthetic apps (the first with plugins)
+    under workdir/sources and build their DBs in workdir/dbs. Returns an
+    APP_CONFIG-style dict for the synthetic apps.
+    """
+    sources = os.path.join(workdir, "sources")
+    dbs = os.path.join(workdir, "dbs")
+    app_config = {}
+    null = io.StringIO()
+    for a in range(num_apps):
+        app = "benchapp%d" % a
+        generate_app(os.path.join(sources, app), app, num_versions, num_files, seed, SHARED_FILES)
+        with contextlib.redirect_stdout(null):
+            path_nodes, version_nodes, versions = DifferencesTables.computeTables(
+                os.path.join(sources, app), f"{app}-(.*)", "none", "none")
+        os.makedirs(dbs, exist_ok=True)
+        DifferencesTables.saveTables(os.path.join(dbs, app + Configuration.DB_EXTENSION),
+                                     path_nodes, version_nodes, versions,
+                                     _metadata(os.path.join(sources, app), f"{app}-(.*)", path_nodes, versions))
+        app_config[app] = {"versionDirectoryRegex": f"{app}-(.*)",
+                           "directoryExcludeRegex": "none",
+                           "fileExcludeRegex": "none",
+                           "indicatorFiles": sorted(FingerprintUtils.pick_indicator_files(version_nodes, versions))}
+        if a == 0 and num_plugins:
+            app_config[app]["pluginsRoot"] = PLUGINS_ROOT
+            app_config[app]["pluginsDirectoryRegex"] = r"\.(.*)"
+            plugin_sources = os.path.join(sources, app + Configuration.PLUGINS_EXTENSION)
+            plugin_dbs = os.path.join(dbs, app + Configuration.PLUGINS_EXTENSION)
+            os.makedirs(plugin_dbs, exist_ok=True)
+            for p in range(num_plugins):
+                plugin = "plugin%d" % p
+                plugin_versions = generate_app(os.path.join(plugin_sources, plugin), plugin, num_plugin_versions,
+                                               num_files // 8, seed)
+                # plugin dirs are named plugin.version (see pluginsDirectoryRegex)
+                for version in plugin_versions:
+                    os.rename(os.path.join(plugin_sources, plugin, f"{plugin}-{version}"),
+                              os.path.join(plugin_sources, plugin, f"{plugin}.{version}"))
+                with contextlib.redirect_stdout(null):
+                    tables = DifferencesTables.computeTables(os.path.join(plugin_sources, plugin),
+                                                             plugin + r"\.(.*)", "none", "none")
+                DifferencesTables.saveTables(os.path.join(plugin_dbs, plugin + Configuration.DB_EXTENSION), *tables,
+                                             _metadata(os.path.join(plugin_sources, plugin), plugin + r"\.(.*)",
+                                                       tables[0], tables[2]))
+    return app_config
+
+
+def _metadata(basepath, version_regex, path_nodes, versions):
+    sizes = DifferencesTables.fileSizes(basepath, version_regex, "none", "none")
+    return {"indicatorFiles": DifferencesTables.computeIndicatorFiles(path_nodes, versions, sizes)}
+
+
+def build_site(workdir, app, version, plugins=()):
+    """Lay out a document root with one version of app (and the latest version
+    of each of plugins) installed, and a landing page linking some of its
+    scripts and stylesheets, and return its path."""
+    site = os.path.join(workdir, "site-%s-%s" % (app, version))
+    if os.path.exists(site):
+        shutil.rmtree(site)
+    shutil.copytree(os.path.join(workdir, "sources", app, f"{app}-{version}"), site)
+    for plugin in plugins:
+        plugin_dir = os.path.join(workdir, "sources", app + Configuration.PLUGINS_EXTENSION, plugin)
+        latest = sorted(os.listdir(plugin_dir), key=lambda d: LooseVersion(d.split(".", 1)[1]))[-1]
+        shutil.copytree(os.path.join(plugin_dir, latest), os.path.join(site, PLUGINS_ROOT.strip("/"), plugin))
+    _write_landing_page(site, random.Random(f"{app}:{version}"))
+    return site
+
+
+def _write_landing_page(site, rng):
+    assets = sorted("/" + os.path.relpath(os.path.join(dirpath, name), site).replace(os.sep, "/")
+                    for dirpath, dirnames, filenames in os.walk(site) for name in filenames
+                    if name.endswith((".js", ".css")))
+    assets = rng.sample(assets, min(LANDING_PAGE_ASSETS, len(assets)))
+    links = ['<link rel="stylesheet" href="%s?v=1">' % a if a.endswith(".css") else '<script src="%s"></script>' % a
+             for a in assets]
+    with open(os.path.join(site, "index.html"), "w") as f:
+        f.write("<html><head><title>Welcome</title>\n%s\n</head><body><p>Hello</p></body></html>\n" % "\n".join(links))
+
+
+@contextlib.contextmanager
+def synthetic_configuration(workdir, app_config):
+    """Point Configuration at the synthetic DBs and apps for the duration"""
+    saved = Configuration.DBS_PATH, Configuration.APP_CONFIG
+    Configuration.DBS_PATH = os.path.join(workdir, "dbs") + "/"
+    Configuration.APP_CONFIG = app_config
+    try:
+        yield
+    finally:
+        Configuration.DBS_PATH, Configuration.APP_CONFIG = saved
+
+
+def _measure(server, func, check):
+    server.reset_counters()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func()
+    wall = time.perf_counter() - start
+    counters = server.counters()
+    correct = bool(check(result))
+    return {"wall": wall,
+            "requests": counters["requests"],
+            "bytes": counters["bytes"],
+            "status": counters["status"],
+            "correct": correct,
+            "requests_per_correct": counters["requests"] if correct else None}
+
+
+def run_scenario(workdir, app_config, app, version, plugins, server_options, concurrency=1):
+    """Run every measured phase once against a MockServer set up with
+    server_options. Returns {phase: measurements}.
+    """
+    logger = Loggers.NullLogger()
+    site = build_site(workdir, app, version, plugins)
+    expected = LooseVersion(version)
+    results = {}
+    # each phase gets a fresh engine, as in a standalone run; all are shut down when the scenario ends
+    engines = []
+    with synthetic_configuration(workdir, app_config), MockServer.MockServer(site, **server_options) as server:
+        def engine():
+            if concurrency <= 1:
+                return None
+            engines.append(ProbeEngine.ProbeEngine(max_window=concurrency))
+            return engines[-1]
+
+        try:
+            start = time.perf_counter()
+            for a in app_config:
+                DifferencesTables.loadTables(Configuration.getDbPath(a), printStats=False, useCaching=False)
+            results["load_dbs"] = {"wall": time.perf_counter() - start}
+
+            results["guess_apps"] = _measure(
+                server, lambda: Fingerprinters.WebAppGuesser(server.url, logger=logger, engine=engine()).guess_apps(),
+                lambda apps: apps == [app])
+            results["fingerprint"] = _measure(
+                server, lambda: Fingerprinters.WebAppFingerprinter(server.url, app, logger=logger,
+                                                                   engine=engine()).fingerprint(),
+                lambda vers: vers == [expected])
+            if plugins:
+                results["guess_plugins"] = _measure(
+                    server, lambda: Fingerprinters.PluginGuesser(server.url, app, logger=logger,
+                                                                 engine=engine()).guess_plugins(),
+                    lambda found: sorted(found) == sorted(plugins))
+                results["guess_plugins_head"] = _measure(
+                    server, lambda: Fingerprinters.PluginGuesser(server.url, app, logger=logger, engine=engine(),
+                                                                 head=True).guess_plugins(),
+                    lambda found: sorted(found) == sorted(plugins))
+
+            def scan():
+                s = Scanner.Scanner(server.url, scan_plugins=bool(plugins), engine=engine())
+                s.scan()
+                return s.result
+
+            results["scan"] = _measure(server, scan,
+                                       lambda r: list(r.apps) == [app] and expected in r.apps[app] and
+                                       sorted(r.plugins.get(app, {})) == sorted(plugins))
+        finally:
+            for e in engines:
+                e.shutdown()
+    return results
+
+
+def _summarize(runs):
+    """Collapse repeated runs of a phase: min/mean wall time, mean counts,
+    fraction of runs that identified correctly."""
+    summary = {"wall_min": min(r["wall"] for r in runs),
+               "wall_mean": sum(r["wall"] for r in runs) / len(runs)}
+    if "requests" in runs[0]:
+        summary["requests"] = sum(r["requests"] for r in runs) / len(runs)
+        summary["bytes"] = sum(r["bytes"] for r in runs) / len(runs)
+        correct = [r for r in runs if r["correct"]]
+        summary["accuracy"] = len(correct) / len(runs)
+        summary["requests_per_correct"] = (sum(r["requests"] for r in runs) / len(correct)) if correct else None
+    return summary
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmark(scenarios=SCENARIOS, repeat=3, seed=0, concurrency=1, workdir=None, **corpus_options):
+    """Build the synthetic corpus and run every scenario repeat times.
+    Returns the report as a dict.
+    """
+    cleanup = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="be-bench-")
+    try:
+        start = time.perf_counter()
+        app_config = build_corpus(workdir, seed=seed, **corpus_options)
+        build_time = time.perf_counter() - start
+
+        rng = random.Random(seed)
+        app = sorted(app_config)[0]
+        with synthetic_configuration(workdir, app_config):
+            versions = DifferencesTables.loadTables(Configuration.getDbPath(app), printStats=False)[2]
+            plugin_dir = Configuration.getDbDir(app)
+            all_plugins = sorted(p[:-len(Configuration.DB_EXTENSION)] for p in os.listdir(plugin_dir)) \
+                if os.path.isdir(plugin_dir) else []
+        version = rng.choice(versions[1:]).vstring
+        plugins = all_plugins[:2]
+
+        report = {"commit": _git_commit(),
+                  "python": platform.python_version(),
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "params": dict(corpus_options, seed=seed, repeat=repeat, concurrency=concurrency, app=app,
+                                 version=version, plugins=plugins),
+                  "build_dbs": {"wall": build_time},
+                  "scenarios": {}}
+        for name, server_options in scenarios.items():
+            runs = [run_scenario(workdir, app_config, app, version, plugins, server_options, concurrency)
+                    for _ in range(repeat)]
+            report["scenarios"][name] = {phase: _summarize([r[phase] for r in runs]) for phase in runs[0]}
+        return report
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare_reports(old, new, file=sys.stdout):
+    """Print the relative change of every shared metric between two reports"""
+    print("Comparing %s -> %s" % (old.get("commit"), new.get("commit")), file=file)
+    for scenario, phases in sorted(new["scenarios"].items()):
+        for phase, metrics in sorted(phases.items()):
+            old_metrics = old.get("scenarios", {}).get(scenario, {}).get(phase, {})
+            for metric, value in sorted(metrics.items()):
+                old_value = old_metrics.get(metric)
+                if value is None or old_value is None:
+                    continue
+                change = ((value - old_value) / old_value * 100) if old_value else 0.0
+                print("%-10s %-14s %-22s %12.4f -> %12.4f  (%+.1f%%)" % (scenario, phase, metric, old_value, value,
+                                                                         change), file=file)
+
+
+if __name__ == '__main__':
+    USAGE = "usage: %prog [options]"
+    EPILOGUE = """Benchmark BlindElephant against synthetic apps served from a local web server.
+               Scenarios: %s""" % ", ".join(SCENARIOS)
+
+    parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
+    parser.add_option("-o", "--output", help="Write the json report to this file (default: stdout)")
+    parser.add_option("-r", "--repeat", type='int', default=3, help="Runs per scenario. Default: %default")
+    parser.add_option("-s", "--scenario", action="append", help="Run only this scenario (may be repeated)")
+    parser.add_option("-c", "--concurrency", type='int', default=1,
+                      help="Maximum number of concurrent probes (see ProbeEngine). Default: %default")
+    parser.add_option("--seed", type='int', default=0, help="Seed for the synthetic corpus. Default: %default")
+    parser.add_option("--versions", type='int', default=NUM_VERSIONS, help="Versions per app. Default: %default")
+    parser.add_option("--files", type='int', default=NUM_FILES, help="Files per app. Default: %default")
+    parser.add_option("--workdir", help="Build the corpus here and keep it (default: temporary directory)")
+    parser.add_option("--compare", help="Print changes relative to this earlier report")
+
+    (options, args) = parser.parse_args()
+
+    scenarios = SCENARIOS
+    if options.scenario:
+        unknown = [s for s in options.scenario if s not in SCENARIOS]
+        if unknown:
+            print("Error: unknown scenario(s)", ", ".join(unknown))
+            quit()
+        scenarios = {s: SCENARIOS[s] for s in options.scenario}
+
+    report = run_benchmark(scenarios, repeat=options.repeat, seed=options.seed, concurrency=options.concurrency,
+                           workdir=options.workdir, num_versions=options.versions, num_files=options.files)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if options.compare:
+        with open(options.compare) as f:
+            compare_reports(json.load(f), report)
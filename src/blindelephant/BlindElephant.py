@@ -3,7 +3,13 @@ import os
 from optparse import OptionParser
 
 import Configuration
+import DbUpdater
 import Fingerprinters
+import NegativeCache
+import ProbeEngine
+import ResponseMemo
+import Tracing
+import Transports
 
 if __name__ == '__main__':
 
@@ -19,9 +25,22 @@ if __name__ == '__main__':
                       help="Number of files to fetch (more may increase accuracy). Default: %default", default=15)
     parser.add_option("-w", "--winnow", action="store_true",
                       help="If more than one version are returned, use winnowing to attempt to narrow it down (up to numProbes additional requests).")
+    parser.add_option("-c", "--concurrency", type='int', default=1,
+                      help="Maximum number of concurrent probes; the actual number adapts to the host's latency and "
+                           "errors. Default: %default (probe sequentially)")
+    parser.add_option("--head", action="store_true",
+                      help="Guess plugins concurrently with HEAD requests, downloading files only to confirm")
+    parser.add_option("--record", help="Record every request and response to this archive (for replay/profiling)")
+    parser.add_option("--replay", help="Answer requests from an archive made with --record instead of the network")
+    parser.add_option("--trace", help="Write a timeline of the run to this file (Chrome trace-event json)")
     parser.add_option("-l", "--list", action="store_true", help="List supported webapps and plugins")
     parser.add_option("-u", "--updateDB", action="store_true",
-                      help="Pull latest DB files from blindelephant.sourceforge.net repo (Equivalent to svn update on blindelephant/dbs/). May require root if blindelephant was installed with root.")
+                      help="Pull latest DB files from blindelephant.sourceforge.net repo (only those that changed; see DbUpdater). May require root if blindelephant was installed with root.")
+    parser.add_option("--updateFrom", help="Update DB files from this url or directory instead (implies -u)")
+    parser.add_option("--allowUnsigned", action="store_true",
+                      help="Let -u install DB files whose signature can't be checked (no public key configured, "
+                           "or the DB tarball used while no signed source exists). DB files are pickles: only use "
+                           "this with a source you trust")
 
     (options, args) = parser.parse_args()
 
@@ -37,27 +56,30 @@ if __name__ == '__main__':
                 print(" -", p[:-(len(Configuration.DB_EXTENSION))], file=Configuration.DEFAULT_LOGFILE)
         quit()
 
-    if options.updateDB:
-        """Added at the request of backbox.org; pretty hacky. May formalize this in the future if there's demand"""
-        import tempfile
-        import urllib.request
-        import urllib.parse
-        import urllib.error
-        import os
-        import tarfile
-
-        dbtar_url = "http://blindelephant.svn.sourceforge.net/viewvc/blindelephant/trunk/src/blindelephant/dbs/?view=tar"
-        untar_dir = os.path.join(Configuration.getDbDir(), os.path.pardir)  # so that dbs/ in tar overlays existing dbs/
-
-        tmp = tempfile.NamedTemporaryFile()
-        print("Fetching latest DB files from", dbtar_url, file=Configuration.DEFAULT_LOGFILE)
-        urllib.request.urlretrieve(
-            "http://blindelephant.svn.sourceforge.net/viewvc/blindelephant/trunk/src/blindelephant/dbs/?view=tar",
-            tmp.name)
-        f = tarfile.open(tmp.name)
-        print("Extracting to ", untar_dir, file=Configuration.DEFAULT_LOGFILE)
-        f.extractall(untar_dir)
-        tmp.close()
+    if options.updateDB or options.updateFrom:
+        """Added at the request of backbox.org"""
+        source = options.updateFrom or Configuration.DB_UPDATE_URL
+        try:
+            if source:
+                print("Fetching latest DB files from", source, file=Configuration.DEFAULT_LOGFILE)
+                verify = None
+                if Configuration.DB_UPDATE_PUBLIC_KEY:
+                    verify = DbUpdater.ed25519_verifier(Configuration.DB_UPDATE_PUBLIC_KEY)
+                updated = DbUpdater.update(source, Configuration.getDbDir(), verify,
+                                           allow_unsigned=options.allowUnsigned)
+            else:
+                print("Fetching latest DB files from", Configuration.DB_UPDATE_TARBALL_URL,
+                      file=Configuration.DEFAULT_LOGFILE)
+                updated = DbUpdater.update_from_tarball(Configuration.DB_UPDATE_TARBALL_URL, Configuration.getDbDir(),
+                                                        allow_unsigned=options.allowUnsigned)
+        except DbUpdater.UnsignedError as e:
+            print("Error updating DB files:", e, "(pass --allowUnsigned to install them anyway)",
+                  file=Configuration.DEFAULT_LOGFILE)
+            quit()
+        except DbUpdater.UpdateError as e:
+            print("Error updating DB files:", e, file=Configuration.DEFAULT_LOGFILE)
+            quit()
+        print(f"Updated {len(updated)} DB files in {Configuration.getDbDir()}", file=Configuration.DEFAULT_LOGFILE)
         quit()
 
     if len(args) < 2:
@@ -70,9 +92,20 @@ if __name__ == '__main__':
     if not (url.startswith("http://") or url.startswith("https://")):
         url = f"http://{url}"
     app_name = args[1]
+    if options.trace:
+        Tracing.enable()
+    engine = ProbeEngine.ProbeEngine(max_window=options.concurrency) if options.concurrency > 1 else None
+    transport = None
+    if options.replay:
+        transport = Transports.ReplayTransport(options.replay)
+    elif options.record:
+        transport = Transports.RecordingTransport()
+    negative_cache = NegativeCache.NegativeCache()
+    negative_cache.protect(url)
+    memo = ResponseMemo.ResponseMemo(negative_cache)
 
     if app_name == "guess":
-        g = Fingerprinters.WebAppGuesser(url)
+        g = Fingerprinters.WebAppGuesser(url, engine=engine, transport=transport, memo=memo)
         print("Probing...", file=Configuration.DEFAULT_LOGFILE)
         apps = g.guess_apps()
         print("Possible apps:", file=Configuration.DEFAULT_LOGFILE)
@@ -82,14 +115,24 @@ if __name__ == '__main__':
         print("Unsupported web app \"" + app_name + "\"", file=Configuration.DEFAULT_LOGFILE)
         quit()
     elif not options.skip:
-        fp = Fingerprinters.WebAppFingerprinter(url, app_name, num_probes=options.numProbes, winnow=options.winnow)
+        fp = Fingerprinters.WebAppFingerprinter(url, app_name, num_probes=options.numProbes, winnow=options.winnow,
+                                                engine=engine, transport=transport, memo=memo)
         fp.fingerprint()
 
     if options.pluginName == 'guess':
         if not options.skip:
             print("\n\n", file=Configuration.DEFAULT_LOGFILE)
-        g = Fingerprinters.PluginGuesser(url, app_name)
+        g = Fingerprinters.PluginGuesser(url, app_name, engine=engine, transport=transport, memo=memo,
+                                         head=options.head)
         g.guess_plugins()
     elif options.pluginName:
-        fp = Fingerprinters.PluginFingerprinter(url, app_name, options.pluginName, num_probes=options.numProbes)
+        fp = Fingerprinters.PluginFingerprinter(url, app_name, options.pluginName, num_probes=options.numProbes,
+                                                engine=engine, transport=transport, memo=memo)
         fp.fingerprint()
+
+    if engine:
+        engine.shutdown()
+    if options.record and not options.replay:
+        transport.save(options.record)
+    if options.trace:
+        Tracing.disable().export(options.trace)
@@ -16,6 +16,14 @@ APPS_PATH = os.path.expanduser("~/webAppSources/")
 
 DEFAULT_LOGFILE = sys.stdout
 
+# Where BlindElephant.py --updateDB gets new DB files (see DbUpdater): a source
+# publishing a manifest (None until one exists), and the hex Ed25519 public key
+# the manifest must be signed with (None: updates need --allowUnsigned)
+DB_UPDATE_URL = None
+DB_UPDATE_PUBLIC_KEY = None
+# Tarball of the dbs/ directory used while there is no DB_UPDATE_URL (unsigned)
+DB_UPDATE_TARBALL_URL = "http://blindelephant.svn.sourceforge.net/viewvc/blindelephant/trunk/src/blindelephant/dbs/?view=tar"
+
 
 # ===============================================================================
 # To regenerate the .pkl files, make sure that APPS_PATH below points to a
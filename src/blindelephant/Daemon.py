@@ -0,0 +1,305 @@
+"""Long-running BlindElephant service with a warm DB cache.
+
+Loads every DB (and the probe list of every app) once, then answers
+fingerprint, guess, plugin and scan requests over a local HTTP API (TCP or a
+Unix socket), several at a time. DBs rebuilt on disk are reloaded while the
+daemon runs.
+
+Requests are POSTs with a json body; responses are json:
+
+    POST /guess        {"url": ...}                          -> {"url", "apps"}
+    POST /fingerprint  {"url": ..., "app": ...}              -> {"url", "app", "versions", "best_guess"}
+    POST /plugins      {"url": ..., "app": ...[, "plugin"]}  -> {"url", "app", "plugins"} (or one plugin's versions)
+    POST /scan         {"url": ...[, "plugins": true]}       -> Scanner result
+    GET  /status                                            -> cache and request statistics
+
+/plugins and /scan take "head": true to look for plugins with HEAD requests
+(see Fingerprinters.PluginGuesser). Paths found missing on a host are
+remembered for all requests (see NegativeCache).
+"""
+import json
+import os
+import pickle
+import socket
+import socketserver
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from optparse import OptionParser
+
+import Configuration
+import DifferencesTables
+import FingerprintUtils
+import Fingerprinters
+import GlobalIndex
+import Loggers
+import NegativeCache
+import ProbeEngine
+import ResponseMemo
+import Scanner
+
+DEFAULT_PORT = 8757
+# Seconds between checks of the DB directory for changed files
+RELOAD_INTERVAL = 2.0
+# Probes per fingerprint unless a request asks for another number
+NUM_PROBES = 15
+
+COMMANDS = ("status", "guess", "fingerprint", "plugins", "scan")
+
+
+class DBCache(object):
+    """Loads every app and plugin DB (into DifferencesTables' cache, which
+    keeps as many as its memory budget allows) and each app's ranked probe
+    list, and reloads DBs whose files change.
+    """
+
+    def __init__(self, use_index=False):
+        self.use_index = use_index
+        self.index = None
+        self.reloads = 0
+        self._mtimes = {}
+        self._probe_lists = {}
+        self._lock = threading.Lock()
+        self.reload()
+
+    def _db_files(self):
+        files = {}
+        for app in Configuration.APP_CONFIG:
+            files[Configuration.getDbPath(app)] = app
+            plugins_dir = Configuration.getDbDir(app)
+            if os.path.isdir(plugins_dir):
+                for name in os.listdir(plugins_dir):
+                    if name.endswith(Configuration.DB_EXTENSION):
+                        files[plugins_dir + name] = None
+        return {f: app for f, app in files.items() if os.path.exists(f)}
+
+    def reload(self):
+        """Load DBs that are new or changed since the last call and drop
+        removed ones. Returns the list of files (re)loaded or dropped."""
+        files = self._db_files()
+        changed = [f for f in files if os.path.getmtime(f) != self._mtimes.get(f)]
+        removed = [f for f in self._mtimes if f not in files]
+        if not changed and not removed:
+            return []
+        probe_lists = dict(self._probe_lists)
+        mtimes = dict(self._mtimes)
+        for f in removed:
+            DifferencesTables.invalidateTables(f)
+            del mtimes[f]
+        for app_name in list(probe_lists):
+            if Configuration.getDbPath(app_name) in removed:
+                del probe_lists[app_name]
+        for f in changed:
+            mtimes[f] = os.path.getmtime(f)
+            DifferencesTables.invalidateTables(f)
+            try:
+                path_nodes, version_nodes, versions = DifferencesTables.loadTables(f, printStats=False)
+            except (pickle.UnpicklingError, EOFError, ValueError) as e:
+                # skipped until the file changes again
+                print(f"WARN: Couldn't load {f}: {e}", file=Configuration.DEFAULT_LOGFILE)
+                continue
+            if files[f]:
+                probe_lists[files[f]] = FingerprintUtils.pick_fingerprint_files(path_nodes, versions)
+        index = GlobalIndex.load_index() if self.use_index else None
+        with self._lock:
+            if self._mtimes:
+                self.reloads += 1
+            self._probe_lists, self._mtimes, self.index = probe_lists, mtimes, index
+        return changed + removed
+
+    def probe_list(self, app_name):
+        with self._lock:
+            return self._probe_lists.get(app_name)
+
+    def stats(self):
+        with self._lock:
+            return {"dbs": len(self._mtimes), "apps": len(self._probe_lists), "reloads": self.reloads,
+                    "index": self.index is not None}
+
+    def watch(self, stop, interval=RELOAD_INTERVAL):
+        """Reload changed DBs every interval seconds until stop (an Event) is set"""
+        while not stop.wait(interval):
+            try:
+                self.reload()
+            except (OSError, EOFError, ValueError) as e:
+                # eg a DB caught half-written; it is retried on the next pass
+                print(f"WARN: Reloading DBs failed: {e}", file=Configuration.DEFAULT_LOGFILE)
+
+
+class FingerprintDaemon(object):
+    """Handles API requests (see module docstring and COMMANDS) with a shared
+    DBCache, ProbeEngine and logger."""
+
+    def __init__(self, cache, engine=None, logger=None):
+        self.cache = cache
+        self.engine = engine
+        # shared by all requests: paths found missing on a host are skipped by later requests until they expire
+        self.negative_cache = NegativeCache.NegativeCache()
+        self.logger = logger or Loggers.NullLogger()
+        self.started = time.time()
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def handle(self, command, params):
+        with self._lock:
+            self.requests += 1
+        if command == "status":
+            table_cache = DifferencesTables.tableCacheStats()
+            del table_cache["sizes"]
+            return dict(self.cache.stats(), uptime=time.time() - self.started, requests=self.requests,
+                        table_cache=table_cache, negative_cache=self.negative_cache.stats())
+        url = params.get("url", "").strip("/")
+        if not url.startswith("http://") and not url.startswith("https://"):
+            raise ValueError("url (http:// or https://) is required")
+        if command == "scan":
+            s = Scanner.Scanner(url, bool(params.get("plugins")), engine=self.engine, logger=self.logger,
+                                index=self.cache.index, head_plugins=bool(params.get("head")),
+                                negative_cache=self.negative_cache)
+            s.scan()
+            return s.result.to_dict()
+
+        self.negative_cache.protect(url)
+        memo = ResponseMemo.ResponseMemo(self.negative_cache)
+        options = {"logger": self.logger, "engine": self.engine, "memo": memo}
+        if command == "guess":
+            guesser = Fingerprinters.WebAppGuesser(url, **options)
+            apps = list(guesser.identify_apps(self.cache.index)) if self.cache.index else guesser.guess_apps()
+            return {"url": url, "apps": apps}
+
+        app_name = params.get("app")
+        if app_name not in Configuration.APP_CONFIG:
+            raise ValueError(f"Unsupported web app {app_name!r}")
+        num_probes = int(params.get("num_probes", NUM_PROBES))
+        if command == "fingerprint":
+            fp = Fingerprinters.WebAppFingerprinter(url, app_name, num_probes=num_probes, **options)
+            probe_list = self.cache.probe_list(app_name)
+            fp.fingerprint(fp.probe_paths(probe_list) if probe_list is not None else None)
+            return {"url": url, "app": app_name, "versions": [v.vstring for v in fp.ver_list],
+                    "best_guess": fp.best_guess.vstring if fp.best_guess else None}
+        if command == "plugins":
+            if "pluginsRoot" not in Configuration.APP_CONFIG[app_name]:
+                raise ValueError(f"Plugins are not supported for {app_name}")
+            if params.get("plugin"):
+                fp = Fingerprinters.PluginFingerprinter(url, app_name, params["plugin"], num_probes=num_probes,
+                                                        **options)
+                fp.fingerprint()
+                return {"url": url, "app": app_name, "plugin": params["plugin"],
+                        "versions": [v.vstring for v in fp.ver_list]}
+            return {"url": url, "app": app_name,
+                    "plugins": Fingerprinters.PluginGuesser(url, app_name, head=bool(params.get("head")),
+                                                            **options).guess_plugins()}
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def _make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self._respond({})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                params = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(params, dict):
+                    raise ValueError
+            except ValueError:
+                self._send(400, {"error": "Request body must be a json object"})
+                return
+            self._respond(params)
+
+        def _respond(self, params):
+            command = self.path.strip("/").split("?")[0]
+            if command not in COMMANDS:
+                self._send(404, {"error": f"Unknown request {self.path}"})
+                return
+            try:
+                self._send(200, daemon.handle(command, params))
+            except ValueError as e:
+                self._send(400, {"error": str(e)})
+            except Exception as e:
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    USAGE = "usage: %prog [options]"
+    EPILOGUE = """Run BlindElephant as a service: DBs are loaded once and kept
+               warm, requests are answered concurrently, and DBs rebuilt on disk
+               are picked up automatically. See Daemon.py's docstring for the API."""
+
+    parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
+    parser.add_option("-p", "--port", type='int', default=DEFAULT_PORT, help="TCP port. Default: %default")
+    parser.add_option("-b", "--bind", default="127.0.0.1", help="Address to listen on. Default: %default")
+    parser.add_option("-s", "--socket", help="Listen on this Unix socket instead of TCP")
+    parser.add_option("-c", "--concurrency", type='int', default=1,
+                      help="Maximum number of concurrent probes per host (see ProbeEngine). Default: %default")
+    parser.add_option("-m", "--cache-mb", type='int',
+                      help="Memory budget of the DB cache in MB; least recently used DBs beyond it are dropped "
+                           "and reloaded on demand. Default: %d" % (DifferencesTables.TABLE_CACHE_BUDGET // 2 ** 20))
+    parser.add_option("-i", "--index", action="store_true", help="Guess apps with the global index (see GlobalIndex)")
+    parser.add_option("--log", help="Log every probe to this file, as json lines if it ends in .jsonl, "
+                                    "as text otherwise")
+    parser.add_option("--reload-interval", type='float', default=RELOAD_INTERVAL,
+                      help="Seconds between checks for changed DBs (0 disables reloading). Default: %default")
+
+    (options, args) = parser.parse_args()
+
+    if options.cache_mb:
+        DifferencesTables.setTableCacheBudget(options.cache_mb * 2 ** 20)
+    start = time.perf_counter()
+    cache = DBCache(options.index)
+    print(f"Loaded {cache.stats()['dbs']} DBs in {time.perf_counter() - start:.2f}s",
+          file=Configuration.DEFAULT_LOGFILE)
+    engine = ProbeEngine.ProbeEngine(max_window=options.concurrency) if options.concurrency > 1 else None
+    logger = None
+    if options.log:
+        logger = Loggers.StructuredLogger(open(options.log, "w"), "jsonl" if options.log.endswith(".jsonl") else "text")
+    daemon = FingerprintDaemon(cache, engine, logger)
+
+    if options.socket:
+        if os.path.exists(options.socket):
+            os.remove(options.socket)
+        httpd = UnixHTTPServer(options.socket, _make_handler(daemon))
+        print(f"Listening on {options.socket}", file=Configuration.DEFAULT_LOGFILE)
+    else:
+        httpd = ThreadingHTTPServer((options.bind, options.port), _make_handler(daemon))
+        print(f"Listening on http://{options.bind}:{httpd.server_address[1]}", file=Configuration.DEFAULT_LOGFILE)
+    httpd.daemon_threads = True
+
+    stop = threading.Event()
+    if options.reload_interval > 0:
+        threading.Thread(target=cache.watch, args=(stop, options.reload_interval), daemon=True).start()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        httpd.server_close()
+        if options.socket and os.path.exists(options.socket):
+            os.remove(options.socket)
+        if engine:
+            engine.shutdown()
+        if logger:
+            logger.close()
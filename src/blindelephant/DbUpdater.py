@@ -0,0 +1,399 @@
+"""Incremental DB updates from a static file server (or a local directory).
+
+The update source publishes the dbs/ tree as is, plus a manifest listing the
+sha256 digest and size of every DB file, and optionally a detached signature
+of the manifest. An update fetches the manifest (and checks its signature),
+downloads only the DB files whose digest differs from the local copy and
+verifies each against the manifest.
+
+Updates are staged in a copy of the DB directory next to it (hard links to
+the unchanged files) and only swapped in, with two renames, once every file
+has arrived, so a failed update changes nothing and no scan ever sees a mix
+of old and new DBs. If the swap itself is interrupted between the renames,
+the next update puts the old directory back before it starts.
+
+Signatures are Ed25519 (hex public key in Configuration.DB_UPDATE_PUBLIC_KEY)
+and need the cryptography package (optional); any other scheme can be
+plugged in by passing a verify function to update(). DB files are pickles,
+so an update whose manifest can't be checked is refused unless unsigned
+updates are explicitly allowed.
+
+Until a source publishes a manifest (Configuration.DB_UPDATE_URL is None),
+DBs come from a tarball of the dbs/ directory (update_from_tarball), which
+can't be verified at all and so always needs unsigned updates allowed.
+Refusals raise UnsignedError, so callers can name their own opt-out flag.
+
+Publishing is `DbUpdater.py --publish dbs/ [--key private.pem]`.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from optparse import OptionParser
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+except ImportError:
+    Ed25519PublicKey = None
+
+import Configuration
+
+MANIFEST_NAME = "manifest.json"
+SIGNATURE_NAME = MANIFEST_NAME + ".sig"
+MANIFEST_FORMAT = 1
+# New DB files are downloaded into the staging directory under their name plus this, until verified
+DOWNLOAD_SUFFIX = ".download"
+# The staging copy of the DB directory, and the old one while the new one is swapped in
+STAGING_SUFFIX = ".new"
+OLD_SUFFIX = ".old"
+CHUNK_SIZE = 2 ** 16
+TIMEOUT = 60
+
+
+class UpdateError(Exception):
+    """The update source can't be used (bad manifest, signature or file); nothing was changed"""
+
+
+class UnsignedError(UpdateError):
+    """The DB files can't be verified and unsigned updates weren't allowed"""
+
+
+def available():
+    """True if signatures can be checked (the cryptography package is installed)"""
+    return Ed25519PublicKey is not None
+
+
+def ed25519_verifier(public_key):
+    """Return a verify(manifest, signature) function checking Ed25519
+    signatures made with the key whose raw public half is public_key (hex)"""
+    if not available():
+        raise UpdateError("checking DB update signatures requires the cryptography package")
+    key = Ed25519PublicKey.from_public_bytes(bytes.fromhex(public_key))
+
+    def verify(manifest, signature):
+        try:
+            key.verify(signature, manifest)
+        except InvalidSignature:
+            raise UpdateError("bad manifest signature")
+
+    return verify
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _db_files(db_dir):
+    """Paths (relative to db_dir, with "/" separators) of the DB files in db_dir"""
+    names = []
+    for dirpath, dirnames, filenames in os.walk(db_dir):
+        rel = os.path.relpath(dirpath, db_dir)
+        names.extend(name if rel == "." else f"{rel.replace(os.sep, '/')}/{name}"
+                     for name in filenames if name.endswith(Configuration.DB_EXTENSION))
+    return sorted(names)
+
+
+def build_manifest(db_dir):
+    """Manifest (a dict) describing the DB files in db_dir"""
+    return {"format": MANIFEST_FORMAT,
+            "created": int(time.time()),
+            "files": {name: {"sha256": _file_digest(os.path.join(db_dir, name)),
+                             "size": os.path.getsize(os.path.join(db_dir, name))}
+                      for name in _db_files(db_dir)}}
+
+
+def publish(db_dir, sign=None):
+    """Write the manifest of db_dir into it, and its signature made with
+    sign(manifest bytes) -> signature bytes if sign is given. Returns the
+    manifest."""
+    manifest = build_manifest(db_dir)
+    data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+    for name, content in ((MANIFEST_NAME, data), (SIGNATURE_NAME, sign(data) if sign else None)):
+        path = os.path.join(db_dir, name)
+        if content is None:
+            if os.path.exists(path):
+                os.remove(path)
+            continue
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+    return manifest
+
+
+def _source_url(source):
+    """Base url (ending in /) for source, an http(s) or file url or a local directory"""
+    if not urllib.parse.urlsplit(source).scheme or os.path.isdir(source):
+        return pathlib.Path(source).resolve().as_uri() + "/"
+    return source if source.endswith("/") else source + "/"
+
+
+def _open(base_url, name):
+    return urllib.request.urlopen(base_url + urllib.parse.quote(name), timeout=TIMEOUT)
+
+
+def fetch_manifest(source, verify=None):
+    """Fetch and parse the manifest of source. If verify is given it is
+    called with the manifest bytes and its signature and must raise
+    UpdateError if the signature is bad; a missing signature is an error
+    then too."""
+    base_url = _source_url(source)
+    try:
+        with _open(base_url, MANIFEST_NAME) as f:
+            data = f.read()
+        signature = None
+        if verify:
+            with _open(base_url, SIGNATURE_NAME) as f:
+                signature = f.read()
+    except (urllib.error.URLError, OSError) as e:
+        raise UpdateError(f"can't fetch the manifest from {base_url}: {e}")
+    if verify:
+        verify(data, signature)
+    try:
+        manifest = json.loads(data)
+    except ValueError as e:
+        raise UpdateError(f"unreadable manifest: {e}")
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise UpdateError(f"unsupported manifest format {manifest.get('format')}")
+    for name in manifest["files"]:
+        parts = name.split("/")
+        if name.startswith("/") or ".." in parts or "" in parts or not name.endswith(Configuration.DB_EXTENSION):
+            raise UpdateError(f"bad file name in manifest: {name!r}")
+    return manifest
+
+
+def changed_files(manifest, db_dir):
+    """Names of the manifest's files that are missing from db_dir or differ"""
+    changed = []
+    for name, entry in sorted(manifest["files"].items()):
+        path = os.path.join(db_dir, *name.split("/"))
+        if not os.path.exists(path) or os.path.getsize(path) != entry["size"] or _file_digest(path) != entry["sha256"]:
+            changed.append(name)
+    return changed
+
+
+def _download(base_url, name, entry, path):
+    """Download name to path, checking it against its manifest entry"""
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with _open(base_url, name) as f, open(path, "wb") as out:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+                size += len(chunk)
+                if size > entry["size"]:
+                    break
+                out.write(chunk)
+    except (urllib.error.URLError, OSError) as e:
+        raise UpdateError(f"can't fetch {name}: {e}")
+    if size != entry["size"] or h.hexdigest() != entry["sha256"]:
+        raise UpdateError(f"{name} doesn't match the manifest")
+
+
+def _refuse_unsigned(allow_unsigned, what, log):
+    if not allow_unsigned:
+        raise UnsignedError(f"{what} can't be verified; refusing to install unsigned DB files "
+                            f"unless unsigned updates are allowed")
+    print(f"WARN: installing unverified DB files ({what} can't be verified)", file=log)
+
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _recover(db_dir):
+    """Put back the old DB directory if a swap was interrupted, and remove
+    what's left of earlier updates"""
+    old = db_dir + OLD_SUFFIX
+    if not os.path.exists(db_dir) and os.path.isdir(old):
+        os.rename(old, db_dir)
+    for leftover in (db_dir + STAGING_SUFFIX, old):
+        if os.path.exists(leftover):
+            shutil.rmtree(leftover)
+
+
+def _stage(db_dir):
+    """New staging copy of db_dir, made of hard links to its files (so new
+    files must be written under another name and os.replace'd in)"""
+    _recover(db_dir)
+    staging = db_dir + STAGING_SUFFIX
+    if os.path.isdir(db_dir):
+        shutil.copytree(db_dir, staging, copy_function=_link)
+    else:
+        os.makedirs(staging)
+    return staging
+
+
+def _swap(db_dir, staging):
+    """Replace db_dir with the staging directory"""
+    old = db_dir + OLD_SUFFIX
+    if os.path.isdir(db_dir):
+        os.rename(db_dir, old)
+    os.rename(staging, db_dir)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+
+def update(source, db_dir=None, verify=None, prune=False, log=None, allow_unsigned=False):
+    """Bring db_dir (default: Configuration.DBS_PATH) up to date with source
+    (see module docstring), downloading only changed DB files. With prune,
+    local DB files missing from the manifest are removed. Without verify,
+    allow_unsigned must be set. Returns the names of the files updated (and
+    removed). Raises UpdateError (UnsignedError if the source can't be
+    verified), leaving db_dir as it was, if the source can't be used.
+    """
+    db_dir = os.path.normpath(os.path.abspath(db_dir or Configuration.DBS_PATH))
+    log = log or Configuration.DEFAULT_LOGFILE
+    base_url = _source_url(source)
+    if verify is None:
+        _refuse_unsigned(allow_unsigned, "the manifest (no public key configured)", log)
+    manifest = fetch_manifest(source, verify)
+    changed = changed_files(manifest, db_dir)
+    print(f"{len(changed)} of {len(manifest['files'])} DB files changed", file=log)
+    removed = []
+    if prune and os.path.isdir(db_dir):
+        removed = [name for name in _db_files(db_dir) if name not in manifest["files"]]
+    if not changed and not removed:
+        return []
+
+    staging = _stage(db_dir)
+    try:
+        for name in changed:
+            path = os.path.join(staging, *name.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            print("Fetching", name, file=log)
+            _download(base_url, name, manifest["files"][name], path + DOWNLOAD_SUFFIX)
+            os.replace(path + DOWNLOAD_SUFFIX, path)
+        for name in removed:
+            print("Removing", name, file=log)
+            os.remove(os.path.join(staging, *name.split("/")))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    _swap(db_dir, staging)
+    return changed + removed
+
+
+def _tarball_db_name(member):
+    """Name (relative to dbs/, with "/" separators) of a tarball member that
+    is a DB file under dbs/, or None for anything else"""
+    parts = member.name.split("/")
+    if not member.isfile() or parts[0] != "dbs":
+        return None
+    name = "/".join(parts[1:])
+    if ".." in parts or "" in parts[1:] or not name.endswith(Configuration.DB_EXTENSION):
+        return None
+    return name
+
+
+def update_from_tarball(url, db_dir=None, log=None, allow_unsigned=False):
+    """Bring db_dir (default: Configuration.DBS_PATH) up to date with a
+    tarball of the dbs/ directory at url. Nothing in it can be verified, so
+    allow_unsigned must be set. Only regular DB files under dbs/ are taken,
+    and like in update() they are staged and swapped in once all are
+    extracted. Returns the names of the files updated."""
+    db_dir = os.path.normpath(os.path.abspath(db_dir or Configuration.DBS_PATH))
+    log = log or Configuration.DEFAULT_LOGFILE
+    _refuse_unsigned(allow_unsigned, "the DB tarball", log)
+    updated = []
+    staging = _stage(db_dir)
+    try:
+        with tempfile.TemporaryFile() as tmp:
+            with urllib.request.urlopen(url, timeout=TIMEOUT) as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    tmp.write(chunk)
+            tmp.seek(0)
+            with tarfile.open(fileobj=tmp) as tar:
+                for member in tar:
+                    name = _tarball_db_name(member)
+                    if name is None:
+                        continue
+                    path = os.path.join(staging, *name.split("/"))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    h = hashlib.sha256()
+                    with tar.extractfile(member) as f, open(path + DOWNLOAD_SUFFIX, "wb") as out:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                            h.update(chunk)
+                            out.write(chunk)
+                    if os.path.exists(path) and _file_digest(path) == h.hexdigest():
+                        os.remove(path + DOWNLOAD_SUFFIX)
+                        continue
+                    print("Updating", name, file=log)
+                    os.replace(path + DOWNLOAD_SUFFIX, path)
+                    updated.append(name)
+    except (urllib.error.URLError, OSError, tarfile.TarError) as e:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise UpdateError(f"can't update from {url}: {e}")
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if updated:
+        _swap(db_dir, staging)
+    else:
+        shutil.rmtree(staging)
+    return updated
+
+
+if __name__ == '__main__':
+    USAGE = "usage: %prog [options] [source]"
+    EPILOGUE = """Update the DB files from source (an http(s) url or a local
+               directory; default: Configuration.DB_UPDATE_URL, or the DB
+               tarball if that isn't set), fetching only those that changed.
+               With --publish, write the manifest (and signature, with --key)
+               for serving a DB directory instead."""
+
+    parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
+    parser.add_option("-d", "--db-dir", help="DB directory to update. Default: the installed dbs/")
+    parser.add_option("--prune", action="store_true", help="Remove local DB files the source doesn't have")
+    parser.add_option("--allow-unsigned", action="store_true",
+                      help="Install DB files that can't be verified (no public key configured, or the tarball)")
+    parser.add_option("--publish", metavar="DIR", help="Write the manifest of the DB directory DIR")
+    parser.add_option("--key", help="Ed25519 private key (PEM) to sign the manifest with, for --publish")
+
+    (options, args) = parser.parse_args()
+
+    try:
+        if options.publish:
+            sign = None
+            if options.key:
+                if not available():
+                    raise UpdateError("signing requires the cryptography package")
+                with open(options.key, "rb") as f:
+                    sign = serialization.load_pem_private_key(f.read(), password=None).sign
+            manifest = publish(options.publish, sign)
+            print(f"Wrote manifest of {len(manifest['files'])} DB files"
+                  f"{' (signed)' if sign else ''} to {options.publish}")
+            quit()
+
+        source = args[0] if args else Configuration.DB_UPDATE_URL
+        if source:
+            verify = None
+            if Configuration.DB_UPDATE_PUBLIC_KEY:
+                verify = ed25519_verifier(Configuration.DB_UPDATE_PUBLIC_KEY)
+            updated = update(source, options.db_dir, verify, options.prune, allow_unsigned=options.allow_unsigned)
+        else:
+            updated = update_from_tarball(Configuration.DB_UPDATE_TARBALL_URL, options.db_dir,
+                                          allow_unsigned=options.allow_unsigned)
+        print(f"Updated {len(updated)} DB files")
+    except UnsignedError as e:
+        print("Error:", e, "(pass --allow-unsigned to install them anyway)")
+        sys.exit(1)
+    except UpdateError as e:
+        print("Error:", e)
+        sys.exit(1)
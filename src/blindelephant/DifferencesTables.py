@@ -1,18 +1,185 @@
 """Functions to create and access BlindElephant fingerprinting dbs"""
+import array
+import collections
 import hashlib
+import heapq
+import itertools
+import math
 import os
 import pickle
 import re
 import sys
+import tempfile
+import threading
 from distutils.version import LooseVersion
 from os.path import join, isdir
+from types import MappingProxyType
+
+try:
+    import Tracing
+except ImportError:
+    # imported as blindelephant.DifferencesTables (eg by LatestVersionFetcher)
+    from blindelephant import Tracing
 
 DEBUG = True
 
 LooseVersion.__hash__ = lambda s: s.vstring.__hash__()
 
+# Approximate memory (bytes) the loadTables cache may hold before evicting the least recently used tables
+TABLE_CACHE_BUDGET = 1024 * 1024 * 1024
+
+# Approximate memory (bytes) of one (path, hash, version) record buffered by an external build (see computeTables)
+BUILD_RECORD_SIZE = 200
+# Maximum number of run files merged at once; more runs are first merged in several passes
+BUILD_MERGE_FANIN = 64
+
+# Indicator file selection (see computeIndicatorFiles):
+# Probability that one indicator file of an installed app can't be seen (removed, blocked, customized)
+INDICATOR_MISS_RATE = .2
+# Probability with which the indicator files should detect any known version
+INDICATOR_TARGET = .95
+# Maximum number of indicator files per app or plugin
+INDICATOR_MAX_FILES = 6
+# Response bytes that cost about as much as one more request
+INDICATOR_REQUEST_BYTES = 16 * 1024
+# Typical sizes (bytes) by extension, used when the size of a file isn't known
+INDICATOR_TYPICAL_SIZES = {".txt": 4096, ".css": 8192, ".js": 16384, ".html": 8192, ".htm": 8192,
+                           ".gif": 4096, ".png": 8192, ".ico": 4096, ".jpg": 32768, ".jpeg": 32768,
+                           ".swf": 65536, ".jar": 131072, ".pdf": 131072, ".zip": 131072}
+INDICATOR_DEFAULT_SIZE = 8192
+
+
+class TableCache(object):
+    """LRU cache of loaded tables, bounded by the estimated memory they use
+    (see estimateTableSize). Evicted tables are freed once callers drop their
+    references to them.
+    """
+
+    def __init__(self, budget=TABLE_CACHE_BUDGET):
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tables = collections.OrderedDict()
+        self._sizes = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        with self._lock:
+            tables = self._tables.get(filename)
+            if tables is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tables.move_to_end(filename)
+            return tables
+
+    def put(self, filename, tables):
+        size = estimateTableSize(tables)
+        with self._lock:
+            self._discard(filename)
+            self._tables[filename] = tables
+            self._sizes[filename] = size
+            self._size += size
+            self._evict()
+
+    def pop(self, filename):
+        with self._lock:
+            self._discard(filename)
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._sizes.clear()
+            self._size = 0
+
+    def setBudget(self, budget):
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    @property
+    def size(self):
+        return self._size
+
+    def stats(self):
+        with self._lock:
+            return {"tables": len(self._tables), "bytes": self.size, "budget": self.budget, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "sizes": dict(self._sizes)}
+
+    def _discard(self, filename):
+        self._tables.pop(filename, None)
+        self._size -= self._sizes.pop(filename, 0)
+
+    def _evict(self):
+        # the most recently used table stays even if it alone exceeds the budget
+        while len(self._tables) > 1 and self.size > self.budget:
+            filename, _ = self._tables.popitem(last=False)
+            self._size -= self._sizes.pop(filename)
+            self.evictions += 1
+
+
+def estimateTableSize(tables):
+    """Approximate memory in bytes used by frozen tables (as returned by
+    loadTables), computed from the number of entries of each container
+    instead of by visiting every object."""
+    pathNodes, versionNodes, versions = tables[:3]
+    size = sys.getsizeof(pathNodes) + _dictSize(len(pathNodes)) + sys.getsizeof(versionNodes) + \
+        _dictSize(len(versionNodes)) + sys.getsizeof(versions)
+    versionTuples = {}
+    for path, hashes in pathNodes.items():
+        # the digests are shared with versionNodes
+        size += sys.getsizeof(path) + sys.getsizeof(hashes) + _dictSize(len(hashes)) + len(hashes) * _DIGEST_SIZE
+        for vers in hashes.values():
+            versionTuples[id(vers)] = vers
+    size += sum(sys.getsizeof(vers) for vers in versionTuples.values())
+    nodes = 0
+    for key, group in versionNodes.items():
+        size += sys.getsizeof(key) + sys.getsizeof(group)
+        nodes += len(group)
+    # each node is a (path, digest) pair of objects shared with pathNodes
+    size += nodes * _PAIR_SIZE
+    for v in versions:
+        size += sys.getsizeof(v) + sys.getsizeof(v.__dict__) + sys.getsizeof(v.vstring) + sys.getsizeof(v.version)
+    return size
+
+
+_PAIR_SIZE = sys.getsizeof(("", ""))
+_DIGEST_SIZE = sys.getsizeof("0" * 32)
+_dictSizes = {}
+
+
+def _dictSize(n):
+    """Memory in bytes of a dict with n entries (not counting its keys and values)"""
+    size = _dictSizes.get(n)
+    if size is None:
+        size = _dictSizes[n] = sys.getsizeof({i: None for i in range(n)})
+    return size
+
+
+def freezeTables(pathNodes, versionNodes, versions):
+    """Return a compact, read-only copy of tables from computeTables() or an
+    unpickled DB, safe to share between threads: paths are interned (and
+    shared between pathNodes and versionNodes), identical version lists
+    become one shared tuple, and dicts become read-only mapping proxies.
+    Digests stay hex strings, so lookups are plain dict lookups.
+    """
+    versionTuples = {}
+    frozenPathNodes = {}
+    for path, hashes in pathNodes.items():
+        frozenHashes = {}
+        for _hash, vers in hashes.items():
+            vers = tuple(vers)
+            frozenHashes[_hash] = versionTuples.setdefault(vers, vers)
+        frozenPathNodes[sys.intern(path)] = MappingProxyType(frozenHashes)
+    frozenVersionNodes = {key: tuple((sys.intern(path), _hash) for path, _hash in nodes)
+                          for key, nodes in versionNodes.items()}
+    return MappingProxyType(frozenPathNodes), MappingProxyType(frozenVersionNodes), tuple(versions)
+
+
 # Used by loadTable for caching
-__loaded_tables = {}
+__loaded_tables = TableCache()
 
 
 # TODO: - emit in a format usable by other services - Correctly use the absence of a file for inference - use
@@ -27,7 +194,8 @@ __loaded_tables = {}
 #  a version set (mult-version winnowing)
 
 
-def computeTables(basepath, versionDirectoryRegex="", directoryExcludeRegex="", fileExcludeRegex=""):
+def computeTables(basepath, versionDirectoryRegex="", directoryExcludeRegex="", fileExcludeRegex="",
+                  memoryLimit=None, tempDir=None):
     """
     Walks version directories (any dirs in basepath matching versionDirectoryRegex) and computes hashes of all files,
     then uses those hashes to create and return pathNodes and versionNodes as a tuple: (pathNodes, versionNodes,
@@ -62,7 +230,16 @@ def computeTables(basepath, versionDirectoryRegex="", directoryExcludeRegex="",
          'a89780a5e042e29af32c3d886578524a')
 
     versions is a list of LooseVersions indicating all known versions    
+
+    If memoryLimit (bytes) is given, the tables are built externally: the (path, hash, version) record of every file
+    is buffered up to memoryLimit, spilled to sorted run files in tempDir (default: the system temp dir) and merged,
+    so that peak memory stays close to the size of the resulting tables however many versions there are. The result
+    is the same as building in memory.
     """
+    appdirs = _versionDirectories(basepath, versionDirectoryRegex)
+    if memoryLimit is not None:
+        return _computeTablesExternal(basepath, appdirs, directoryExcludeRegex, fileExcludeRegex, memoryLimit,
+                                      tempDir)
 
     # hashNodes is the simple hash that gives rise to versionNodes and pathNodes.
     # It is indexed by hash(data + path) and contains
@@ -73,54 +250,27 @@ def computeTables(basepath, versionDirectoryRegex="", directoryExcludeRegex="",
     versions = []
     numfiles = 0
 
-    # root dirs for various versions of an app
-    appdirs = [f for f in os.listdir(basepath) if isdir(join(basepath, f)) and re.match(versionDirectoryRegex, f)]
-
     # Process all version directories
-    for app_dir in appdirs:
-        # TODO: just a single regex isn't sufficiently expressive to capture all
-        #  the random version naming schemes out there
-        # See SPIP and phpMyAdmin
-        # Suggest using a callable function that takes an app dir and returns a version version object
-        version = LooseVersion(re.match(versionDirectoryRegex, app_dir)[1])
+    for app_dir, version in appdirs:
         versions.append(version)
-        for root, dirs, files in os.walk(join(basepath, app_dir)):
-
-            # print "files before:", files
-            files = [d for d in files if not re.match(fileExcludeRegex, d)]
-            # print "files after:", files
-
-            to_remove = [_dir for _dir in dirs if re.match(directoryExcludeRegex, _dir)]
-            for _dir in to_remove:
-                dirs.remove(_dir)
-
-            # compute hashes for all files
-            for name in files:
-                numfiles += 1
-                # set path to be only the part of the full path *after* the version directory, eg /templates/system/css/general.css, not .../Joomla-x.y.z/templates/system/css/general.css
-                path = join(root, name)
-                path = path[path.index(app_dir) + len(app_dir):]
-                # print "Path: ", path, "(root=", root, ", appdir=", appdir, ", name=", name,")"
-                with open(join(root, name)) as file:
-                    _hash = hashlib.md5(f"{file.read()}{path}".encode('utf-8')).hexdigest()
-
-                # print version,join(root, name).replace(dir + "/", "", 1), hashlib.md5(open(join(root, name)).read()).hexdigest()
-                node = (version, path, _hash)
-
-                if _hash in hashNodes:
-                    hashNodes[_hash].append(node)
-                else:
-                    hashNodes[_hash] = [node]
-
-                if path in pathNodes:
-                    if _hash in pathNodes[path]:
-                        pathNodes[path][_hash].append(version)
-                    else:
-                        pathNodes[path][_hash] = [version]
+        for path, _hash in _hashVersionFiles(basepath, app_dir, directoryExcludeRegex, fileExcludeRegex):
+            numfiles += 1
+            node = (version, path, _hash)
+
+            if _hash in hashNodes:
+                hashNodes[_hash].append(node)
+            else:
+                hashNodes[_hash] = [node]
+
+            if path in pathNodes:
+                if _hash in pathNodes[path]:
+                    pathNodes[path][_hash].append(version)
                 else:
-                    pathNodes[path] = {_hash: [version]}
-                    # print "Intermediate result: Processed %s versions with %s files matching filter, resulting in %s unique hashes, %s differentiating paths" % (len(versions), numfiles, len(hashNodes), len(pathNodes))
-                    # print "%s, %s, %s, %s" % (len(versions), numfiles, len(hashNodes), len(pathNodes))
+                    pathNodes[path][_hash] = [version]
+            else:
+                pathNodes[path] = {_hash: [version]}
+                # print "Intermediate result: Processed %s versions with %s files matching filter, resulting in %s unique hashes, %s differentiating paths" % (len(versions), numfiles, len(hashNodes), len(pathNodes))
+                # print "%s, %s, %s, %s" % (len(versions), numfiles, len(hashNodes), len(pathNodes))
 
     for key in list(hashNodes.keys()):
         # collect versions implied by this file+path hash, and construct an ordered versions str to use as key
@@ -159,27 +309,218 @@ def computeTables(basepath, versionDirectoryRegex="", directoryExcludeRegex="",
     return pathNodes, versionNodes, versions
 
 
-def saveTables(filename, pathNodes, versionNodes, versions):
-    """Save the results of computeTables to disk.
+def _versionDirectories(basepath, versionDirectoryRegex):
+    """(dirname, LooseVersion) of the root dirs of the versions of an app in basepath"""
+    # TODO: just a single regex isn't sufficiently expressive to capture all
+    #  the random version naming schemes out there
+    # See SPIP and phpMyAdmin
+    # Suggest using a callable function that takes an app dir and returns a version version object
+    return [(f, LooseVersion(re.match(versionDirectoryRegex, f)[1])) for f in os.listdir(basepath)
+            if isdir(join(basepath, f)) and re.match(versionDirectoryRegex, f)]
+
+
+def _hashVersionFiles(basepath, app_dir, directoryExcludeRegex, fileExcludeRegex):
+    """Yield (path, hash) for every file of the version in app_dir that isn't excluded"""
+    for path, filename in _walkVersionFiles(basepath, app_dir, directoryExcludeRegex, fileExcludeRegex):
+        with open(filename) as file:
+            yield path, hashlib.md5(f"{file.read()}{path}".encode('utf-8')).hexdigest()
+
+
+def _walkVersionFiles(basepath, app_dir, directoryExcludeRegex, fileExcludeRegex):
+    """Yield (path, filename on disk) for every file of the version in app_dir that isn't excluded"""
+    for root, dirs, files in os.walk(join(basepath, app_dir)):
+
+        # print "files before:", files
+        files = [d for d in files if not re.match(fileExcludeRegex, d)]
+        # print "files after:", files
+
+        to_remove = [_dir for _dir in dirs if re.match(directoryExcludeRegex, _dir)]
+        for _dir in to_remove:
+            dirs.remove(_dir)
+
+        for name in files:
+            # set path to be only the part of the full path *after* the version directory, eg /templates/system/css/general.css, not .../Joomla-x.y.z/templates/system/css/general.css
+            path = join(root, name)
+            path = path[path.index(app_dir) + len(app_dir):]
+            yield path, join(root, name)
+
+
+def fileSizes(basepath, versionDirectoryRegex="", directoryExcludeRegex="", fileExcludeRegex=""):
+    """Return {path: largest size in bytes in any version} for the files computeTables (with the same arguments)
+    would hash"""
+    sizes = {}
+    for app_dir, version in _versionDirectories(basepath, versionDirectoryRegex):
+        for path, filename in _walkVersionFiles(basepath, app_dir, directoryExcludeRegex, fileExcludeRegex):
+            sizes[path] = max(sizes.get(path, 0), os.path.getsize(filename))
+    return sizes
+
+
+def indicatorCost(path, size=None):
+    """Relative cost of probing path: one request, plus its size (default: typical for its extension) in units of
+    INDICATOR_REQUEST_BYTES"""
+    if size is None:
+        size = INDICATOR_TYPICAL_SIZES.get(os.path.splitext(path)[1].lower(), INDICATOR_DEFAULT_SIZE)
+    return 1 + size / INDICATOR_REQUEST_BYTES
+
+
+def computeIndicatorFiles(pathNodes, versions, sizes=None, target=INDICATOR_TARGET, missRate=INDICATOR_MISS_RATE,
+                          maxFiles=INDICATOR_MAX_FILES):
+    """
+    Pick indicator files for an app or plugin from its tables: a small set of cheap paths (see indicatorCost; sizes
+    maps path -> bytes where known) that detects every known version with probability target, if each file of an
+    installed version can't be seen with probability missRate. A version with k of the files is missed with
+    probability missRate ** k, so each needs enough of them (2 with the defaults).
+
+    Paths are picked greedily by detection probability they add, summed over the versions still short of files, per
+    unit of cost, until every version is covered, no path adds anything, or maxFiles are picked. Gains only shrink
+    as paths are picked, so each round re-evaluates just the best few candidates (lazy greedy). Returns the paths
+    in the order picked, most useful first.
+    """
+    needed = max(1, math.ceil(math.log(1 - target) / math.log(missRate)))
+    # what one more file adds to the detection probability of a version that has k: missRate ** k * (1 - missRate)
+    added = [missRate ** k for k in range(needed)] + [0]
+    # versions are matched by identity, as a DB can have several versions with the same name
+    column = {id(v): i for i, v in enumerate(versions)}
+    columnByName = {v.vstring: i for i, v in enumerate(versions)}
+    sizes = sizes or {}
+    paths = list(pathNodes)
+    present = [{column[id(v)] if id(v) in column else columnByName[v.vstring]
+                for vers in pathNodes[path].values() for v in vers}
+               for path in paths]
+    costs = [indicatorCost(path, sizes.get(path)) for path in paths]
+    have = [0] * len(versions)
+    heap = [(-len(columns) / cost, i) for i, (columns, cost) in enumerate(zip(present, costs))]
+    heapq.heapify(heap)
+    chosen = []
+    while heap and len(chosen) < maxFiles and any(k < needed for k in have):
+        stale, i = heapq.heappop(heap)
+        gain = sum(added[have[c]] for c in present[i]) / costs[i]
+        if gain <= 0:
+            continue
+        if heap and (-gain, i) > heap[0]:
+            # another path may be better now; look at it first
+            heapq.heappush(heap, (-gain, i))
+            continue
+        chosen.append(paths[i])
+        for c in present[i]:
+            have[c] = min(have[c] + 1, needed)
+    return chosen
+
+
+def _computeTablesExternal(basepath, appdirs, directoryExcludeRegex, fileExcludeRegex, memoryLimit, tempDir):
+    """computeTables with bounded memory: file records (path id, raw hash, sequence number, version index) are
+    sorted in runs of at most memoryLimit and spilled to disk, then merged, so each (path, hash) group arrives
+    in one piece. Sequence numbers keep every list in the order computeTables would produce.
     """
+    versions = []
+    pathIds = {}  # path -> order of first appearance; the paths end up in pathNodes anyway
+    paths = []
+    buffer = []
+    maxRecords = max(1, memoryLimit // BUILD_RECORD_SIZE)
+    # merging reads one frame of every run at a time, so frames share the memory limit
+    frame = max(1, maxRecords // BUILD_MERGE_FANIN)
+    numfiles = 0
+
+    with tempfile.TemporaryDirectory(prefix="blindelephant-build-", dir=tempDir) as tmp:
+        runs = []
+        for app_dir, version in appdirs:
+            versionIndex = len(versions)
+            versions.append(version)
+            for path, _hash in _hashVersionFiles(basepath, app_dir, directoryExcludeRegex, fileExcludeRegex):
+                pathId = pathIds.get(path)
+                if pathId is None:
+                    pathId = pathIds[path] = len(paths)
+                    paths.append(path)
+                buffer.append((pathId, bytes.fromhex(_hash), numfiles, versionIndex))
+                numfiles += 1
+                if len(buffer) >= maxRecords:
+                    buffer.sort()
+                    runs.append(_writeRun(tmp, len(runs), buffer, frame))
+                    buffer = []
+        buffer.sort()
+        spilled = len(runs)
+        while len(runs) > BUILD_MERGE_FANIN:
+            # too many runs to open at once: merge them in groups first
+            merged = []
+            for i in range(0, len(runs), BUILD_MERGE_FANIN):
+                group = runs[i:i + BUILD_MERGE_FANIN]
+                merged.append(_writeRun(tmp, f"{len(runs)}-{i}", heapq.merge(*[_readRun(r) for r in group]), frame))
+                for r in group:
+                    os.remove(r)
+            runs = merged
+
+        pathNodes = {}
+        # first sequence number of every hash, in pathNodes order, to order versionNodes like computeTables
+        hashSeqs = array.array("q")
+        merged = heapq.merge(*[_readRun(r) for r in runs], buffer)
+        for pathId, records in itertools.groupby(merged, key=lambda r: r[0]):
+            path = paths[pathId]
+            groups = []
+            for digest, hashRecords in itertools.groupby(records, key=lambda r: r[1]):
+                hashRecords = list(hashRecords)
+                groups.append((hashRecords[0][2], digest.hex(), [versions[r[3]] for r in hashRecords]))
+            groups.sort()
+            pathNodes[path] = {_hash: vers for seq, _hash, vers in groups}
+            hashSeqs.extend(seq for seq, _hash, vers in groups)
+    del buffer, pathIds, paths
+
+    versionNodes = {}
+    hashes = [(path, _hash) for path in pathNodes for _hash in pathNodes[path]]
+    for i in sorted(range(len(hashes)), key=hashSeqs.__getitem__):
+        path, _hash = hashes[i]
+        versionNodes.setdefault(verListStr(pathNodes[path][_hash]), []).append(hashes[i])
+
+    if DEBUG:
+        print(f"Processed {len(versions)} versions with {numfiles} files matching filter, "
+              f"resulting in {len(hashes)} unique hashes, {len(pathNodes)} differentiating paths, "
+              f"and {len(versionNodes)} version groups ({spilled} runs spilled to disk).")
+
+    versions.sort()
+    return pathNodes, versionNodes, versions
+
+
+def _writeRun(directory, name, records, frame):
+    """Write sorted records to a run file in directory, in pickled frames; returns its filename"""
+    filename = join(directory, f"run-{name}")
+    records = iter(records)
     with open(filename, "wb") as f:
-        pickle.dump((pathNodes, versionNodes, versions), f, -1)
+        for chunk in iter(lambda: list(itertools.islice(records, frame)), []):
+            pickle.dump(chunk, f, -1)
+    return filename
+
+
+def _readRun(filename):
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                frame = pickle.load(f)
+            except EOFError:
+                return
+            yield from frame
 
 
+def saveTables(filename, pathNodes, versionNodes, versions, metadata=None):
+    """Save the results of computeTables to disk, with an optional metadata
+    dict (eg {"indicatorFiles": computeIndicatorFiles(...)}) as a fourth element.
+    The file is replaced atomically, so readers never see a partial DB.
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump((pathNodes, versionNodes, versions) + ((metadata,) if metadata else ()), f, -1)
+    os.replace(tmp, filename)
+
+
+@Tracing.traced("loadTables", "db", arg="filename")
 def loadTables(filename, printStats=True, useCaching=True):
     """Load a file created with saveTables(...) and return pathNodes, versionNodes and all_versions as a
-    tuple. See computeTables for the structure of each tuple element.
+    tuple. See computeTables for the structure of each tuple element; the tables returned are frozen
+    (read-only and compact, see freezeTables) so they can be shared by threads.
     
-    Attempts to do some caching to reduce in-memory footpring; threads should 
-    not modify structures returned from a request with useCaching turned on 
-    (the default).
+    Attempts to do some caching to reduce in-memory footpring. The cache keeps
+    the most recently used tables within TABLE_CACHE_BUDGET; see
+    setTableCacheBudget() and tableCacheStats().
     """
-    if filename in __loaded_tables and useCaching:
-        pathNodes, versionNodes, versions = __loaded_tables[filename]
-    else:
-        with open(filename, "rb") as f:
-            pathNodes, versionNodes, versions = pickle.load(f)
-        __loaded_tables[filename] = pathNodes, versionNodes, versions
+    pathNodes, versionNodes, versions, metadata = _loadDb(filename, useCaching)
     if printStats:
         print(f"Loaded {filename} with {len(versions)} versions, {len(pathNodes)} differentiating paths, "
               f"and {len(versionNodes)} version groups.")
@@ -187,6 +528,59 @@ def loadTables(filename, printStats=True, useCaching=True):
     return pathNodes, versionNodes, versions
 
 
+def loadMetadata(filename, useCaching=True):
+    """Return the metadata saved with the tables in filename (see saveTables; empty for DBs saved without it) as a
+    read-only mapping. Cached with the tables."""
+    return _loadDb(filename, useCaching)[3]
+
+
+def readTables(filename):
+    """Read filename as saved, without freezing or caching: (pathNodes, versionNodes, versions, metadata)"""
+    with open(filename, "rb") as f:
+        tables = pickle.load(f)
+    # DBs saved before metadata existed hold only the three tables
+    return tables if len(tables) == 4 else tuple(tables) + ({},)
+
+
+def updateMetadata(filename, **metadata):
+    """Add metadata (or replace keys of it) in the DB filename, keeping its tables"""
+    pathNodes, versionNodes, versions, oldMetadata = readTables(filename)
+    saveTables(filename, pathNodes, versionNodes, versions, dict(oldMetadata, **metadata))
+    invalidateTables(filename)
+
+
+def _loadDb(filename, useCaching):
+    cached = __loaded_tables.get(filename) if useCaching else None
+    if cached:
+        return cached
+    pathNodes, versionNodes, versions, metadata = readTables(filename)
+    db = freezeTables(pathNodes, versionNodes, versions) + (
+        MappingProxyType({key: tuple(value) if isinstance(value, list) else value for key, value in metadata.items()}),)
+    __loaded_tables.put(filename, db)
+    return db
+
+
+def invalidateTables(filename=None):
+    """Drop filename (or every file, if None) from the loadTables cache, eg
+    after the DB has been rebuilt on disk.
+    """
+    if filename is None:
+        __loaded_tables.clear()
+    else:
+        __loaded_tables.pop(filename)
+
+
+def setTableCacheBudget(budget):
+    """Set the approximate memory (bytes) the loadTables cache may use,
+    evicting least recently used tables if it is over the new budget."""
+    __loaded_tables.setBudget(budget)
+
+
+def tableCacheStats():
+    """Counters and size estimates (bytes, per file) of the loadTables cache"""
+    return __loaded_tables.stats()
+
+
 def prettyVersionNode(versionNode):
     return "".join(f"\t{str(path)}" + "\n" for path in versionNode)
 
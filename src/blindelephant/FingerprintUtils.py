@@ -1,3 +1,5 @@
+import collections
+import hashlib
 import operator
 import re
 import socket
@@ -6,55 +8,130 @@ import urllib.parse
 import urllib.request
 from distutils.version import LooseVersion
 from functools import reduce
+from html.parser import HTMLParser
 from http.client import HTTPException
 
+try:
+    import Tracing
+except ImportError:
+    # imported as blindelephant.FingerprintUtils (eg by LatestVersionFetcher)
+    from blindelephant import Tracing
+
 # TODO:
 # - Unit tests for everything in this module
 
 # How close a page needs to be to the reference error page in order to be considered a custom error page
 # Range (0,1), with 1 being "exact match" between fingerprinted values
 ERROR_PAGE_SIMILARITY_TOLERANCE = .9
+# Closing tags counted in an error page fingerprint (in lower or upper case)
+ERROR_PAGE_TAGS = ("</div>", "</a>", "</tr>", "</p>")
+# A page with the tag counts of an error page also has to resemble it (so that eg a tagless JS file isn't taken
+# for a tagless error page): be within a factor of ERROR_PAGE_LENGTH_RATIO or ERROR_PAGE_LENGTH_SLACK characters
+# of its length (error pages often echo the requested path)...
+ERROR_PAGE_LENGTH_RATIO = 2
+ERROR_PAGE_LENGTH_SLACK = 256
+# ...or have a simhash within this many bits of its simhash
+SIMHASH_MAX_DISTANCE = 12
+# Characters at the start of a page that go into its simhash
+SIMHASH_TEXT_LIMIT = 1024
 
 TIMEOUT = 5
 socket.setdefaulttimeout(TIMEOUT)
 
 
+# _BITS[i] maps each byte to its bit i (see simhash())
+_BITS = [bytes(b >> i & 1 for b in range(256)) for i in range(8)]
+
+# Matches each counted tag, in lower or upper case; group 1 is the tag name
+_error_page_tags_re = re.compile("</(%s)>" % "|".join(
+    name for tag in ERROR_PAGE_TAGS for name in (tag[2:-1], tag[2:-1].upper())))
+_ERROR_PAGE_TAG_INDEX = {name: i for i, tag in enumerate(ERROR_PAGE_TAGS) for name in (tag[2:-1], tag[2:-1].upper())}
+
+
+def simhash(text):
+    """64 bit simhash of text, with one feature per ">" (roughly one per tag
+    and the text that follows it): near-duplicate pages get hashes differing
+    in few bits. Feature hashes are 8 byte BLAKE2b digests, so simhashes are
+    the same in every process and can be stored."""
+    hashes = b"".join([hashlib.blake2b(feature, digest_size=8).digest()
+                       for feature in text.encode("utf-8", "replace").split(b">")])
+    features = len(hashes) // 8
+    result = 0
+    # bit slicing: take byte k of every feature hash, then bit i of each of those, and count the ones, all in C
+    for k in range(8):
+        column = hashes[k::8]
+        for i in range(8):
+            if 2 * column.translate(_BITS[i]).count(1) > features:
+                result |= 1 << 8 * k + i
+    return result
+
+
+class PageFeatures(object):
+    """What soft-404 detection keeps of a page: counts of ERROR_PAGE_TAGS,
+    length, simhash of its start (lowered) and whether it is a parking page.
+    See fingerprint_error_page()."""
+    __slots__ = ("tags", "length", "simhash", "parked")
+
+    def __init__(self, tags, length, simhash, parked):
+        self.tags = tags
+        self.length = length
+        self.simhash = simhash
+        self.parked = parked
+
+    def resembles(self, other):
+        """True if other is about as long as this page or starts with nearly the same text"""
+        shorter, longer = sorted((self.length, other.length))
+        return longer - shorter <= ERROR_PAGE_LENGTH_SLACK or longer <= shorter * ERROR_PAGE_LENGTH_RATIO or \
+            (self.simhash ^ other.simhash).bit_count() <= SIMHASH_MAX_DISTANCE
+
+    def __repr__(self):
+        return f"PageFeatures({self.tags}, {self.length}, {self.simhash:#018x}, {self.parked})"
+
+
 def fingerprint_error_page(page_data):
     """Takes page_data as a string and returns an "error page fingerprint".
     (This error page "fingerprint" is different from the hash-based fingerprints
     used in the rest of BlindElephant.)
-     
-    (Implementation detail: It's a list (one entry per page type) containing dicts of tags
-    that we care about and their counts)
+
+    (Implementation detail: It's a PageFeatures, which compare_to_error_page()
+    checks in constant time)
+
+    The page is scanned once for all the tags, and once more for the parking
+    phrases (folding those into the same regex measured two to three times
+    slower); the simhash only reads the first SIMHASH_TEXT_LIMIT characters.
     """
-    error_page_fingerprint = {"</div>": 0, "</a>": 0, "</tr>": 0, "</p>": 0}
     page_data = str(page_data)
-    for tag in error_page_fingerprint:
-        count = page_data.count(tag) + page_data.count(tag.upper())
-        error_page_fingerprint[tag] = count
+    tags = [0] * len(ERROR_PAGE_TAGS)
+    for name, count in collections.Counter(_error_page_tags_re.findall(page_data)).items():
+        tags[_ERROR_PAGE_TAG_INDEX[name]] += count
+    return PageFeatures(tuple(tags), len(page_data), simhash(page_data[:SIMHASH_TEXT_LIMIT].lower()),
+                        is_parked_page(page_data))
 
-    return error_page_fingerprint
 
-
-def identify_error_page(base_url):
+@Tracing.traced("identify_error_page", arg="base_url")
+def identify_error_page(base_url, fetch=None):
     """Fetches pages that should not exist on the host and looks for 
     characteristics that would help us identify custom error pages (HTTP 200 w/ 
     error text instead of 404).
     
     If not identified, custom error pages can be mistaken for 
     present-but-no-match hashes and screw up guessing and fingerprinting.
+
+    fetch is the function used to read urls (default url_read_spoof_ua).
     
-    Returns an "error page fingerprint" that can be passed to compare_to_error_page()
+    Returns an "error page fingerprint" (a list of the PageFeatures of the
+    pages) that can be passed to compare_to_error_page()
     See fingerprint_error_page()
     """
+    fetch = fetch or url_read_spoof_ua
     retry = 2
     while retry:
         try:
             url = f"{base_url}/should/not/exist.html"
-            data = url_read_spoof_ua(url)
+            data = fetch(url)
             error_page_fingerprint = [fingerprint_error_page(data)]
             url = f"{base_url}/should/not/exist.gif"
-            data = url_read_spoof_ua(url)
+            data = fetch(url)
             error_page_fingerprint.append(fingerprint_error_page(data))
             return error_page_fingerprint
         except IOError as e:
@@ -67,6 +144,45 @@ def identify_error_page(base_url):
     return None
 
 
+# Parked domains respond with random stuff; doing manual exceptions for now until a pattern emerges
+PARKING_PHRASES = ["GoDaddy.com is the world's No. 1 ICANN-accredited domain name registrar",
+                   "This site is not currently available."]
+
+
+def _trie_regex(phrases):
+    """Regex matching any of phrases, with their common prefixes factored out
+    (a trie), so searching a page stays one pass however many phrases there are"""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = True
+    return re.compile(_trie_pattern(trie)) if trie else None
+
+
+def _trie_pattern(node):
+    if "" in node:
+        return ""  # a phrase ends here; longer ones starting with it add nothing to a search
+    alternatives = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items())]
+    return alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+
+
+_parking_re = _trie_regex(PARKING_PHRASES)
+
+
+def add_parking_phrases(phrases):
+    """Also treat pages containing any of phrases as parking pages"""
+    global _parking_re
+    PARKING_PHRASES.extend(phrases)
+    _parking_re = _trie_regex(PARKING_PHRASES)
+
+
+def is_parked_page(page_data):
+    """Return True if page_data looks like a domain parking page"""
+    return _parking_re is not None and _parking_re.search(page_data) is not None
+
+
 def compare_to_error_page(error_page_fingerprint, page_data):
     """Check a page returned from a server against an error_page_fingerprint and 
     return True if the page is probably a custom error page, or False if not. 
@@ -77,28 +193,91 @@ def compare_to_error_page(error_page_fingerprint, page_data):
     if not error_page_fingerprint:
         # print "Returning false because of no error page fingerprint"
         return False
+    return compare_fingerprint_to_error_page(error_page_fingerprint, fingerprint_error_page(page_data))
+
 
-    candidate_fingerprint = fingerprint_error_page(page_data)
-    # print "Error page fingerprint:", error_page_fingerprint
-    # print "Candidate fingerprint:", candidate_fingerprint
-    # Parked domains respond with random stuff; doing manual exceptions for now until a pattern emerges
-    parking_phrases = ["GoDaddy.com is the world's No. 1 ICANN-accredited domain name registrar",
-                       "This site is not currently available."]
-    for phrase in parking_phrases:
-        if phrase in page_data:
-            # print "Identified custom 404 because of phrase:", phrase
-            return True
+def compare_fingerprint_to_error_page(error_page_fingerprint, candidate_fingerprint):
+    """Like compare_to_error_page(), for a page already reduced to its
+    fingerprint (see fingerprint_error_page()).
 
+    As before PageFeatures, the candidate must have about the same tag
+    counts as every error page (or be a parking page). It must now also
+    resemble one of them in length or text (see PageFeatures.resembles): with
+    tag counts alone, a host whose error page has none of the tags had every
+    tagless file (most JS, CSS and text files) taken for its error page.
+    """
+    if not error_page_fingerprint:
+        return False
+    if candidate_fingerprint.parked:
+        # print "Identified custom 404 because of parking phrase"
+        return True
+
+    resembles = False
     for page_type in error_page_fingerprint:
-        for tag in page_type:
-            tag_count_diff = abs(page_type[tag] - candidate_fingerprint[tag])
-            bigger_count = max(page_type[tag], candidate_fingerprint[tag])
+        for count, candidate_count in zip(page_type.tags, candidate_fingerprint.tags):
+            tag_count_diff = abs(count - candidate_count)
+            bigger_count = max(count, candidate_count)
             tolerance = (bigger_count - (bigger_count * ERROR_PAGE_SIMILARITY_TOLERANCE))
-            # print "Tag: %s\tErrPg: %d\tCandidate: %d" % (tag, error_page_fingerprint[tag], candidate_fingerprint[tag])
             # if a single value exceeds tolerance, we're done
             if tag_count_diff > tolerance:
                 return False
-    return True
+        resembles = resembles or page_type.resembles(candidate_fingerprint)
+    return resembles
+
+
+# Tag -> attributes of it that link static assets
+ASSET_ATTRIBUTES = {"script": ("src",), "link": ("href",), "img": ("src",), "input": ("src",),
+                    "source": ("src",), "embed": ("src",), "object": ("data",)}
+
+
+class _AssetLinkParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        names = ASSET_ATTRIBUTES.get(tag)
+        if names:
+            self.links.extend(value for name, value in attrs if name in names and value)
+
+    handle_startendtag = handle_starttag
+
+
+def linked_assets(page_data, page_url):
+    """Absolute urls (without query or fragment) of the static assets a page
+    links to (see ASSET_ATTRIBUTES), in page order and without repeats.
+    page_url is where the page was fetched from, to resolve relative links.
+    """
+    parser = _AssetLinkParser()
+    try:
+        parser.feed(page_data)
+        parser.close()
+    except AssertionError:
+        pass  # html.parser gives up on some malformed markup; keep what it found
+    urls = []
+    for link in parser.links:
+        parts = urllib.parse.urlsplit(urllib.parse.urljoin(page_url, link.strip()))
+        if parts.scheme in ("http", "https"):
+            url = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def paths_under(urls, base_url):
+    """Paths (starting with "/") of the urls that are under base_url, relative
+    to it, in the same form as DB paths. Scheme and host case are ignored."""
+    base = urllib.parse.urlsplit(base_url)
+    base_path = base.path.rstrip("/")
+    paths = []
+    for url in urls:
+        parts = urllib.parse.urlsplit(url)
+        if parts.netloc.lower() == base.netloc.lower() and parts.path.startswith(base_path + "/"):
+            path = urllib.parse.unquote(parts.path[len(base_path):])
+            if path not in paths:
+                paths.append(path)
+    return paths
 
 
 def collapse_version_possibilities(possible_vers):
@@ -182,8 +361,8 @@ def pick_fingerprint_files(path_nodes, all_versions):
         curr_vers = []
         curr_hashes = len(path_nodes[path])
 
-        for path_hash in path_nodes[path]:
-            curr_vers.extend(path_nodes[path][path_hash])
+        for vers in path_nodes[path].values():
+            curr_vers.extend(vers)
 
         fitness = (float(len(curr_vers)) / float(len(all_versions))) + curr_hashes
         candidate_nodes.append({"fitness": fitness, "path": path})
@@ -192,6 +371,35 @@ def pick_fingerprint_files(path_nodes, all_versions):
     return [f["path"] for f in candidate_nodes]
 
 
+def plan_joint_probes(ranked_paths, num_probes, window=2):
+    """Plan the probes for several apps installed at the same url. 
+    ranked_paths maps each app to its paths ordered by usefulness (see
+    pick_fingerprint_files()); each app is given num_probes paths from the
+    num_probes * window best of them, preferring paths that other apps want
+    too (bundled libraries, shared files), so that one request serves several
+    apps.
+
+    Returns (plan, app_plans): the deduplicated list of paths to fetch, in
+    priority order, and a dict mapping each app to its share of the plan.
+    """
+    horizon = num_probes * window
+    candidates = {app: set(paths[:horizon]) for app, paths in ranked_paths.items()}
+    scores = {}
+    for app, paths in ranked_paths.items():
+        for rank, path in enumerate(paths[:horizon]):
+            scores[path] = scores.get(path, 0) + horizon - rank
+
+    plan = []
+    app_plans = {app: [] for app in ranked_paths}
+    for path in sorted(scores, key=lambda p: (-scores[p], p)):
+        wanting = [app for app in ranked_paths if path in candidates[app] and len(app_plans[app]) < num_probes]
+        if wanting:
+            plan.append(path)
+            for app in wanting:
+                app_plans[app].append(path)
+    return plan, app_plans
+
+
 def pick_indicator_files(version_nodes, all_versions):
     """Choose a small number of files that (should) reliably indicate
     whether an app or plugin exists. Returns an ordered list of paths."""
@@ -220,16 +428,28 @@ def pick_indicator_files(version_nodes, all_versions):
     return list(set(indicator_files))
 
 
+SPOOFED_HEADERS = {"User-agent": "Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.2.3) "
+                                 "Gecko/20100423 Ubuntu/10.04 (lucid) Firefox/3.6.3"}
+
+
 def url_read_spoof_ua(url):
     """I really hate to do this, but various spam, advertising and domain parking sites
     won't give either a 404 or a consistent landing page without pretending like we're a browser.
     """
-    headers = {"User-agent": "Mozilla/5.0 (X11; U; Linux i686; en-US; rv:1.9.2.3) "
-                             "Gecko/20100423 Ubuntu/10.04 (lucid) Firefox/3.6.3"}
-    req = urllib.request.Request(url, headers=headers)
+    req = urllib.request.Request(url, headers=SPOOFED_HEADERS)
     return urllib.request.urlopen(req, timeout=TIMEOUT).read().decode()
 
 
+def url_head_spoof_ua(url):
+    """Like url_read_spoof_ua, but with a HEAD request: returns (status,
+    Content-Length or None) without downloading the body. Error statuses
+    raise HTTPError as with GET."""
+    req = urllib.request.Request(url, headers=SPOOFED_HEADERS, method="HEAD")
+    with urllib.request.urlopen(req, timeout=TIMEOUT) as response:
+        length = response.headers.get("Content-Length", "")
+        return response.status, int(length) if length.isdigit() else None
+
+
 def pick_winnow_files(possible_ver_list, version_nodes, max_paths):
     """Given a condensed ver list (and version nodes), return paths (up to max_paths) 
     that may be able to rule out of some versions.
@@ -1,8 +1,8 @@
 """Fingerprinter and Guesser objects for WebApps and their plugins"""
-import hashlib
 import http.server
-import itertools
 import os
+import threading
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
@@ -10,64 +10,246 @@ from http.client import HTTPException
 
 import DifferencesTables
 import Configuration
-import FileMassagers
 import FingerprintUtils
+import ProbeEngine
+import ResponseMemo
+import Tracing
 from Loggers import FileLogger
 
 # Number of consecutive low-level communication failures to tolerate before giving up
 HOST_DOWN_THRESHOLD = 2
 
+# Plugins checked at once by PluginGuesser in head mode when it isn't given a ProbeEngine
+HEAD_FANOUT_WINDOW = 8
+# A HEAD response is taken for the soft-404 page if its length is within this many bytes of the soft-404 page's
+# (plus twice the difference in url lengths, for pages that echo the url)
+SOFT_404_LENGTH_SLACK = 32
+# Statuses of a HEAD request meaning the file is missing; any other error (405 or 501 for no HEAD support, a
+# firewall's 403...) says nothing about a GET for the same file, which is made instead
+HEAD_MISSING_CODES = (404, 410)
+# Known paths linked from a site's landing page that are probed ahead of the others (per app)
+HARVEST_MAX_PROBES = 5
+
 
 # TODO:
 # - implement winnowing
 # - stop early on consistent and accurate results + make this configurable
 
 
+def _load_tables(logger, filename):
+    start = time.perf_counter()
+    tables = DifferencesTables.loadTables(filename, printStats=False)
+    logger.logTiming("db_load_seconds", time.perf_counter() - start)
+    return tables
+
+
+def _identify_error_page(logger, url, fetch, memo=None):
+    if memo is not None:
+        return memo.error_page(url, lambda base_url: _identify_error_page(logger, base_url, fetch))
+    start = time.perf_counter()
+    error_page_fingerprint = FingerprintUtils.identify_error_page(url, fetch)
+    logger.logTiming("error_page_detection_seconds", time.perf_counter() - start)
+    return error_page_fingerprint
+
+
+def _harvest_assets(logger, site_url, fetch, memo=None):
+    """Urls of the assets linked from the landing page of site_url (see
+    FingerprintUtils.linked_assets); with a memo the page is fetched once per
+    site. [] if the page can't be fetched or decoded."""
+    if memo is not None:
+        return memo.linked_assets(site_url, lambda url: _harvest_assets(logger, url, fetch))
+    page_url = site_url + "/"
+    try:
+        urls = FingerprintUtils.linked_assets(fetch(page_url), page_url)
+    except (IOError, HTTPException, ValueError):
+        return []
+    logger.logCount("harvested_assets", len(urls))
+    return urls
+
+
+@Tracing.traced("http_request", "http", arg="url")
+def _fetch(logger, engine, transport, url):
+    """Fetch url (see ProbeEngine.fetch_url), reporting latency, errors and
+    size (decoded length) of the response to logger."""
+    start = time.perf_counter()
+    try:
+        data = ProbeEngine.fetch_url(engine, url, transport)
+    except Exception:
+        logger.logCount("probe_errors")
+        raise
+    finally:
+        logger.logTiming("probe_latency_seconds", time.perf_counter() - start)
+    logger.logCount("bytes_fetched", len(data))
+    return data
+
+
+def _head(logger, engine, url, memo=None):
+    """HEAD url (see FingerprintUtils.url_head_spoof_ua) through engine if
+    there is one, reporting latency and errors to logger. Returns (status,
+    Content-Length or None). The memo's NegativeCache, if any, is consulted
+    and updated like for GETs, but only with missing files (see
+    HEAD_MISSING_CODES)."""
+    negative_cache = memo.negative_cache if memo is not None else None
+    if negative_cache:
+        error = negative_cache.error(url)
+        if error:
+            raise error
+    start = time.perf_counter()
+    logger.logCount("head_probes")
+    try:
+        response = ProbeEngine.fetch_url(engine, url, FingerprintUtils.url_head_spoof_ua)
+    except urllib.error.HTTPError as e:
+        logger.logCount("probe_errors")
+        if negative_cache and e.code in HEAD_MISSING_CODES:
+            negative_cache.record_error(url, e.code)
+        raise
+    except Exception:
+        logger.logCount("probe_errors")
+        raise
+    finally:
+        logger.logTiming("probe_latency_seconds", time.perf_counter() - start)
+    if negative_cache and response[0] == 200:
+        negative_cache.record_found(url)
+    return response
+
+
+def _is_unreachable(e):
+    """True for errors meaning the server couldn't be reached at all, as
+    opposed to an HTTP error response (eg 404), which says nothing about
+    whether the host is down."""
+    return hasattr(e, 'reason') and not hasattr(e, 'code')
+
+
+class _FailureCount(object):
+    """Consecutive failures to reach a host, counted from the probes of a
+    fingerprinter or guesser, which may run on ProbeEngine worker threads"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+    def host_is_down(self):
+        return self.count >= HOST_DOWN_THRESHOLD
+
+
+def _file_url(base_url, path):
+    return base_url + (path if path.startswith("/") else f"/{path}")
+
+
+def _log_skipped(logger, skipped):
+    if skipped:
+        logger.logCount("probes_skipped", len(skipped))
+        logger.logCount("host_down_aborts")
+
+
 class WebAppFingerprinter(object):
     """Class that encapsulates the data and functions needed to use a 
     BlindElephant fingerprint db to attempt to get the version of a web
     app.
     """
 
-    def __init__(self, url, app_name, num_probes=15, logger=FileLogger(), winnow=False):
+    def __init__(self, url, app_name, num_probes=15, logger=FileLogger(), winnow=False, engine=None,
+                 transport=None, memo=None, versions=None):
         """Expects the url where a (supported) webapp is installed, the name of
         the web app, an optional number of files to check while guessing the
         version, and an optional logger object supporting the operations in 
         BlindElephantLogger (default is a FileLogger tied to sys.stdout)
+
+        If a ProbeEngine is given, probes are run concurrently within the
+        engine's adaptive per-host window instead of one at a time. transport
+        replaces FingerprintUtils.url_read_spoof_ua for fetching (see Transports).
+        memo is the target's ResponseMemo when other phases of a scan have
+        probed (or will probe) the same site. versions are the app's possible
+        versions if an earlier phase already narrowed them (eg
+        WebAppGuesser.identify_apps); fingerprinting narrows them further.
         """
         self.best_guess = None
         self.error_page_fingerprint = None
         self.ver_list = None
+        self.path_nodes = None
         self.url = url
+        # where the landing page whose asset links are probed first is
+        self.site_url = url
         self.app_name = app_name
         self.num_probes = num_probes
         self.logger = logger
         self.winnow = winnow
-        self._host_down_errors = 0
+        self.engine = engine
+        self.transport = transport
+        self.memo = memo
+        self.known_versions = versions
+        self._host_down_errors = _FailureCount()
         self._error_page_fingerprint = None
 
     def _load_db(self):
         self.path_nodes, self.version_nodes, self.all_versions = \
-            DifferencesTables.loadTables(Configuration.getDbPath(self.app_name), printStats=False)
+            _load_tables(self.logger, Configuration.getDbPath(self.app_name))
         self.logger.logLoadDB(Configuration.getDbPath(self.app_name), self.all_versions,
                               self.path_nodes, self.version_nodes)
 
-    def fingerprint(self):
-        """Select num_probes most useful paths, and fetch them
-        from the site at url. Return an ordered list of possible versions or 
-        [].
+    def ranked_paths(self):
+        """All known paths of the app, most useful first (see
+        FingerprintUtils.pick_fingerprint_files)"""
+        if self.path_nodes is None:
+            self._load_db()
+        return FingerprintUtils.pick_fingerprint_files(self.path_nodes, self.all_versions)
+
+    def linked_paths(self):
+        """Known paths of the app (up to HARVEST_MAX_PROBES) that the landing
+        page of the site links to and that differ between versions. Those
+        files are surely there, unlike paths picked from the DB alone (a file
+        with one hash in every version would only confirm the app)."""
+        if self.path_nodes is None:
+            self._load_db()
+        urls = _harvest_assets(self.logger, self.site_url, self._fetch, self.memo)
+        return [path for path in FingerprintUtils.paths_under(urls, self.url)
+                if len(self.path_nodes.get(path, ())) > 1][:HARVEST_MAX_PROBES]
+
+    def probe_paths(self, ranked=None):
+        """The paths linked from the site's landing page (see linked_paths),
+        then the first num_probes of ranked (default: ranked_paths())"""
+        # linked files come on top of the budget: on sites stripped of the usual files they replace probes
+        # that would miss, but taking the budget's place they'd push out the best probes where those exist
+        linked = self.linked_paths()
+        self.logger.logCount("linked_probes", len(linked))
+        ranked = self.ranked_paths() if ranked is None else ranked
+        return linked + [path for path in ranked[:self.num_probes] if path not in linked]
+
+    @Tracing.traced("fingerprint")
+    def fingerprint(self, paths=None):
+        """Select paths with probe_paths (or use paths, eg this app's share
+        of a plan made with FingerprintUtils.plan_joint_probes), and fetch
+        them from the site at url. Return an ordered list of possible
+        versions or [].
         """
-        self._load_db()
-        paths = FingerprintUtils.pick_fingerprint_files(self.path_nodes, self.all_versions)
+        if paths is None:
+            paths = self.probe_paths()
+        elif self.path_nodes is None:
+            self._load_db()
         self.logger.logStartFingerprint(self.url, self.app_name)
-        self.error_page_fingerprint = FingerprintUtils.identify_error_page(self.url)
-
-        possible_vers = []
-        for path in paths[:self.num_probes]:
-            if curr_vers := self.fingerprint_file(path):
-                possible_vers.append(curr_vers)
-            if self._host_down_errors >= HOST_DOWN_THRESHOLD:
-                break
+        self.error_page_fingerprint = _identify_error_page(self.logger, self.url, self._fetch, self.memo)
+
+        # Files already fetched during this scan (eg indicator files while guessing, or paths planned for
+        # other apps at this url) are free evidence
+        memoized = self._memoized_paths()
+        results = [self.fingerprint_file(path) for path in memoized]
+        paths = [path for path in paths if path not in memoized]
+
+        skipped = []
+        results += ProbeEngine.map_probes(self.engine, self.fingerprint_file, paths, stop=self._host_is_down,
+                                          on_skip=skipped.append)
+        _log_skipped(self.logger, skipped)
+        possible_vers = [curr_vers for curr_vers in results if curr_vers]
+        if self.known_versions:
+            possible_vers.append(list(self.known_versions))
 
         ver_set = FingerprintUtils.collapse_version_possibilities(possible_vers)
         self.ver_list = list(ver_set)
@@ -86,58 +268,81 @@ class WebAppFingerprinter(object):
             self.best_guess = FingerprintUtils.pick_likely_version(self.ver_list)
         elif len(self.ver_list) == 1:
             self.best_guess = self.ver_list[0]
-        self.logger.logFinishFingerprint(self.ver_list, self.best_guess)
+        self.logger.logFinishFingerprint(self.ver_list, self.best_guess, self.url)
         return self.ver_list
 
+    @Tracing.traced("fingerprint_file", arg="path")
     def fingerprint_file(self, path):
         """Fingerprint a single file given the path, and return a list
         possible versions implied by the result, or None if no information
         could be gleaned.
         """
         try:
-            url = self.url + (path if path.startswith("/") else f"/{path}")
-            data = FingerprintUtils.url_read_spoof_ua(url)
-            self._host_down_errors = 0
-            digest_hash = hashlib.md5(f"{data}{path}".encode('utf-8')).hexdigest()
-            if digest_hash in self.path_nodes:
-                possible_vers = self.path_nodes[path][digest_hash]
-                self.logger.logFileHit(path, possible_vers, None, None, False)
+            entry = self._fetch_entry(_file_url(self.url, path))
+            self._host_down_errors.reset()
+            possible_vers, massaged = entry.match(path, self.path_nodes)
+            if possible_vers:
+                self.logger.logCount("massager_hits" if massaged else "hashes_matched")
+                self.logger.logFileHit(path, possible_vers, "" if massaged else None, None, False, self.url)
                 return possible_vers
-            else:
-                ms = FileMassagers.MASSAGERS
-                for i in range(1, len(ms) + 1):
-                    for massagersTpl in itertools.combinations(ms, i):
-                        massagedData = data
-                        for m in massagersTpl:
-                            massagedData = m(massagedData)
-                        massaged_hash = hashlib.md5(f'{massagedData}{path}'.encode('utf-8')).hexdigest()
-                        if massaged_hash in self.path_nodes[path]:
-                            possible_vers = self.path_nodes[path][massaged_hash]
-                            self.logger.logFileHit(path, possible_vers, "", None, False)
-                            return possible_vers
-                if FingerprintUtils.compare_to_error_page(self.error_page_fingerprint, data):
-                    self.logger.logFileHit(path, None, None, 'Detected Custom 404', True)
-                    return None
-                if not hasattr(self.path_nodes[path], digest_hash):
-                    raise KeyError
+            if entry.is_error_page(self.error_page_fingerprint):
+                self.logger.logFileHit(path, None, None, 'Detected Custom 404', True, self.url)
+                return None
+            raise KeyError(path)
         except IOError as e:
-            if hasattr(e, 'reason'):
-                self.logger.logFileHit(path, None, None, f"Failed to reach a server: {e.reason}", True)
+            if _is_unreachable(e):
+                self.logger.logFileHit(path, None, None, f"Failed to reach a server: {e.reason}", True, self.url)
 
-                self._host_down_errors += 1
+                self._host_down_errors.add()
             elif hasattr(e, 'code'):
                 self.logger.logFileHit(path, None, None,
                                        f'Error code: {e.code} '
-                                       f'({http.server.BaseHTTPRequestHandler.responses[e.code][0]})', True)
+                                       f'({http.server.BaseHTTPRequestHandler.responses[e.code][0]})', True,
+                                       self.url)
 
         except HTTPException as e2:
-            self.logger.logFileHit(path, None, None, f'Error: {e2} ', True)
+            self.logger.logFileHit(path, None, None, f'Error: {e2} ', True, self.url)
         except KeyError as e2:
             self.logger.logFileHit(path, None, None,
-                                   "Retrieved file doesn't match known fingerprint. %s" % e2.args, True)
+                                   "Retrieved file doesn't match known fingerprint. %s" % e2.args, True, self.url)
 
         return None
 
+    def _fetch(self, url):
+        return _fetch(self.logger, self.engine, self.transport, url)
+
+    def _fetch_entry(self, url):
+        return ResponseMemo.fetch_entry(self.memo, self._fetch, url)
+
+    def prefetch(self, paths):
+        """Fetch paths into the memo without scoring them, so that every
+        fingerprinter sharing the memo can use the responses."""
+        def prefetch_file(path):
+            try:
+                self._fetch_entry(_file_url(self.url, path))
+                self._host_down_errors.reset()
+            except (IOError, HTTPException) as e:
+                if _is_unreachable(e):
+                    self._host_down_errors.add()
+
+        skipped = []
+        ProbeEngine.map_probes(self.engine, prefetch_file, paths, stop=self._host_is_down, on_skip=skipped.append)
+        _log_skipped(self.logger, skipped)
+
+    def _memoized_paths(self):
+        """Known paths whose responses are already in the memo"""
+        if self.memo is None:
+            return []
+        paths = set()
+        for url, entry in self.memo.items():
+            if entry.ok and url.startswith(self.url):
+                path = url[len(self.url):]
+                paths.update(p for p in (path, path[1:]) if p in self.path_nodes)
+        return sorted(paths)
+
+    def _host_is_down(self):
+        return self._host_down_errors.host_is_down()
+
     def winnow_versions(self, possible_vers):
         winnow_attempts = 0
         while len(self.ver_list) > 1 and winnow_attempts < self.num_probes:
@@ -155,7 +360,7 @@ class WebAppFingerprinter(object):
                         self.ver_list = list(tmp_ver_set)
                         print("winnow eliminated a version... picking again")
                         continue
-                if self._host_down_errors >= HOST_DOWN_THRESHOLD:
+                if self._host_down_errors.host_is_down():
                     break
                 if winnow_attempts > self.num_probes:
                     break
@@ -168,7 +373,8 @@ class PluginFingerprinter(WebAppFingerprinter):
     """
 
     # TODO: Revisit logging to differentiate plugin fingerprint output from app fingerprint output
-    def __init__(self, url, app_name, plugin_name, num_probes=15, logger=FileLogger(), winnow=False):
+    def __init__(self, url, app_name, plugin_name, num_probes=15, logger=FileLogger(), winnow=False, engine=None,
+                 transport=None, memo=None):
         """Same params as WebAppFingerprinter plus the name of plugin to 
         fingerprint. 
         """
@@ -180,125 +386,199 @@ class PluginFingerprinter(WebAppFingerprinter):
                                                   Configuration.APP_CONFIG[app_name]["pluginsRoot"] + plugin_name,
                                                   app_name, num_probes=num_probes)
         # super doesn't take keyword args; this is getting more and more annoying
+        self.site_url = url
         self.num_probes = num_probes
         self.logger = logger
         self.winnow = winnow
+        self.engine = engine
+        self.transport = transport
+        self.memo = memo
 
     def _load_db(self):
         # version_nodes is temporarily unused
         self.path_nodes, self.version_nodes, self.all_versions = \
-            DifferencesTables.loadTables(Configuration.getDbPath(self.app_name, self.plugin_name), printStats=False)
+            _load_tables(self.logger, Configuration.getDbPath(self.app_name, self.plugin_name))
 
 
 class WebAppGuesser(object):
 
-    def __init__(self, url, logger=FileLogger(Configuration.DEFAULT_LOGFILE)):
+    def __init__(self, url, logger=FileLogger(Configuration.DEFAULT_LOGFILE), engine=None, transport=None,
+                 memo=None):
         self.url = url
         self.logger = logger
+        self.engine = engine
+        self.transport = transport
+        self.memo = memo
         self.error_page_fingerprint = None
         self.already_checked_for_error_page = False
-        self._host_down_errors = 0
+        self._host_down_errors = _FailureCount()
+        # app -> paths linked from the landing page that only that app has (see _linked_paths)
+        self._linked = {}
 
     def guess_apps(self, app_list=None):
         """Probe a small number of indicator files for each supported webapp to 
-        quickly check for existence, but not version.
+        quickly check for existence, but not version. Files linked from the
+        landing page that belong to a single app are tried first.
         """
-        possible_apps = []
         if not self.error_page_fingerprint and not self.already_checked_for_error_page:
-            self.error_page_fingerprint = FingerprintUtils.identify_error_page(self.url)
+            self.error_page_fingerprint = _identify_error_page(self.logger, self.url, self._fetch, self.memo)
             self.already_checked_for_error_page = True
 
         if not app_list:
             app_list = list(Configuration.APP_CONFIG.keys())
+        self._linked = self._linked_paths(app_list)
+
+        skipped = []
+        results = ProbeEngine.map_probes(self.engine, self.guess_app, app_list, stop=self._host_is_down,
+                                         on_skip=skipped.append)
+        _log_skipped(self.logger, skipped)
+        return [app for app, found in zip(app_list, results) if found]
+
+    @Tracing.traced("identify_apps")
+    def identify_apps(self, index, app_list=None):
+        """Identify the apps present and narrow their versions in a single
+        pass over the high-yield paths picked by index (a GlobalIndex), instead
+        of checking each app's indicator files. Returns {app: versions}.
+        """
+        linked = [path for path in self._harvested_paths() if path in index.path_apps and
+                  (not app_list or any(app in app_list for app in index.path_apps[path]))][:HARVEST_MAX_PROBES]
+        paths = linked + [path for path in index.pick_probe_paths(app_list) if path not in linked]
+        skipped = []
+        entries = ProbeEngine.map_probes(self.engine, self._probe, paths, stop=self._host_is_down,
+                                         on_skip=skipped.append)
+        _log_skipped(self.logger, skipped)
+        return index.identify((path, entry) for path, entry in zip(paths, entries) if entry)
+
+    def _harvested_paths(self):
+        return FingerprintUtils.paths_under(_harvest_assets(self.logger, self.url, self._fetch, self.memo), self.url)
+
+    def _linked_paths(self, app_list):
+        """{app: paths linked from the landing page that, among app_list, only
+        app's DB knows}. Paths several apps have (eg a bundled library) say
+        nothing about which one is there, so they are left to fingerprinting."""
+        paths = self._harvested_paths()
+        if not paths:
+            return {}
+        owners = {}
+        for app_name in app_list:
+            path_nodes = _load_tables(self.logger, Configuration.getDbPath(app_name))[0]
+            for path in paths:
+                if path in path_nodes:
+                    owners.setdefault(path, []).append(app_name)
+        linked = {}
+        for path in paths:
+            if len(owners.get(path, ())) == 1:
+                linked.setdefault(owners[path][0], []).append(path)
+        return {app_name: app_paths[:HARVEST_MAX_PROBES] for app_name, app_paths in linked.items()}
+
+    def _probe(self, path):
+        try:
+            entry = self._fetch_entry(_file_url(self.url, path))
+            self._host_down_errors.reset()
+            return entry
+        except (IOError, HTTPException) as e:
+            if _is_unreachable(e):
+                self._host_down_errors.add()
+        return None
 
-        for app in app_list:
-            if self.guess_app(app):
-                possible_apps.append(app)
-            if self._host_down_errors >= HOST_DOWN_THRESHOLD:
-                break
-        return possible_apps
-
+    @Tracing.traced("guess_app", arg="app_name")
     def guess_app(self, app_name):
         """Probe a small number of paths to verify the existence (but not the 
         version) of a particular app
         """
         if not self.error_page_fingerprint and not self.already_checked_for_error_page:
             print("WARN: Fetching error page because it was not available")
-            self.error_page_fingerprint = FingerprintUtils.identify_error_page(self.url)
+            self.error_page_fingerprint = _identify_error_page(self.logger, self.url, self._fetch, self.memo)
             self.already_checked_for_error_page = True
-        path_nodes, version_nodes, all_versions = DifferencesTables.loadTables(Configuration.getDbPath(app_name),
-                                                                               printStats=False)
-
-        return any(self.fingerprint_file(file, path_nodes, version_nodes, all_versions) for file
-                   in Configuration.APP_CONFIG[app_name]["indicatorFiles"])
-
+        db = Configuration.getDbPath(app_name)
+        path_nodes, version_nodes, all_versions = _load_tables(self.logger, db)
+        # indicator files picked from the DB's statistics when it was built, if any (see
+        # DifferencesTables.computeIndicatorFiles); the hand-picked ones otherwise
+        indicator_files = (DifferencesTables.loadMetadata(db).get("indicatorFiles")
+                           or Configuration.APP_CONFIG[app_name]["indicatorFiles"])
+        linked = self._linked.get(app_name, [])
+        files = linked + [file for file in indicator_files if file not in linked]
+
+        return any(self.fingerprint_file(file, path_nodes, version_nodes, all_versions) for file in files)
+
+    @Tracing.traced("fingerprint_file", arg="path")
     def fingerprint_file(self, path, path_nodes, version_nodes, all_versions):
         """Fingerprint a single file given the path, and return a list
         possible versions implied by the result, or None if no information
         could be gleaned.
         """
         try:
-            url = self.url + (path if path.startswith("/") else f"/{path}")
-            data = FingerprintUtils.url_read_spoof_ua(url)
-            self._host_down_errors = 0
-            digest_hash = hashlib.md5(f"{data}{path}".encode('utf-8')).hexdigest()
-            if digest_hash in path_nodes:
-                possible_vers = path_nodes[path][digest_hash]
-                self.logger.logFileHit(path, possible_vers, None, None, False)
+            entry = self._fetch_entry(_file_url(self.url, path))
+            self._host_down_errors.reset()
+            possible_vers, massaged = entry.match(path, path_nodes)
+            if possible_vers:
+                self.logger.logCount("massager_hits" if massaged else "hashes_matched")
                 return possible_vers
-            else:
-                ms = FileMassagers.MASSAGERS
-                for i in range(1, len(ms) + 1):
-                    for massagersTpl in itertools.combinations(ms, i):
-                        massagedData = data
-                        for m in massagersTpl:
-                            massagedData = m(massagedData)
-                        massaged_hash = hashlib.md5(f"{massagedData}{path}".encode('utf-8')).hexdigest()
-                        if massaged_hash in path_nodes[path]:
-                            possible_vers = path_nodes[path][massaged_hash]
-                            return possible_vers
-                if FingerprintUtils.compare_to_error_page(self.error_page_fingerprint, data):
-                    return None
-                if not hasattr(path_nodes[path], digest_hash):
-                    raise KeyError
         except (IOError, HTTPException) as e:
-            if hasattr(e, 'reason'):
-                self._host_down_errors += 1
-        except KeyError:
-            pass
+            if _is_unreachable(e):
+                self._host_down_errors.add()
         return None
 
+    def _fetch(self, url):
+        return _fetch(self.logger, self.engine, self.transport, url)
+
+    def _fetch_entry(self, url):
+        return ResponseMemo.fetch_entry(self.memo, self._fetch, url)
+
+    def _host_is_down(self):
+        return self._host_down_errors.host_is_down()
+
 
 class PluginGuesser(object):
     """Class that uses a BlindElephant fingerprint db to discover if a plugin or
     are installed in a web app.
     """
 
-    def __init__(self, url, app_name, logger=FileLogger()):
+    def __init__(self, url, app_name, logger=FileLogger(), engine=None, transport=None, memo=None, head=False):
         """Url should be the base url for the app (finding the plugin 
         directory is handled internally). App_name is required; it
         doesn't make sense to look for plugins if the app is unknown. 
+
+        With head, guess_plugins checks plugins concurrently (through engine,
+        or a private one of HEAD_FANOUT_WINDOW) with HEAD requests, judged by
+        status and length against the site's soft-404 response, and downloads
+        a body only to confirm a plugin that looks present. HEAD requests
+        can't be recorded or replayed, so a transport turns head off.
         """
         self.error_page_fingerprint = None
         self.app_name = app_name
         self.url = url + Configuration.APP_CONFIG[app_name]["pluginsRoot"]
         self.logger = logger
-
+        self.engine = engine
+        self.transport = transport
+        self.memo = memo
+        self.head = head and transport is None
+        # (url, length) of the response to a HEAD for a missing file if it is a soft 404, None for servers that
+        # answer missing files with an error
+        self._soft_404 = None
+
+    @Tracing.traced("guess_plugin", arg="plugin_name")
     def guess_plugin(self, plugin_name):
         """Check for the existence of the named plugin"""
-        path_nodes, version_nodes, all_versions = DifferencesTables.loadTables(
-            Configuration.getDbPath(self.app_name, plugin_name), False)
-        self.error_page_fingerprint = FingerprintUtils.identify_error_page(self.url)
-
-        for file in FingerprintUtils.pick_indicator_files(version_nodes, all_versions):
+        db = Configuration.getDbPath(self.app_name, plugin_name)
+        path_nodes, version_nodes, all_versions = _load_tables(self.logger, db)
+        indicator_files = (DifferencesTables.loadMetadata(db).get("indicatorFiles")
+                           or FingerprintUtils.pick_indicator_files(version_nodes, all_versions))
+        if self.head:
+            return self._guess_plugin_head(plugin_name, indicator_files)
+        self.error_page_fingerprint = _identify_error_page(self.logger, self.url, self._fetch, self.memo)
+        return self._guess_plugin_get(plugin_name, indicator_files)
+
+    def _guess_plugin_get(self, plugin_name, indicator_files):
+        for file in indicator_files:
             try:
                 # TODO: factor out construction of path to plugin files...
                 # not all plugin dirs can be found simple appending
                 url = self.url + plugin_name + file
                 # self.logger.logExtraInfo("    Trying " + url + "...")
-                data = FingerprintUtils.url_read_spoof_ua(url)
+                entry = self._fetch_entry(url)
                 # Check for custom 404
-                return not FingerprintUtils.compare_to_error_page(self.error_page_fingerprint, data)
+                return not entry.is_error_page(self.error_page_fingerprint)
             except urllib.error.URLError as e:
                 # self.logger.logExtraInfo("URLError: %s" % e)
                 pass
@@ -307,6 +587,66 @@ class PluginGuesser(object):
                 pass
         return False
 
+    def _guess_plugin_head(self, plugin_name, indicator_files):
+        """guess_plugin with HEAD requests, downloading a body only to confirm"""
+        for file in indicator_files:
+            url = self.url + plugin_name + file
+            try:
+                status, length = _head(self.logger, self.engine, url, self.memo)
+            except urllib.error.HTTPError as e:
+                if e.code in HEAD_MISSING_CODES:
+                    continue
+                break
+            except (urllib.error.URLError, HTTPException):
+                continue
+            if self._soft_404 is None:
+                # missing files are errors here, so anything else is there
+                return True
+            soft_404_url, soft_404_length = self._soft_404
+            if length is not None and \
+                    abs(length - soft_404_length) <= SOFT_404_LENGTH_SLACK + 2 * abs(len(url) - len(soft_404_url)):
+                return False
+            # looks different from the soft-404 page (or no length to tell): compare bodies
+            self.logger.logCount("head_confirmations")
+            try:
+                entry = self._fetch_entry(url)
+                return not entry.is_error_page(self.error_page_fingerprint)
+            except (urllib.error.URLError, HTTPException):
+                continue
+        else:
+            return False
+        # HEAD refused or failed for this path; check it the usual way
+        self.error_page_fingerprint = _identify_error_page(self.logger, self.url, self._fetch, self.memo)
+        return self._guess_plugin_get(plugin_name, indicator_files)
+
+    def _profile_soft_404(self):
+        """Learn how the server answers a HEAD for a missing file under the
+        plugins root (see _soft_404). Returns False if HEAD can't be used:
+        only a 404 or 410 shows the server answers missing files with an
+        error; a 403 for instance may just be a firewall refusing HEAD."""
+        url = self.url + "should/not/exist.js"
+        try:
+            status, length = _head(self.logger, self.engine, url)
+        except urllib.error.HTTPError as e:
+            if e.code not in HEAD_MISSING_CODES:
+                return False
+            self._soft_404 = None
+            return True
+        except (urllib.error.URLError, HTTPException):
+            return False
+        if length is None:
+            # nothing to tell soft-404 answers from files by; every plugin would need its body fetched
+            return False
+        self._soft_404 = (url, length)
+        self.error_page_fingerprint = _identify_error_page(self.logger, self.url, self._fetch, self.memo)
+        return True
+
+    def _fetch(self, url):
+        return _fetch(self.logger, self.engine, self.transport, url)
+
+    def _fetch_entry(self, url):
+        return ResponseMemo.fetch_entry(self.memo, self._fetch, url)
+
     def guess_plugins(self):
         """For the given app, check for the existence any known plugins, and
         return a list possible plugins. Obviously if the named app doesn't 
@@ -314,10 +654,21 @@ class PluginGuesser(object):
         possible_plugins = []
         plugins_dir = Configuration.getDbDir(self.app_name)
         if os.access(plugins_dir, os.F_OK):
-            for plugin_name in [x for x in sorted(os.listdir(plugins_dir)) if x.endswith(Configuration.DB_EXTENSION)]:
-                plugin_name = plugin_name[:-len(Configuration.DB_EXTENSION)]
-                if self.guess_plugin(plugin_name):
-                    possible_plugins.append(plugin_name)
+            plugin_names = [x[:-len(Configuration.DB_EXTENSION)] for x in sorted(os.listdir(plugins_dir))
+                            if x.endswith(Configuration.DB_EXTENSION)]
+            private_engine = self.head and plugin_names and not self.engine
+            if private_engine:
+                self.engine = ProbeEngine.ProbeEngine(max_window=HEAD_FANOUT_WINDOW)
+            try:
+                if self.head and plugin_names and not self._profile_soft_404():
+                    self.logger.logExtraInfo("HEAD requests don't work here; checking plugins with GET")
+                    self.head = False
+                results = ProbeEngine.map_probes(self.engine, self.guess_plugin, plugin_names)
+            finally:
+                if private_engine:
+                    self.engine.shutdown()
+                    self.engine = None
+            possible_plugins = [name for name, found in zip(plugin_names, results) if found]
         possible_plugins.sort()
         self.logger.logExtraInfo(f"Possible plugins: {possible_plugins}")
         return possible_plugins
@@ -0,0 +1,175 @@
+"""Index over the DBs of all supported apps, for identifying the app and
+narrowing its version in a single pass.
+
+The index maps every known path to the apps that have it, and every
+(path, hash) to the apps and versions it implies. Probing a few high-yield
+paths per app then answers both "which app is this" and "which versions"
+from the same responses, instead of guessing with indicator files and
+fingerprinting separately. Exact hash matches can't come from a custom 404
+page, so no error page detection is needed either.
+
+The index is built from the DBs on first use and kept next to them; it is
+rebuilt when any DB changes.
+"""
+import os
+import pickle
+from optparse import OptionParser
+
+import Configuration
+import DifferencesTables
+import FingerprintUtils
+
+INDEX_FILENAME = "global-index.pickle"
+INDEX_FORMAT = 1
+
+# Paths probed per app in one identification pass
+PROBES_PER_APP = 4
+# Paths considered for probing must exist in at least this fraction of an app's versions
+MIN_PROBE_COVERAGE = .5
+
+
+def default_index_path():
+    return Configuration.DBS_PATH + INDEX_FILENAME
+
+
+class GlobalIndex(object):
+
+    def __init__(self, path_apps, hashes, ranked_paths, sources):
+        """See build(). path_apps maps path -> tuple of apps, hashes maps
+        path -> {hash: [(app, versions)]}, ranked_paths maps app -> its
+        candidate probe paths, best first, and sources maps each DB file
+        used to its mtime.
+        """
+        self.path_apps = path_apps
+        self.hashes = hashes
+        self.ranked_paths = ranked_paths
+        self.sources = sources
+
+    @classmethod
+    def build(cls, app_names=None):
+        """Index the DBs of app_names (default: all configured apps that have a DB)"""
+        path_apps = {}
+        hashes = {}
+        ranked_paths = {}
+        sources = {}
+        for app in sorted(app_names or Configuration.APP_CONFIG):
+            db = Configuration.getDbPath(app)
+            if not os.path.exists(db):
+                continue
+            sources[db] = os.path.getmtime(db)
+            path_nodes, version_nodes, versions = DifferencesTables.loadTables(db, printStats=False)
+            for path, path_hashes in path_nodes.items():
+                path_apps.setdefault(path, []).append(app)
+                index_hashes = hashes.setdefault(path, {})
+                for digest, vers in path_hashes.items():
+                    index_hashes.setdefault(digest, []).append((app, vers))
+            ranked_paths[app] = [path for path in FingerprintUtils.pick_fingerprint_files(path_nodes, versions)
+                                 if _coverage(path_nodes[path]) >= MIN_PROBE_COVERAGE * len(versions)]
+        path_apps = {path: tuple(apps) for path, apps in path_apps.items()}
+        return cls(path_apps, hashes, ranked_paths, sources)
+
+    def is_stale(self):
+        """True if a DB the index was built from has changed or disappeared"""
+        return any(not os.path.exists(db) or os.path.getmtime(db) != mtime for db, mtime in self.sources.items())
+
+    def save(self, filename):
+        tmp = filename + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((INDEX_FORMAT, self.path_apps, self.hashes, self.ranked_paths, self.sources), f, -1)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, "rb") as f:
+            index_format, path_apps, hashes, ranked_paths, sources = pickle.load(f)
+        if index_format != INDEX_FORMAT:
+            raise ValueError(f"Unsupported index format in {filename}: {index_format}")
+        return cls(path_apps, hashes, ranked_paths, sources)
+
+    @property
+    def apps(self):
+        return sorted(self.ranked_paths)
+
+    def pick_probe_paths(self, app_list=None, per_app=PROBES_PER_APP):
+        """Return the paths to probe to identify any of app_list (default: all
+        indexed apps): per_app high-yield paths of each app, preferring paths
+        no other app has. Shared paths are kept only once.
+        """
+        paths = []
+        for app in app_list or self.apps:
+            ranked = self.ranked_paths.get(app, [])
+            ranked = sorted(ranked, key=lambda p: len(self.path_apps[p]) > 1)  # stable: keeps rank order
+            paths.extend(p for p in ranked[:per_app] if p not in paths)
+        return paths
+
+    def lookup(self, path, entry):
+        """Return [(app, versions)] implied by the response entry (a
+        ResponseMemo.MemoEntry) for path, or [] if no indexed DB knows it."""
+        path_hashes = self.hashes.get(path)
+        if path_hashes and entry.ok:
+            for digest, massaged in entry.digests(path):
+                if digest in path_hashes:
+                    return path_hashes[digest]
+        return []
+
+    def identify(self, responses):
+        """Given (path, MemoEntry) responses, return {app: possible versions}
+        for the apps they show to be present. An app counts as present only
+        if some response matches a hash of that app alone, so identical
+        bundled files (a shared editor, say) don't report every app that
+        ships them.
+        """
+        evidence = {}
+        present = set()
+        for path, entry in responses:
+            matches = self.lookup(path, entry)
+            for app, vers in matches:
+                evidence.setdefault(app, []).append(vers)
+            if len({app for app, vers in matches}) == 1:
+                present.add(matches[0][0])
+        return {app: sorted(FingerprintUtils.collapse_version_possibilities(evidence[app]))
+                for app in sorted(present)}
+
+
+def _coverage(path_hashes):
+    return sum(len(vers) for vers in path_hashes.values())
+
+
+def load_index(filename=None, rebuild=False):
+    """Return the index stored in filename (default: default_index_path()),
+    building and storing it first if it is missing, stale or rebuild is set.
+    """
+    filename = filename or default_index_path()
+    index = None
+    if not rebuild and os.path.exists(filename):
+        try:
+            index = GlobalIndex.load(filename)
+        except (ValueError, pickle.UnpicklingError, EOFError):
+            index = None
+    if index is None or index.is_stale():
+        index = GlobalIndex.build()
+        try:
+            index.save(filename)
+        except OSError:
+            pass  # eg read-only install; the index is just rebuilt next time
+    return index
+
+
+if __name__ == '__main__':
+    USAGE = "usage: %prog [options]"
+    EPILOGUE = """Build (or rebuild) the global index of all app DBs used by
+               Scanner.py --index, and print some statistics about it."""
+
+    parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
+    parser.add_option("-f", "--file", help="Index file. Default: %s in the DB directory" % INDEX_FILENAME)
+    parser.add_option("-r", "--rebuild", action="store_true", help="Rebuild even if the index is up to date")
+    parser.add_option("-n", "--per-app", type='int', default=PROBES_PER_APP,
+                      help="Paths probed per app. Default: %default")
+
+    (options, args) = parser.parse_args()
+
+    index = load_index(options.file, options.rebuild)
+    shared = sum(1 for apps in index.path_apps.values() if len(apps) > 1)
+    print(f"{len(index.apps)} apps, {len(index.path_apps)} paths ({shared} in more than one app), "
+          f"{sum(len(h) for h in index.hashes.values())} hashes")
+    print(f"Identification pass: {len(index.pick_probe_paths(per_app=options.per_app))} probes")
@@ -1,4 +1,8 @@
+import json
+import queue
 import sys
+import threading
+import time
 
 
 class FileLogger(object):
@@ -11,8 +15,8 @@ class FileLogger(object):
         print(f"Loaded {filename} with {len(all_versions)} versions, "
               f"{len(path_nodes)} differentiating paths, and {len(version_nodes)} version groups.", file=self.file)
 
-    def logFileHit(self, path, versions, massagers, error, nomatch):
-        print("Hit", self.url + path, file=self.file)
+    def logFileHit(self, path, versions, massagers, error, nomatch, url=None):
+        print("Hit", (url or self.url) + path, file=self.file)
         if nomatch:
             print("File produced no match. Error:", error, "\n", file=self.file)
         else:
@@ -24,7 +28,7 @@ class FileLogger(object):
         self.app_name = app_name
         print("Starting BlindElephant fingerprint for version of", app_name, "at", url, "\n", file=self.file)
 
-    def logFinishFingerprint(self, versions, best_guess):
+    def logFinishFingerprint(self, versions, best_guess, url=None):
         print("", file=self.file)
         if versions:
             print("Fingerprinting resulted in:", file=self.file)
@@ -36,3 +40,269 @@ class FileLogger(object):
 
     def logExtraInfo(self, message):
         print(message, file=self.file)
+
+    def logTiming(self, name, seconds):
+        pass
+
+    def logCount(self, name, amount=1):
+        pass
+
+
+class NullLogger(object):
+    """Logger that discards everything (without formatting or writing anything)"""
+
+    def logLoadDB(self, filename, all_versions, path_nodes, version_nodes):
+        pass
+
+    def logFileHit(self, path, versions, massagers, error, nomatch, url=None):
+        pass
+
+    def logStartFingerprint(self, url, app_name):
+        pass
+
+    def logFinishFingerprint(self, versions, best_guess, url=None):
+        pass
+
+    def logExtraInfo(self, message):
+        pass
+
+    def logTiming(self, name, seconds):
+        pass
+
+    def logCount(self, name, amount=1):
+        pass
+
+
+class StructuredLogger(object):
+    """Logger that records events as small tuples on a queue and leaves the
+    formatting and writing to a background thread, which writes them to file
+    in batches as json lines (fmt="jsonl") or FileLogger-style text
+    (fmt="text"). Scanning threads never block on the output file, and with
+    file=None nothing is recorded at all.
+
+    Events carry the url they are about, so one logger can be shared by
+    concurrent scans. At most max_queued events wait for the writer; past that
+    (or if writing fails) events are dropped, and the number dropped is
+    reported in the log and to stderr.
+
+    Call close() (or use as a context manager) to flush what is queued.
+    """
+
+    def __init__(self, file=sys.stdout, fmt="jsonl", batch_size=512, flush_interval=.5, max_queued=65536):
+        self.file = file
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._queue = queue.Queue(max_queued)
+        self._writer = None
+        if file is not None:
+            self._writer = threading.Thread(target=self._write_events, name="StructuredLogger", daemon=True)
+            self._writer.start()
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def logLoadDB(self, filename, all_versions, path_nodes, version_nodes):
+        if self._writer:
+            self._put((time.time(), "load_db", filename, len(all_versions), len(path_nodes), len(version_nodes)))
+
+    def logFileHit(self, path, versions, massagers, error, nomatch, url=None):
+        if self._writer:
+            self._put((time.time(), "file_hit", url, path, versions, error, nomatch))
+
+    def logStartFingerprint(self, url, app_name):
+        if self._writer:
+            self._put((time.time(), "start_fingerprint", url, app_name))
+
+    def logFinishFingerprint(self, versions, best_guess, url=None):
+        if self._writer:
+            self._put((time.time(), "finish_fingerprint", url, versions, best_guess))
+
+    def logExtraInfo(self, message):
+        if self._writer:
+            self._put((time.time(), "info", message))
+
+    def logTiming(self, name, seconds):
+        pass
+
+    def logCount(self, name, amount=1):
+        pass
+
+    def _write_events(self):
+        formatter = self._format_json if self.fmt == "jsonl" else self._format_text
+        reported = 0
+        while True:
+            try:
+                events = [self._queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(events) < self.batch_size:
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = events[-1] is None
+            events = [e for e in events if e is not None]
+            dropped = self.dropped
+            if dropped > reported:
+                events.append((time.time(), "info", f"{dropped - reported} log events dropped (queue full)"))
+                reported = dropped
+            try:
+                self.file.write("".join(formatter(e) for e in events))
+                self.file.flush()
+            except Exception as e:
+                # keep draining the queue, or every later event would be lost
+                with self._dropped_lock:
+                    self.dropped += len(events)
+                    reported = self.dropped
+                print(f"StructuredLogger: dropped {len(events)} log events: {type(e).__name__}: {e}",
+                      file=sys.stderr)
+            if closing:
+                break
+
+    @staticmethod
+    def _format_json(event):
+        ts, kind = event[0], event[1]
+        if kind == "load_db":
+            record = {"filename": event[2], "versions": event[3], "paths": event[4], "version_groups": event[5]}
+        elif kind == "file_hit":
+            record = {"url": event[2], "path": event[3], "error": event[5], "nomatch": event[6],
+                      "versions": [v.vstring for v in sorted(event[4])] if event[4] else None}
+        elif kind == "start_fingerprint":
+            record = {"url": event[2], "app": event[3]}
+        elif kind == "finish_fingerprint":
+            record = {"url": event[2], "versions": [v.vstring for v in event[3]],
+                      "best_guess": event[4].vstring if event[4] else None}
+        else:
+            record = {"message": str(event[2])}
+        return json.dumps(dict(ts=ts, event=kind, **record)) + "\n"
+
+    @staticmethod
+    def _format_text(event):
+        kind = event[1]
+        if kind == "load_db":
+            return (f"Loaded {event[2]} with {event[3]} versions, {event[4]} differentiating paths, "
+                    f"and {event[5]} version groups.\n")
+        if kind == "file_hit":
+            if event[6]:
+                return f"Hit {event[2]}{event[3]}\nFile produced no match. Error: {event[5]} \n\n"
+            return (f"Hit {event[2]}{event[3]}\nPossible versions based on result: "
+                    f"{', '.join(v.vstring for v in sorted(event[4]))}\n\n")
+        if kind == "start_fingerprint":
+            return f"Starting BlindElephant fingerprint for version of {event[3]} at {event[2]} \n\n"
+        if kind == "finish_fingerprint":
+            if not event[3]:
+                return "\nError: All versions ruled out!\n"
+            return ("\nFingerprinting resulted in:\n" + "".join(v.vstring + "\n" for v in event[3]) +
+                    f"\n\nBest Guess: {event[4].vstring}\n")
+        return f"{event[2]}\n"
+
+    def close(self):
+        """Write out everything queued so far and stop the writer thread"""
+        if self._writer:
+            # blocks until there is room: the writer never stops draining
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MetricsLogger(object):
+    """Logger that collects counters and timing histograms (DB loads, error
+    page detection, probe latency, bytes fetched, hash and massager hits,
+    skipped probes...) reported through logTiming/logCount, and passes all the
+    usual log calls on to another logger (if given). One instance can be
+    shared by every scan in a batch; results are available with to_json() and
+    to_prometheus().
+    """
+
+    # upper bounds (seconds) of the timing histogram buckets
+    BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def logLoadDB(self, filename, all_versions, path_nodes, version_nodes):
+        if self.logger:
+            self.logger.logLoadDB(filename, all_versions, path_nodes, version_nodes)
+
+    def logFileHit(self, path, versions, massagers, error, nomatch, url=None):
+        if self.logger:
+            self.logger.logFileHit(path, versions, massagers, error, nomatch, url)
+
+    def logStartFingerprint(self, url, app_name):
+        if self.logger:
+            self.logger.logStartFingerprint(url, app_name)
+
+    def logFinishFingerprint(self, versions, best_guess, url=None):
+        if self.logger:
+            self.logger.logFinishFingerprint(versions, best_guess, url)
+
+    def logExtraInfo(self, message):
+        if self.logger:
+            self.logger.logExtraInfo(message)
+
+    def logTiming(self, name, seconds):
+        with self._lock:
+            if name not in self.timings:
+                self.timings[name] = {"count": 0, "sum": 0.0, "min": seconds, "max": seconds,
+                                      "buckets": [0] * len(self.BUCKETS)}
+            timing = self.timings[name]
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["min"] = min(timing["min"], seconds)
+            timing["max"] = max(timing["max"], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    timing["buckets"][i] += 1
+                    break
+        if self.logger:
+            self.logger.logTiming(name, seconds)
+
+    def logCount(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        if self.logger:
+            self.logger.logCount(name, amount)
+
+    def to_dict(self):
+        with self._lock:
+            timings = {}
+            for name, timing in self.timings.items():
+                timings[name] = dict(timing, buckets=dict(zip([str(b) for b in self.BUCKETS], timing["buckets"])))
+            return {"counters": dict(self.counters), "timings": timings}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix="blindelephant"):
+        """Metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                lines.append(f"{prefix}_{name}_total {value}")
+            for name, timing in sorted(self.timings.items()):
+                lines.append(f"# TYPE {prefix}_{name} histogram")
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS, timing["buckets"]):
+                    cumulative += count
+                    lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_{name}_bucket{{le="+Inf"}} {timing["count"]}')
+                lines.append(f"{prefix}_{name}_sum {timing['sum']}")
+                lines.append(f"{prefix}_{name}_count {timing['count']}")
+        return "\n".join(lines) + "\n"
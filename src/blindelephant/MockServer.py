@@ -0,0 +1,126 @@
+"""A local web server for exercising BlindElephant offline.
+
+Serves a directory (eg one unpacked version of an app) with configurable
+per-request latency, soft-404 behaviour (missing files answered with a 200
+"not found" page, like many CMSes; directories are answered with their
+index.html), forbidden directories (everything under
+them answered with 403) and a rate of 503 errors, and counts the requests
+and bytes it serves.
+"""
+import os
+import posixpath
+import random
+import threading
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+SOFT_404_PAGE = """<html><head><title>Page not found</title></head><body>
+<div id="header"><a href="/">Home</a> | <a href="/about">About</a></div>
+<div id="content"><p>Sorry, the page you requested could not be found.</p></div>
+<div id="footer"><p>Powered by Nothing in Particular</p></div>
+</body></html>"""
+
+
+class MockServer(object):
+    """Serves root on 127.0.0.1 (port 0 picks a free port) from a background
+    thread. Use start()/stop() or as a context manager; url is the base url.
+    """
+
+    def __init__(self, root, port=0, latency=0.0, soft_404=False, error_rate=0.0, seed=0, forbidden=()):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.soft_404 = soft_404
+        self.forbidden = tuple(forbidden)
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_counters()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._httpd.server_address[1]
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.status_counts = {}
+
+    def counters(self):
+        with self._lock:
+            return {"requests": self.requests, "bytes": self.bytes_sent, "status": dict(self.status_counts)}
+
+    def _count(self, status, length):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += length
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def _should_fail(self):
+        with self._lock:
+            return self.error_rate and self._random.random() < self.error_rate
+
+    def _local_path(self, url_path):
+        path = posixpath.normpath(urllib.parse.unquote(urllib.parse.urlsplit(url_path).path))
+        local = os.path.join(self.root, *[p for p in path.split("/") if p and p not in (".", "..")])
+        if os.path.isdir(local):
+            local = os.path.join(local, "index.html")
+        return local if os.path.isfile(local) else None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self._respond(send_body=True)
+
+        def do_HEAD(self):
+            self._respond(send_body=False)
+
+        def _respond(self, send_body):
+            if server.latency:
+                time.sleep(server.latency)
+            if server._should_fail():
+                status, body = 503, b"Service Unavailable"
+            elif self.path.startswith(server.forbidden) and server.forbidden:
+                status, body = 403, b"Forbidden"
+            else:
+                local = server._local_path(self.path)
+                if local:
+                    with open(local, "rb") as f:
+                        status, body = 200, f.read()
+                elif server.soft_404:
+                    status, body = 200, SOFT_404_PAGE.encode()
+                else:
+                    status, body = 404, b"Not Found"
+            # count before answering, so counters() read right after a request returns include it
+            server._count(status, len(body) if send_body else 0)
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,194 @@
+"""Per-host cache of paths known to be missing, shared by every phase of a
+scan, by every target on the same host and (saved to a file) by later runs.
+
+Two kinds of entries, both expiring after a TTL:
+
+ - missing paths: a url answered with 404, 410, 401 or 403 is answered from
+   the cache (as the same HTTPError) instead of being fetched again
+ - dead directories: once DEAD_PREFIX_THRESHOLD different entries of a
+   directory (eg /wp-content/plugins/a/..., /wp-content/plugins/b/...) are
+   denied with 401/403 and nothing under it was served, everything under the
+   directory is taken to be denied too
+
+A denied file counts for the directory it is in and the one above only, so
+a few guarded directories (/wp-admin/, /.git/...) don't condemn a distant
+ancestor. "/" and the directories of protected urls (the base urls of the
+apps scanned, see protect) are never taken for dead. A 404 never marks a
+directory dead: most plugins of an app are missing, and that says nothing
+about the ones that are installed.
+"""
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+# Seconds entries stay valid
+NEGATIVE_CACHE_TTL = 1800.0
+# Different entries of a directory that must be denied before the directory is taken for dead
+DEAD_PREFIX_THRESHOLD = 3
+# Entries kept per host; the oldest are dropped beyond this
+MAX_PATHS_PER_HOST = 10000
+
+# Statuses remembered for a path
+MISSING_CODES = (404, 410, 401, 403)
+# Statuses that count towards a dead directory
+DENIED_CODES = (401, 403)
+
+CACHE_FORMAT = 1
+
+
+class _Host(object):
+    __slots__ = ("paths", "prefixes", "denied_children", "served", "protected")
+
+    def __init__(self):
+        self.paths = {}  # path -> (expires, code)
+        self.prefixes = {}  # directory -> (expires, code)
+        self.denied_children = {}  # directory -> names of its entries that were denied
+        self.served = set()  # directories something was served from
+        self.protected = {"/"}  # directories never taken for dead
+
+
+class NegativeCache(object):
+    """See module docstring. Thread safe; hits and prefix_hits count the
+    requests it answered (prefix_hits those answered by a dead directory).
+    """
+
+    def __init__(self, ttl=NEGATIVE_CACHE_TTL, clock=time.time):
+        self.ttl = ttl
+        self.hits = 0
+        self.prefix_hits = 0
+        self._clock = clock
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, url):
+        """Return the cached error code for url, or None if it should be fetched"""
+        host, path = _split(url)
+        now = self._clock()
+        with self._lock:
+            entries = self._hosts.get(host)
+            if entries is None:
+                return None
+            code = _valid(entries.paths, path, now)
+            if code is None:
+                for prefix in _prefixes(path):
+                    code = _valid(entries.prefixes, prefix, now)
+                    if code is not None:
+                        self.prefix_hits += 1
+                        break
+            if code is not None:
+                self.hits += 1
+            return code
+
+    def record_error(self, url, code):
+        """Remember that url was answered with code (ignored unless in MISSING_CODES)"""
+        if code not in MISSING_CODES:
+            return
+        host, path = _split(url)
+        expires = self._clock() + self.ttl
+        with self._lock:
+            entries = self._hosts.setdefault(host, _Host())
+            entries.paths.pop(path, None)
+            entries.paths[path] = (expires, code)
+            if len(entries.paths) > MAX_PATHS_PER_HOST:
+                del entries.paths[next(iter(entries.paths))]
+            if code in DENIED_CODES:
+                parts = path.split("/")
+                prefixes = _prefixes(path)
+                for i in range(max(0, len(prefixes) - 2), len(prefixes)):
+                    prefix = prefixes[i]
+                    if prefix in entries.served or prefix in entries.protected:
+                        continue
+                    children = entries.denied_children.setdefault(prefix, set())
+                    children.add(parts[i + 1])
+                    if len(children) >= DEAD_PREFIX_THRESHOLD:
+                        entries.prefixes[prefix] = (expires, code)
+
+    def record_found(self, url):
+        """Note that url was served, so no directory above it is dead"""
+        host, path = _split(url)
+        with self._lock:
+            entries = self._hosts.setdefault(host, _Host())
+            entries.paths.pop(path, None)
+            for prefix in _prefixes(path):
+                entries.served.add(prefix)
+                entries.prefixes.pop(prefix, None)
+                entries.denied_children.pop(prefix, None)
+
+    def protect(self, url):
+        """Never take url's directory (eg the base url of a scanned app) or
+        any directory above it for dead, and forget any that were"""
+        host, path = _split(url)
+        with self._lock:
+            entries = self._hosts.setdefault(host, _Host())
+            for prefix in _prefixes(path.rstrip("/") + "/."):
+                entries.protected.add(prefix)
+                entries.prefixes.pop(prefix, None)
+                entries.denied_children.pop(prefix, None)
+
+    def error(self, url):
+        """HTTPError to raise for url if it is cached as missing, else None"""
+        code = self.lookup(url)
+        if code is None:
+            return None
+        return urllib.error.HTTPError(url, code, "Missing (cached)", {}, None)
+
+    def stats(self):
+        now = self._clock()
+        with self._lock:
+            hosts = list(self._hosts.values())
+            return {"hosts": len(hosts),
+                    "paths": sum(1 for h in hosts for expires, code in h.paths.values() if expires > now),
+                    "dead_prefixes": sum(1 for h in hosts for expires, code in h.prefixes.values() if expires > now),
+                    "hits": self.hits,
+                    "prefix_hits": self.prefix_hits}
+
+    def save(self, filename):
+        """Write the unexpired entries to filename (json)"""
+        now = self._clock()
+        with self._lock:
+            hosts = {host: {"paths": {p: e for p, e in h.paths.items() if e[0] > now},
+                            "prefixes": {p: e for p, e in h.prefixes.items() if e[0] > now}}
+                     for host, h in self._hosts.items()}
+        tmp = filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"format": CACHE_FORMAT, "hosts": hosts}, f)
+        os.replace(tmp, filename)
+
+    def load(self, filename):
+        """Add the unexpired entries saved in filename (see save)"""
+        with open(filename) as f:
+            saved = json.load(f)
+        if saved.get("format") != CACHE_FORMAT:
+            raise ValueError(f"Unsupported negative cache format in {filename}: {saved.get('format')}")
+        now = self._clock()
+        with self._lock:
+            for host, saved_entries in saved["hosts"].items():
+                entries = self._hosts.setdefault(host, _Host())
+                entries.paths.update((p, tuple(e)) for p, e in saved_entries["paths"].items() if e[0] > now)
+                entries.prefixes.update((p, tuple(e)) for p, e in saved_entries["prefixes"].items()
+                                        if e[0] > now and p not in entries.protected)
+        return self
+
+
+def _split(url):
+    parts = urllib.parse.urlsplit(url)
+    return parts.netloc.lower(), parts.path or "/"
+
+
+def _prefixes(path):
+    """Directories containing path, outermost first: /a/b/c.js -> /, /a/, /a/b/"""
+    parts = path.split("/")
+    return ["/".join(parts[:i]) + "/" for i in range(1, len(parts))]
+
+
+def _valid(table, key, now):
+    entry = table.get(key)
+    if entry is None:
+        return None
+    if entry[0] <= now:
+        del table[key]
+        return None
+    return entry[1]
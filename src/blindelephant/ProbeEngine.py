@@ -0,0 +1,239 @@
+"""Adaptive per-host concurrency for BlindElephant probes.
+
+Each target host gets an AIMD (additive increase, multiplicative decrease)
+window: the number of requests allowed in flight against it at once. Every
+successful probe grows the window a little; timeouts, dropped connections,
+429/503 responses and probes that are much slower than the host's best
+observed latency shrink it by half. Beefy servers converge on a large window,
+shared hosting on a small one.
+"""
+import threading
+import time
+import urllib.error
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPException
+
+import FingerprintUtils
+
+# Window bounds (probes in flight per host)
+INITIAL_WINDOW = 2
+MIN_WINDOW = 1
+MAX_WINDOW = 16
+
+# Window grows by ADDITIVE_INCREASE for every window's worth of successful
+# probes, and is multiplied by MULTIPLICATIVE_DECREASE on congestion
+ADDITIVE_INCREASE = 1.0
+MULTIPLICATIVE_DECREASE = .5
+
+# A probe slower than LATENCY_TOLERANCE times the fastest probe seen on the
+# host is treated as a congestion signal. LATENCY_FLOOR (seconds) keeps a
+# handful of very fast local responses from making every later probe "slow".
+LATENCY_TOLERANCE = 4.0
+LATENCY_FLOOR = .05
+
+# HTTP status codes that mean "slow down" rather than "not here"
+CONGESTION_CODES = (429, 503)
+
+# Throughput is reported over this many trailing seconds
+THROUGHPUT_PERIOD = 10.0
+
+# Number of window changes kept per host, so convergence can be inspected
+HISTORY_LENGTH = 100
+
+
+class AIMDWindow(object):
+    """Concurrency window for a single host. acquire() blocks while the
+    host already has a full window of probes in flight.
+    """
+
+    def __init__(self, initial=INITIAL_WINDOW, minimum=MIN_WINDOW, maximum=MAX_WINDOW):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = float(max(minimum, min(initial, maximum)))
+        self.in_flight = 0
+        self.completed = 0
+        self.congestion_events = 0
+        self.min_latency = None
+        self.avg_latency = None
+        self.history = deque(maxlen=HISTORY_LENGTH)
+        self._since_decrease = int(self.window)
+        self._completions = deque()
+        self._started = time.time()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.window):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, congested=False):
+        """Record the outcome of a probe started with acquire()."""
+        with self._cond:
+            now = time.time()
+            self.in_flight -= 1
+            self.completed += 1
+            self._since_decrease += 1
+            self._completions.append(now)
+
+            if not congested:
+                baseline = max(self.min_latency or latency, LATENCY_FLOOR)
+                congested = latency > baseline * LATENCY_TOLERANCE
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+            self.avg_latency = latency if self.avg_latency is None else .8 * self.avg_latency + .2 * latency
+
+            if congested:
+                self._decrease(now)
+            else:
+                self._increase(now)
+            self._cond.notify_all()
+
+    def _increase(self, now):
+        if self.window < self.maximum:
+            self.window = min(self.maximum, self.window + ADDITIVE_INCREASE / self.window)
+            self.history.append((now, self.window))
+
+    def _decrease(self, now):
+        self.congestion_events += 1
+        # Probes already in flight when the window was cut will report the same
+        # congestion; only back off once per window's worth of completions.
+        if self._since_decrease < int(self.window):
+            return
+        self._since_decrease = 0
+        self.window = max(self.minimum, self.window * MULTIPLICATIVE_DECREASE)
+        self.history.append((now, self.window))
+
+    def throughput(self):
+        """Completed probes per second over the last THROUGHPUT_PERIOD seconds."""
+        with self._cond:
+            now = time.time()
+            while self._completions and self._completions[0] < now - THROUGHPUT_PERIOD:
+                self._completions.popleft()
+            period = min(THROUGHPUT_PERIOD, now - self._started)
+            return len(self._completions) / period if period > 0 else 0.0
+
+    def stats(self):
+        return {"window": self.window,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "congestion_events": self.congestion_events,
+                "throughput": self.throughput(),
+                "min_latency": self.min_latency,
+                "avg_latency": self.avg_latency,
+                "history": list(self.history)}
+
+
+class ProbeEngine(object):
+    """Runs fingerprint_file-style probes concurrently, keeping each host
+    within its own AIMD window. Fingerprinters and guessers take an optional
+    engine; without one they probe sequentially as before.
+    """
+
+    def __init__(self, max_window=MAX_WINDOW, initial_window=INITIAL_WINDOW, max_workers=None,
+                 fetch=FingerprintUtils.url_read_spoof_ua):
+        """max_window caps the window of any single host; max_workers (default
+        max_window) caps the number of probe threads across all hosts. fetch
+        is the function used to read a url.
+        """
+        self.max_window = max_window
+        self.initial_window = initial_window
+        self._fetch = fetch
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or max_window)
+
+    def window_for(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._windows:
+                self._windows[host] = AIMDWindow(self.initial_window, maximum=self.max_window)
+            return self._windows[host]
+
+    def fetch(self, url, fetch=None):
+        """Read url like FingerprintUtils.url_read_spoof_ua (or with fetch, eg a
+        transport, if given), waiting for room in the host's window and feeding
+        the outcome back into it. Errors are re-raised unchanged so callers keep
+        their existing handling (and their _host_down_errors accounting, which
+        counts the same failures that shrink the window here).
+        """
+        window = self.window_for(url)
+        window.acquire()
+        start = time.time()
+        congested = False
+        try:
+            return (fetch or self._fetch)(url)
+        except urllib.error.HTTPError as e:
+            congested = e.code in CONGESTION_CODES
+            raise
+        except (IOError, HTTPException):
+            # timeouts, refused or dropped connections
+            congested = True
+            raise
+        finally:
+            window.release(time.time() - start, congested)
+
+    def map(self, func, items, stop=None, on_skip=None):
+        """Call func on each item concurrently and return the results in order.
+        If stop is given it is checked before each call; items not yet started
+        once it returns True produce None and are passed to on_skip.
+        """
+        if getattr(self._local, "in_worker", False):
+            # Already on an engine thread (eg guess_apps -> fingerprint); nesting
+            # pools could deadlock, and the host window still applies to fetch().
+            return map_probes(None, func, items, stop, on_skip)
+
+        def run(item):
+            self._local.in_worker = True
+            if stop and stop():
+                if on_skip:
+                    on_skip(item)
+                return None
+            return func(item)
+
+        return list(self._executor.map(run, items))
+
+    def stats(self):
+        """Current window, throughput etc. for every host seen, keyed by host."""
+        with self._lock:
+            windows = dict(self._windows)
+        return {host: window.stats() for host, window in windows.items()}
+
+    def log_stats(self, logger):
+        for host, stats in sorted(self.stats().items()):
+            logger.logExtraInfo(f"{host}: window {stats['window']:.1f}, {stats['throughput']:.1f} probes/s, "
+                                f"{stats['completed']} probes, {stats['congestion_events']} congestion events")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+def fetch_url(engine, url, transport=None):
+    """Read url with transport (default url_read_spoof_ua), through engine if
+    there is one.
+    """
+    if engine:
+        return engine.fetch(url, transport)
+    return (transport or FingerprintUtils.url_read_spoof_ua)(url)
+
+
+def map_probes(engine, func, items, stop=None, on_skip=None):
+    """Call func on each item, through engine if there is one, and return the
+    results in order. Without an engine items run one at a time in this
+    thread. Once stop returns True the remaining items are not run: they
+    produce None and are passed to on_skip.
+    """
+    if engine:
+        return engine.map(func, items, stop, on_skip)
+    results = []
+    for item in items:
+        if stop and stop():
+            if on_skip:
+                on_skip(item)
+            results.append(None)
+        else:
+            results.append(func(item))
+    return results
@@ -0,0 +1,235 @@
+"""Per-target memo of probe responses, shared by every phase of a scan
+(app guessing, app fingerprinting, winnowing, plugin guessing and plugin
+fingerprinting) so that no url is fetched twice and responses fetched by one
+phase count as evidence in the others. The error page profile and the assets
+linked from the landing page of each site are kept too.
+
+Each entry holds what the matching code needs: md5 state of the body from
+which the digest for any path can be finished, the error-page fingerprint of
+the body (see FingerprintUtils.PageFeatures), the status and a small prefix
+of the body. The md5 states of the body's massaged variants (see
+FileMassagers) are only computed the first time the body itself doesn't
+match; bodies up to KEPT_BODY_LIMIT characters are kept until then, bigger
+ones are massaged straight away so that no entry holds a large body.
+"""
+import contextlib
+import hashlib
+import itertools
+import threading
+import urllib.error
+
+import FileMassagers
+import FingerprintUtils
+import ProbeEngine
+
+# Number of characters of each body kept (for logging and cheap heuristics)
+PREFIX_LENGTH = 256
+
+# Longest body (in characters) kept in an entry until its massaged variants
+# are needed; longer ones are massaged when the entry is made
+KEPT_BODY_LIMIT = 16 * 1024
+
+
+def _finish(state, path):
+    h = state.copy()
+    h.update(path.encode('utf-8'))
+    return h.hexdigest()
+
+
+class MemoEntry(object):
+    __slots__ = ("code", "reason", "length", "prefix", "page_fingerprint", "_data", "_hash", "_massaged_hashes")
+
+    def __init__(self, code, reason=None, length=0, prefix="", page_fingerprint=None, data=None):
+        self.code = code
+        self.reason = reason
+        self.length = length
+        self.prefix = prefix
+        self.page_fingerprint = page_fingerprint
+        self._data = data
+        self._hash = hashlib.md5(data.encode('utf-8')) if data is not None else None
+        self._massaged_hashes = None
+        if data is not None and len(data) > KEPT_BODY_LIMIT:
+            self._massaged()
+
+    @classmethod
+    def from_data(cls, data):
+        """Entry for a successfully fetched body"""
+        return cls(200, length=len(data), prefix=data[:PREFIX_LENGTH],
+                   page_fingerprint=FingerprintUtils.fingerprint_error_page(data), data=data)
+
+    def _massaged(self):
+        """md5 states of the distinct massaged variants of the body, computed
+        on first use (the body is dropped then)"""
+        hashes = self._massaged_hashes
+        if hashes is not None:
+            return hashes
+        data = self._data
+        if data is None:
+            # computed by another thread meanwhile (it is set before the body is dropped)
+            return self._massaged_hashes
+        hashes = []
+        seen = {data}
+        ms = FileMassagers.MASSAGERS
+        for i in range(1, len(ms) + 1):
+            for massagersTpl in itertools.combinations(ms, i):
+                massagedData = data
+                for m in massagersTpl:
+                    massagedData = m(massagedData)
+                if massagedData not in seen:
+                    seen.add(massagedData)
+                    hashes.append(hashlib.md5(massagedData.encode('utf-8')))
+        self._massaged_hashes = hashes
+        self._data = None
+        return hashes
+
+    @classmethod
+    def from_http_error(cls, e):
+        return cls(e.code, reason=str(e.reason))
+
+    @property
+    def ok(self):
+        return self.code == 200
+
+    def digests(self, path):
+        """Yield (digest, massaged) for the body as hashed in the DBs for path
+        (md5 of body + path): the unmodified body first, then any distinct
+        massaged variants (computed only if asked for).
+        """
+        if self._hash is None:
+            return
+        yield _finish(self._hash, path), False
+        for state in self._massaged():
+            yield _finish(state, path), True
+
+    def match(self, path, path_nodes):
+        """Return (versions, massaged) for the first digest of this body known
+        for path in path_nodes, or (None, False)."""
+        hashes = path_nodes.get(path)
+        if hashes:
+            for digest, massaged in self.digests(path):
+                if digest in hashes:
+                    return hashes[digest], massaged
+        return None, False
+
+    def is_error_page(self, error_page_fingerprint):
+        return FingerprintUtils.compare_fingerprint_to_error_page(error_page_fingerprint, self.page_fingerprint)
+
+    def raise_error(self, url):
+        raise urllib.error.HTTPError(url, self.code, self.reason, {}, None)
+
+
+class ResponseMemo(object):
+    """Responses (MemoEntry) for one target, keyed by url. Client errors (eg
+    404) are remembered too; server errors, throttling and failures to reach
+    the server are not, so those urls are tried again.
+
+    A NegativeCache (which can outlive the memo and be shared between
+    targets on a host) answers urls known to be missing without fetching
+    them, and learns from every response fetched through the memo.
+
+    Threads fetching the same url at the same time (eg two phases run
+    through a ProbeEngine) share one fetch, see fetch_entry.
+    """
+
+    def __init__(self, negative_cache=None):
+        self.negative_cache = negative_cache
+        self.hits = 0
+        self._entries = {}
+        self._error_pages = {}
+        self._linked_assets = {}
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                self.hits += 1
+            return entry
+
+    def put(self, url, entry):
+        with self._lock:
+            self._entries[url] = entry
+
+    @contextlib.contextmanager
+    def fetching(self, url):
+        """Hold the lock of url while fetching it, so concurrent fetches of it
+        wait for the first one. The lock is forgotten when the fetch is done."""
+        with self._lock:
+            lock = self._fetching.setdefault(url, threading.Lock())
+        with lock:
+            try:
+                yield
+            finally:
+                with self._lock:
+                    if self._fetching.get(url) is lock:
+                        del self._fetching[url]
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def error_page(self, base_url, identify):
+        """Error page fingerprint for base_url, computed with identify(base_url)
+        the first time it is asked for."""
+        with self._lock:
+            if base_url in self._error_pages:
+                return self._error_pages[base_url]
+        error_page_fingerprint = identify(base_url)
+        with self._lock:
+            self._error_pages[base_url] = error_page_fingerprint
+        return error_page_fingerprint
+
+    def linked_assets(self, site_url, harvest):
+        """Asset urls linked from the landing page of site_url, found with
+        harvest(site_url) the first time they are asked for."""
+        with self._lock:
+            if site_url in self._linked_assets:
+                return self._linked_assets[site_url]
+        urls = harvest(site_url)
+        with self._lock:
+            self._linked_assets[site_url] = urls
+        return urls
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def fetch_entry(memo, fetch, url):
+    """Return the MemoEntry for url from memo, or fetch it with fetch(url) and
+    remember it. Recorded HTTP errors are raised again as HTTPError. A call
+    for a url another thread is fetching waits for that fetch and uses its
+    entry (or fetches again if it wasn't remembered, eg a server error).
+    """
+    if memo is None:
+        return _fetch_new_entry(None, fetch, url)
+    entry = memo.get(url)
+    if entry is None:
+        with memo.fetching(url):
+            entry = memo.get(url)
+            if entry is None:
+                return _fetch_new_entry(memo, fetch, url)
+    if not entry.ok:
+        entry.raise_error(url)
+    return entry
+
+
+def _fetch_new_entry(memo, fetch, url):
+    negative_cache = memo.negative_cache if memo is not None else None
+    if negative_cache:
+        error = negative_cache.error(url)
+        if error:
+            raise error
+    try:
+        entry = MemoEntry.from_data(fetch(url))
+    except urllib.error.HTTPError as e:
+        if memo is not None and e.code < 500 and e.code not in ProbeEngine.CONGESTION_CODES:
+            memo.put(url, MemoEntry.from_http_error(e))
+        if negative_cache:
+            negative_cache.record_error(url, e.code)
+        raise
+    if memo is not None:
+        memo.put(url, entry)
+    if negative_cache:
+        negative_cache.record_found(url)
+    return entry
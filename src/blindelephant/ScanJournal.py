@@ -0,0 +1,116 @@
+"""Write-ahead journal of completed scan units, so that an interrupted batch
+scan resumes where it stopped instead of starting from zero.
+
+Every unit of work Scanner finishes is appended to the journal (one json
+line, flushed and fsynced) before the scan moves on:
+
+    ("apps", target)                   -> apps found on target
+    ("app", target, app)               -> versions of app
+    ("plugins", target, app)           -> plugins found for app
+    ("plugin", target, app, plugin)    -> versions of plugin
+    ("done", target)                   -> target finished
+
+A finished run can be compacted into the final json report with compact().
+"""
+import json
+import os
+
+
+class ScanJournal(object):
+
+    def __init__(self, filename, sync=True):
+        """Open (or create) the journal at filename and replay what is already
+        in it. With sync turned off records are flushed but not fsynced, which
+        is faster but may lose the last few units on a power failure.
+        """
+        self.filename = filename
+        self.sync = sync
+        self._records = {}
+        if os.path.exists(filename):
+            self._replay()
+        self._file = open(filename, "a")
+
+    def _replay(self):
+        good_offset = 0
+        with open(self.filename, "rb") as f:
+            for line in f:
+                # torn write at the end of an interrupted run (which can stop
+                # right before the newline, leaving valid json)
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    key, value = json.loads(line)
+                except ValueError:
+                    break
+                self._records[tuple(key)] = value
+                good_offset += len(line)
+        if good_offset != os.path.getsize(self.filename):
+            with open(self.filename, "r+b") as f:
+                f.truncate(good_offset)
+
+    def __contains__(self, key):
+        return key in self._records
+
+    def __getitem__(self, key):
+        return self._records[key]
+
+    def record(self, key, value):
+        """Durably record the (json-serializable) result of unit key"""
+        self._file.write(json.dumps([key, value]) + "\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self._records[key] = value
+
+    def is_done(self, target):
+        return ("done", target) in self._records
+
+    def mark_done(self, target):
+        self.record(("done", target), True)
+
+    def record_result(self, result):
+        """Record every unit of a finished target at once, given its
+        ScannerResult.to_dict() (eg from a scan run in another process)"""
+        url = result["url"]
+        self.record(("apps", url), list(result["apps"]))
+        for app, vers in result["apps"].items():
+            self.record(("app", url, app), vers)
+        for app, plugins in result["plugins"].items():
+            self.record(("plugins", url, app), list(plugins))
+            for plugin, vers in plugins.items():
+                self.record(("plugin", url, app, plugin), vers)
+        self.mark_done(url)
+
+    def results(self):
+        """Results of every finished target in the form of ScannerResult.to_dict()"""
+        results = {}
+        for key, value in self._records.items():
+            if key[0] == "done":
+                results[key[1]] = {"url": key[1], "apps": {}, "plugins": {}}
+        for key, value in self._records.items():
+            if key[0] == "app" and key[1] in results:
+                results[key[1]]["apps"][key[2]] = value
+            elif key[0] == "plugins" and key[1] in results:
+                results[key[1]]["plugins"].setdefault(key[2], {})
+            elif key[0] == "plugin" and key[1] in results:
+                results[key[1]]["plugins"].setdefault(key[2], {})[key[3]] = value
+        return list(results.values())
+
+    def compact(self, report_filename, remove=True):
+        """Write the results of all finished targets to report_filename as a
+        json list and (by default) delete the journal. The report is written to
+        a temporary file and renamed so a crash can't leave half a report.
+        """
+        tmp_filename = report_filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(self.results(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, report_filename)
+        self.close()
+        if remove:
+            os.remove(self.filename)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
@@ -0,0 +1,283 @@
+"""Coordinator/worker mode for Scanner: a durable SQLite job queue of targets
+that any number of worker processes lease, scan and report back into.
+
+A job is leased to one worker at a time. Workers renew their lease while a
+scan is running; if a worker dies the lease expires and the job goes back to
+pending, up to MAX_ATTEMPTS tries.
+
+The queue file uses SQLite's default rollback journal, which coordinates
+workers through file locks only. Workers on other machines can share it over a
+network filesystem only if that filesystem implements POSIX byte-range locks
+correctly (eg NFSv4 with locking enabled, not mounted with nolock); many
+NFS/SMB setups don't, and then two workers can lease the same job or the file
+can be corrupted. Where that can't be guaranteed, keep the queue file on one
+host and run the workers there (several with -w). When all workers are on one
+host, WAL mode (wal=True, --wal) lets status and results readers run alongside
+them without blocking; it needs shared memory, so it never works across
+machines.
+"""
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import DifferencesTables
+import ProbeEngine
+import Scanner
+
+# Seconds a leased job stays assigned to a worker without a renewal
+LEASE_SECONDS = 300
+
+# Number of times a job is tried (across workers) before it is marked failed
+MAX_ATTEMPTS = 3
+
+# Seconds an idle worker waits before asking for a job again
+POLL_INTERVAL = 2
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    target TEXT UNIQUE NOT NULL,
+    scan_plugins INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+
+
+class ScanQueue(object):
+    """Durable queue of scan jobs stored in a SQLite file."""
+
+    def __init__(self, filename, wal=False):
+        """Open (or create) the queue at filename. wal switches the file to
+        WAL mode, for when every worker runs on this host (see module
+        docstring); otherwise the file keeps its mode, which for a new file is
+        the rollback journal.
+        """
+        self.filename = filename
+        self._conn = sqlite3.connect(filename, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        if wal:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def add_targets(self, targets, scan_plugins=False):
+        """Queue targets (urls); ones already queued are left alone. Returns
+        the number of new jobs.
+        """
+        now = time.time()
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany("INSERT OR IGNORE INTO jobs (target, scan_plugins, updated) VALUES (?, ?, ?)",
+                                   ((t, int(bool(scan_plugins)), now) for t in targets))
+            self._conn.execute("COMMIT")
+            return self._conn.total_changes - before
+
+    def lease(self, worker, lease_seconds=LEASE_SECONDS):
+        """Assign the next pending job to worker. Returns (job_id, target,
+        scan_plugins) or None if nothing is pending.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire_leases(now)
+                row = self._conn.execute("SELECT id, target, scan_plugins FROM jobs WHERE state = ? "
+                                         "ORDER BY id LIMIT 1", (PENDING,)).fetchone()
+                if row:
+                    self._conn.execute("UPDATE jobs SET state = ?, worker = ?, lease_expires = ?, "
+                                       "attempts = attempts + 1, updated = ? WHERE id = ?",
+                                       (LEASED, worker, now + lease_seconds, now, row[0]))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return (row[0], row[1], bool(row[2])) if row else None
+
+    def _expire_leases(self, now):
+        self._conn.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, "
+                           "error = 'lease expired', updated = ? WHERE state = ? AND lease_expires < ?",
+                           (MAX_ATTEMPTS, FAILED, PENDING, now, LEASED, now))
+
+    def renew(self, job_id, worker, lease_seconds=LEASE_SECONDS):
+        """Extend worker's lease on job_id; returns False if it was lost."""
+        return self._update("UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND state = ?",
+                            (time.time() + lease_seconds, job_id, worker, LEASED))
+
+    def complete(self, job_id, worker, result):
+        """Store the (json-serializable) result of a job. Returns False if the
+        worker no longer held the lease, in which case the result is dropped.
+        """
+        return self._update("UPDATE jobs SET state = ?, result = ?, error = NULL, lease_expires = NULL, updated = ? "
+                            "WHERE id = ? AND worker = ? AND state = ?",
+                            (DONE, json.dumps(result), time.time(), job_id, worker, LEASED))
+
+    def fail(self, job_id, worker, error):
+        """Give a job back after an error; it is retried until MAX_ATTEMPTS."""
+        return self._update("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, worker = NULL, "
+                            "error = ?, lease_expires = NULL, updated = ? WHERE id = ? AND worker = ? AND state = ?",
+                            (MAX_ATTEMPTS, FAILED, PENDING, str(error), time.time(), job_id, worker, LEASED))
+
+    def _update(self, sql, params):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                changed = self._conn.execute(sql, params).rowcount
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return changed > 0
+
+    def counts(self):
+        """Number of jobs in each state"""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def results(self):
+        """Yield (target, state, result, error) for every finished or failed job"""
+        with self._lock:
+            rows = self._conn.execute("SELECT target, state, result, error FROM jobs WHERE state IN (?, ?) "
+                                      "ORDER BY id", (DONE, FAILED)).fetchall()
+        for target, state, result, error in rows:
+            yield target, state, json.loads(result) if result else None, error
+
+
+def run_worker(queue_file, worker=None, concurrency=1, lease_seconds=LEASE_SECONDS, exit_when_idle=True,
+               wal=False):
+    """Lease jobs from the queue at queue_file and scan them until the queue is
+    drained (or forever, polling, if exit_when_idle is False). Returns the
+    number of jobs this worker completed.
+    """
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    queue = ScanQueue(queue_file, wal)
+    done = 0
+    try:
+        while True:
+            job = queue.lease(worker, lease_seconds)
+            if not job:
+                if exit_when_idle and not queue.counts()[LEASED]:
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+            job_id, target, scan_plugins = job
+
+            # keep the lease alive for as long as the scan takes
+            finished = threading.Event()
+            heartbeat = threading.Thread(target=_renew_lease, daemon=True,
+                                         args=(queue, job_id, worker, lease_seconds, finished))
+            heartbeat.start()
+            engine = ProbeEngine.ProbeEngine(max_window=concurrency) if concurrency > 1 else None
+            try:
+                scanner = Scanner.Scanner(target, scan_plugins, engine=engine)
+                scanner.scan()
+            except Exception as e:
+                finished.set()
+                queue.fail(job_id, worker, f"{type(e).__name__}: {e}")
+            else:
+                finished.set()
+                if queue.complete(job_id, worker, scanner.result.to_dict()):
+                    done += 1
+            finally:
+                heartbeat.join()
+                if engine:
+                    engine.shutdown()
+    finally:
+        queue.close()
+    return done
+
+
+def _renew_lease(queue, job_id, worker, lease_seconds, finished):
+    while not finished.wait(lease_seconds / 3.0):
+        if not queue.renew(job_id, worker, lease_seconds):
+            break
+
+
+if __name__ == '__main__':
+    USAGE = """usage: %prog [options] add queuefile targetsfile
+       %prog [options] work queuefile
+       %prog status queuefile
+       %prog results queuefile"""
+    EPILOGUE = """Distribute Scanner runs over worker processes. "add" queues the urls in
+               targetsfile (one per line, - for stdin); "work" starts workers that scan
+               queued targets until none are left; "results" prints finished jobs as
+               json lines."""
+
+    parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
+    parser.add_option("-p", "--plugins", action="store_true", help="(add) Detect and fingerprint plugins too")
+    parser.add_option("-w", "--workers", type='int', default=1,
+                      help="(work) Number of local worker processes. Default: %default")
+    parser.add_option("-c", "--concurrency", type='int', default=1,
+                      help="(work) Maximum number of concurrent probes per host in each worker. Default: %default")
+    parser.add_option("-f", "--forever", action="store_true",
+                      help="(work) Keep polling for new jobs instead of exiting when the queue is drained")
+    parser.add_option("-m", "--cache-mb", type='int',
+                      help="(work) Memory budget of each worker's DB cache in MB. Default: %d"
+                           % (DifferencesTables.TABLE_CACHE_BUDGET // 2 ** 20))
+    parser.add_option("--wal", action="store_true",
+                      help="Put the queue file in WAL mode. Only when every worker runs on this host: WAL doesn't "
+                           "work over network filesystems")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2 or args[0] not in ("add", "work", "status", "results") or (args[0] == "add" and len(args) < 3):
+        parser.print_help()
+        quit()
+
+    command, queue_file = args[0], args[1]
+
+    if command == "add":
+        with (sys.stdin if args[2] == "-" else open(args[2])) as f:
+            targets = [line.strip().strip("/") for line in f if line.strip()]
+        q = ScanQueue(queue_file, options.wal)
+        print("Queued %d new targets" % q.add_targets(targets, options.plugins))
+        q.close()
+    elif command == "work":
+        if options.cache_mb:
+            DifferencesTables.setTableCacheBudget(options.cache_mb * 2 ** 20)
+        worker_args = (queue_file, None, options.concurrency, LEASE_SECONDS, not options.forever, options.wal)
+        if options.workers > 1:
+            # load the DBs once, before forking, so the workers share them
+            Scanner.preload_dbs(scan_plugins=True)
+            processes = [multiprocessing.Process(target=run_worker, args=worker_args) for _ in range(options.workers)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+        else:
+            run_worker(*worker_args)
+        q = ScanQueue(queue_file, options.wal)
+        print(q.counts())
+        q.close()
+    elif command == "status":
+        q = ScanQueue(queue_file, options.wal)
+        print(q.counts())
+        q.close()
+    else:
+        q = ScanQueue(queue_file, options.wal)
+        for target, state, result, error in q.results():
+            print(json.dumps({"target": target, "state": state, "result": result, "error": error}))
+        q.close()
@@ -1,8 +1,25 @@
 import datetime
+import functools
+import gc
+import json
+import multiprocessing
+import os
+import time
+from distutils.version import LooseVersion
 from optparse import OptionParser
 
+import Configuration
+import DifferencesTables
+import FingerprintUtils
 import Fingerprinters
+import GlobalIndex
 import Loggers
+import NegativeCache
+import ProbeEngine
+import ResponseMemo
+import ScanJournal
+import Tracing
+import Transports
 
 
 class ScannerResult(object):
@@ -14,9 +31,16 @@ class ScannerResult(object):
     def print_results(self, file):
         pass
 
+    def to_dict(self):
+        """Plain (json-serializable) form of the results, with versions as strings"""
+        return {"url": self.url,
+                "apps": {app: [v.vstring for v in vers] for app, vers in self.apps.items()},
+                "plugins": {app: {plugin: [v.vstring for v in vers] for plugin, vers in plugins.items()}
+                            for app, plugins in self.plugins.items()}}
+
     def __str__(self):
         string_name = ""
-        string_name += "Scanner Results for %s\n" % url
+        string_name += "Scanner Results for %s\n" % self.url
 
         for app, vers in self.apps.items():
             versions_as_str = [v.vstring for v in vers]
@@ -30,54 +54,288 @@ class ScannerResult(object):
 
 
 class Scanner(object):
-    def __init__(self, target_url, scan_plugins=False):
+    def __init__(self, target_url, scan_plugins=False, engine=None, journal=None, transport=None, logger=None,
+                 index=None, head_plugins=False, negative_cache=None):
+        """If a ScanJournal is given, every finished unit of the scan is
+        recorded in it, and units it already holds are restored from it instead
+        of being scanned again. transport replaces url_read_spoof_ua for all
+        requests (see Transports). logger (default: discard everything) can be
+        a Loggers.MetricsLogger shared between scans to collect statistics.
+
+        All phases of the scan share one ResponseMemo, so each url of the
+        target is fetched at most once. With a GlobalIndex, apps are identified
+        in one pass over high-yield paths (see WebAppGuesser.identify_apps)
+        and those responses are reused as fingerprinting evidence.
+        head_plugins checks for plugins with HEAD requests (see
+        PluginGuesser). A NegativeCache shared between scans of the same
+        host (default: one for this scan) skips paths already found missing.
+        """
         self.url = target_url
         self.scan_plugins = scan_plugins
+        self.engine = engine
+        self.journal = journal
+        self.transport = transport
+        self.index = index
+        self.head_plugins = head_plugins
         self.result = ScannerResult(target_url)
-        self.logger = Loggers.FileLogger(open("/dev/null", "w"))
-        self.app_guesser = Fingerprinters.WebAppGuesser(target_url, logger=self.logger)
+        self.logger = logger or Loggers.NullLogger()
+        self.negative_cache = negative_cache or NegativeCache.NegativeCache()
+        self.negative_cache.protect(target_url)
+        self.memo = ResponseMemo.ResponseMemo(self.negative_cache)
+        self.app_guesser = Fingerprinters.WebAppGuesser(target_url, logger=self.logger, engine=engine,
+                                                        transport=transport, memo=self.memo)
 
     def scan(self):
+        start = time.perf_counter()
+        negative_hits = self.negative_cache.hits
+
+        # {app: versions} narrowed by the index while identifying apps (not journaled: only a head start)
+        narrowed = {}
+        if self.index:
+            def identify_apps():
+                narrowed.update(self.app_guesser.identify_apps(self.index))
+                return list(narrowed)
 
-        possible_apps = self.app_guesser.guess_apps()
+            possible_apps = self._checkpoint(("apps", self.url), identify_apps)
+        else:
+            possible_apps = self._checkpoint(("apps", self.url), self.app_guesser.guess_apps)
 
-        for app_name in possible_apps:
-            fp = Fingerprinters.WebAppFingerprinter(self.url, app_name, logger=self.logger)
-            self.result.apps[app_name] = fp.fingerprint()
+        fingerprinters = {app_name: Fingerprinters.WebAppFingerprinter(self.url, app_name, logger=self.logger,
+                                                                       engine=self.engine, transport=self.transport,
+                                                                       memo=self.memo,
+                                                                       versions=narrowed.get(app_name))
+                          for app_name in possible_apps}
+        app_plans = self._plan_probes([fp for app_name, fp in fingerprinters.items()
+                                       if not (self.journal and ("app", self.url, app_name) in self.journal)])
+        for app_name, fp in fingerprinters.items():
+            self.result.apps[app_name] = self._checkpoint(("app", self.url, app_name),
+                                                          functools.partial(fp.fingerprint, app_plans.get(app_name)),
+                                                          True)
 
         if self.scan_plugins:
             for app_name in possible_apps:
-                pg = Fingerprinters.PluginGuesser(self.url, app_name)
+                pg = Fingerprinters.PluginGuesser(self.url, app_name, logger=self.logger, engine=self.engine,
+                                                  transport=self.transport, memo=self.memo, head=self.head_plugins)
                 self.result.plugins[app_name] = {}
 
-                possible_plugins = pg.guess_plugins()
+                possible_plugins = self._checkpoint(("plugins", self.url, app_name), pg.guess_plugins)
 
                 for plugin_name in possible_plugins:
-                    pfp = Fingerprinters.PluginFingerprinter(self.url, app_name, plugin_name, logger=self.logger)
-                    self.result.plugins[app_name][plugin_name] = pfp.fingerprint()
+                    pfp = Fingerprinters.PluginFingerprinter(self.url, app_name, plugin_name, logger=self.logger,
+                                                             engine=self.engine, transport=self.transport,
+                                                             memo=self.memo)
+                    self.result.plugins[app_name][plugin_name] = self._checkpoint(
+                        ("plugin", self.url, app_name, plugin_name), pfp.fingerprint, True)
+
+        if self.journal:
+            self.journal.mark_done(self.url)
+        self.logger.logCount("memo_hits", self.memo.hits)
+        self.logger.logCount("negative_cache_hits", self.negative_cache.hits - negative_hits)
+        self.logger.logTiming("scan_seconds", time.perf_counter() - start)
+
+    def _plan_probes(self, fingerprinters):
+        """With several candidate apps at the url, plan their probes jointly
+        (see FingerprintUtils.plan_joint_probes) and fetch the plan once;
+        every fingerprinter then scores every response it knows the path of.
+        Returns {app_name: paths}, empty for a single app.
+        """
+        if len(fingerprinters) < 2:
+            return {}
+        num_probes = min(fp.num_probes for fp in fingerprinters)
+        plan, app_plans = FingerprintUtils.plan_joint_probes({fp.app_name: fp.ranked_paths() for fp in fingerprinters},
+                                                             num_probes)
+        fingerprinters[0].prefetch(plan)
+        self.logger.logCount("joint_plan_probes", len(plan))
+        return app_plans
+
+    def _checkpoint(self, key, func, versions=False):
+        """Return the journaled result for key if there is one, otherwise call
+        func and journal its result. versions marks results that are lists of
+        LooseVersions (stored as strings).
+        """
+        if self.journal and key in self.journal:
+            value = self.journal[key]
+            return [LooseVersion(v) for v in value] if versions else value
+        value = func()
+        if self.journal:
+            self.journal.record(key, [v.vstring for v in value] if versions else value)
+        return value
+
+
+def preload_dbs(scan_plugins=False):
+    """Load every app DB (and with scan_plugins every plugin DB) into the
+    loadTables cache, then move everything allocated so far out of the
+    garbage collector's reach (gc.freeze). Processes forked afterwards share
+    one copy of the tables: the collector never writes to their pages, so
+    they are only copied where a worker's refcount updates touch them.
+    """
+    dbs = [Configuration.getDbPath(app) for app in Configuration.APP_CONFIG]
+    if scan_plugins:
+        for app in Configuration.APP_CONFIG:
+            plugins_dir = Configuration.getDbDir(app)
+            if os.path.isdir(plugins_dir):
+                dbs.extend(plugins_dir + name for name in sorted(os.listdir(plugins_dir))
+                           if name.endswith(Configuration.DB_EXTENSION))
+    for db in dbs:
+        if os.path.exists(db):
+            try:
+                DifferencesTables.loadTables(db, printStats=False)
+            except (ValueError, EOFError) as e:
+                print(f"WARN: Couldn't load {db}: {e}", file=Configuration.DEFAULT_LOGFILE)
+    gc.collect()
+    gc.freeze()
+
+
+# Per-process state of scan_in_processes workers
+_worker = {}
+
+
+def _init_worker(scan_plugins, concurrency, transport, index, head_plugins):
+    _worker["scan_plugins"] = scan_plugins
+    _worker["head_plugins"] = head_plugins
+    _worker["engine"] = ProbeEngine.ProbeEngine(max_window=concurrency) if concurrency > 1 else None
+    _worker["transport"] = transport
+    _worker["index"] = index
+    _worker["negative_cache"] = NegativeCache.NegativeCache()
+
+
+def _scan_in_worker(url):
+    s = Scanner(url, _worker["scan_plugins"], engine=_worker["engine"], transport=_worker["transport"],
+                index=_worker["index"], head_plugins=_worker["head_plugins"],
+                negative_cache=_worker["negative_cache"])
+    s.scan()
+    return s.result
+
+
+def scan_in_processes(targets, scan_plugins=False, workers=2, concurrency=1, transport=None, index=None,
+                      head_plugins=False):
+    """Scan targets in a pool of worker processes and yield each
+    ScannerResult, in order. The DBs are preloaded (see preload_dbs) before
+    the workers are forked, so they share them instead of each loading a
+    copy. transport must be usable from forked processes (eg a replay).
+    """
+    preload_dbs(scan_plugins)
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers, _init_worker, (scan_plugins, concurrency, transport, index, head_plugins)) as pool:
+        yield from pool.imap(_scan_in_worker, targets)
 
 
 if __name__ == '__main__':
-    USAGE = "usage: %prog [options] url"
+    USAGE = "usage: %prog [options] url\n       %prog [options] -f targetsfile"
     EPILOGUE = """Check a URL for any webapps supported by BlindElephant, and 
                fingerprint any found. With optional -p, also detect and fingerprint
-               plugins (not all supported apps have supported plugins)."""
+               plugins (not all supported apps have supported plugins). With -j,
+               progress is journaled and rerunning the same command resumes an
+               interrupted scan."""
 
     parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
     parser.add_option("-p", "--plugins", action="store_true", help="Detect and fingerprint plugins too")
+    parser.add_option("--head", action="store_true",
+                      help="Check for plugins concurrently with HEAD requests, downloading files only to confirm")
+    parser.add_option("--negative-cache",
+                      help="Remember missing paths in this file, and skip paths it holds (until they expire)")
+    parser.add_option("-w", "--workers", type='int', default=1,
+                      help="Scan this many targets at a time in separate processes sharing one copy of the DBs. "
+                           "Default: %default")
+    parser.add_option("-c", "--concurrency", type='int', default=1,
+                      help="Maximum number of concurrent probes per host; the actual number adapts to the host's "
+                           "latency and errors. Default: %default (probe sequentially)")
+    parser.add_option("-f", "--targets", help="Scan every url in this file (one per line)")
+    parser.add_option("-i", "--index", action="store_true",
+                      help="Identify apps in one pass using the global index of all DBs (see GlobalIndex)")
+    parser.add_option("-j", "--journal", help="Journal finished work to this file and resume from it if it exists")
+    parser.add_option("--record", help="Record every request and response of the scan to this archive")
+    parser.add_option("--replay", help="Answer requests from an archive made with --record instead of the network")
+    parser.add_option("--trace", help="Write a timeline of the scan to this file (Chrome trace-event json)")
+    parser.add_option("--log", help="Log every probe to this file, as json lines if it ends in .jsonl, "
+                                    "as text otherwise")
+    parser.add_option("--stats", help="Write scan statistics (timings, counters) to this file as json")
+    parser.add_option("--prometheus", help="Write scan statistics to this file in Prometheus text format")
+    parser.add_option("-o", "--output", help="Write results of all targets to this file as json (compacts and "
+                                             "removes the journal, if any)")
 
     (options, args) = parser.parse_args()
 
-    if len(args) < 1:
+    if len(args) < 1 and not options.targets:
         print("Error: url is required argument\n")
         parser.print_help()
         quit()
 
-    url = args[0].strip("/")
+    if options.targets:
+        with open(options.targets) as f:
+            targets = [line.strip().strip("/") for line in f if line.strip()]
+    else:
+        targets = [args[0].strip("/")]
 
+    if options.workers > 1 and (options.record or options.trace or options.log or options.stats or options.prometheus
+                                or options.negative_cache):
+        print("Error: --record, --trace, --log, --stats, --prometheus and --negative-cache can't be used with "
+              "--workers\n")
+        parser.print_help()
+        quit()
+
+    if options.trace:
+        Tracing.enable()
     start = datetime.datetime.now()
-    s = Scanner(url, options.plugins)
-    s.scan()
+    engine = ProbeEngine.ProbeEngine(max_window=options.concurrency) \
+        if options.concurrency > 1 and options.workers <= 1 else None
+    journal = ScanJournal.ScanJournal(options.journal) if options.journal else None
+    transport = None
+    if options.replay:
+        transport = Transports.ReplayTransport(options.replay)
+    elif options.record:
+        transport = Transports.RecordingTransport()
+    logger = None
+    if options.log:
+        logger = Loggers.StructuredLogger(open(options.log, "w"), "jsonl" if options.log.endswith(".jsonl") else "text")
+    metrics = Loggers.MetricsLogger(logger) if options.stats or options.prometheus else None
+    index = GlobalIndex.load_index() if options.index else None
+    # shared by all targets, so targets on one host skip each other's missing paths
+    negative_cache = NegativeCache.NegativeCache()
+    if options.negative_cache and os.path.exists(options.negative_cache):
+        negative_cache.load(options.negative_cache)
+    pending = [url for url in targets if not (journal and journal.is_done(url))]
+
+    def scan_here(url):
+        s = Scanner(url, options.plugins, engine=engine, journal=journal, transport=transport,
+                    logger=metrics or logger, index=index, head_plugins=options.head, negative_cache=negative_cache)
+        s.scan()
+        return s.result
+
+    if options.workers > 1 and pending:
+        scanned = scan_in_processes(pending, options.plugins, options.workers, options.concurrency, transport, index,
+                                    options.head)
+    else:
+        scanned = map(scan_here, pending)
+    results = []
+    for result in scanned:
+        if journal and options.workers > 1:
+            journal.record_result(result.to_dict())
+        results.append(result.to_dict())
+        print(result)
     finish = datetime.datetime.now()
-    print(s.result)
     print("Fingerprint time: ", finish - start)
+    if options.record and not options.replay:
+        transport.save(options.record)
+    if options.negative_cache:
+        negative_cache.save(options.negative_cache)
+    if logger:
+        logger.close()
+    if options.trace:
+        Tracing.disable().export(options.trace)
+    if options.stats:
+        with open(options.stats, "w") as f:
+            f.write(metrics.to_json())
+    if options.prometheus:
+        with open(options.prometheus, "w") as f:
+            f.write(metrics.to_prometheus())
+    if journal and options.output:
+        journal.compact(options.output)
+    elif options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f)
+    elif journal:
+        journal.close()
+    if engine:
+        engine.log_stats(Loggers.FileLogger())
+        engine.shutdown()
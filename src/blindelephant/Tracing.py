@@ -0,0 +1,95 @@
+"""Opt-in timeline tracing of a scan, exported as Chrome trace-event json
+(open with chrome://tracing or https://ui.perfetto.dev).
+
+Tracing is off unless enable() is called; span() is then a cheap no-op.
+DB loads, error page detection, app guesses, every probe and every HTTP
+request are wrapped in spans, so concurrent probing shows up as parallel
+lanes (one per thread) and stalls as gaps.
+"""
+import contextlib
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+_tracer = None
+_null_span = contextlib.nullcontext()
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.events = []
+        self._pid = os.getpid()
+        self._start = time.perf_counter()
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._add({"name": name, "cat": category, "ph": "X", "pid": self._pid,
+                       "tid": threading.get_ident(), "ts": (start - self._start) * 1e6,
+                       "dur": (end - start) * 1e6, "args": args})
+
+    def _add(self, event):
+        with self._lock:
+            if event["tid"] not in self._threads:
+                self._threads.add(event["tid"])
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": event["tid"],
+                                    "args": {"name": threading.current_thread().name}})
+            self.events.append(event)
+
+    def export(self, filename):
+        """Write the trace recorded so far to filename"""
+        with self._lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(filename, "w") as f:
+            json.dump(trace, f)
+
+
+def enable():
+    """Start recording spans (in this process) and return the Tracer"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    """Stop recording and return the Tracer that was in use, if any"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def span(name, category="scan", **args):
+    """Context manager recording a span named name while tracing is enabled"""
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, category, args)
+
+
+def traced(name, category="scan", arg=None):
+    """Decorator that records every call of the function as a span. arg names
+    a parameter whose value is stored with the span (eg the path probed).
+    """
+    def decorator(func):
+        arg_index = list(inspect.signature(func).parameters).index(arg) if arg else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+            span_args = {}
+            if arg:
+                span_args[arg] = args[arg_index] if arg_index < len(args) else kwargs.get(arg)
+            with _tracer.span(name, category, span_args):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
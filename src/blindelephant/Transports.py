@@ -0,0 +1,134 @@
+"""Record/replay transports for BlindElephant.
+
+A transport is anything that can stand in for FingerprintUtils.url_read_spoof_ua:
+a callable taking a url and returning the decoded body, or raising the same
+errors urllib would. Fingerprinters, guessers and Scanner take one with the
+transport argument.
+
+RecordingTransport passes requests through to the network and keeps every
+response; save() writes them to a compact archive (gzipped json, identical
+bodies stored once). ReplayTransport answers from such an archive at memory
+speed, so the matching and selection code can be profiled and
+regression-tested against real recorded traffic without network noise.
+"""
+import cProfile
+import gzip
+import hashlib
+import json
+import pstats
+import socket
+import threading
+import urllib.error
+from http.client import HTTPException
+from optparse import OptionParser
+
+import FingerprintUtils
+
+ARCHIVE_FORMAT = 1
+
+
+class RecordingTransport(object):
+
+    def __init__(self, fetch=FingerprintUtils.url_read_spoof_ua):
+        self._fetch = fetch
+        self._lock = threading.Lock()
+        self.responses = {}
+        self.bodies = {}
+
+    def __call__(self, url):
+        try:
+            data = self._fetch(url)
+        except urllib.error.HTTPError as e:
+            self._record(url, ["http", e.code, str(e.reason)])
+            raise
+        except urllib.error.URLError as e:
+            self._record(url, ["url", str(e.reason)])
+            raise
+        except socket.timeout as e:
+            self._record(url, ["timeout", str(e)])
+            raise
+        except (IOError, HTTPException) as e:
+            self._record(url, ["io", f"{type(e).__name__}: {e}"])
+            raise
+        digest = hashlib.md5(data.encode("utf-8", "surrogateescape")).hexdigest()
+        with self._lock:
+            self.bodies[digest] = data
+        self._record(url, ["ok", digest])
+        return data
+
+    def _record(self, url, response):
+        with self._lock:
+            self.responses[url] = response
+
+    def save(self, filename):
+        with self._lock:
+            archive = {"format": ARCHIVE_FORMAT, "responses": self.responses, "bodies": self.bodies}
+            with gzip.open(filename, "wt", encoding="utf-8", errors="surrogateescape") as f:
+                json.dump(archive, f)
+
+
+class ReplayTransport(object):
+    """Answers requests from an archive written by RecordingTransport.save().
+    Urls that were never recorded get a 404 (or a KeyError with strict=True);
+    they are counted in misses.
+    """
+
+    def __init__(self, filename, strict=False):
+        with gzip.open(filename, "rt", encoding="utf-8", errors="surrogateescape") as f:
+            archive = json.load(f)
+        if archive.get("format") != ARCHIVE_FORMAT:
+            raise ValueError(f"Unsupported replay archive format in {filename}: {archive.get('format')}")
+        self.responses = archive["responses"]
+        self.bodies = archive["bodies"]
+        self.strict = strict
+        self.misses = 0
+
+    def __call__(self, url):
+        response = self.responses.get(url)
+        if response is None:
+            self.misses += 1
+            if self.strict:
+                raise KeyError(f"{url} is not in the replay archive")
+            raise urllib.error.HTTPError(url, 404, "Not recorded", {}, None)
+        kind = response[0]
+        if kind == "ok":
+            return self.bodies[response[1]]
+        if kind == "http":
+            raise urllib.error.HTTPError(url, response[1], response[2], {}, None)
+        if kind == "url":
+            raise urllib.error.URLError(response[1])
+        if kind == "timeout":
+            raise socket.timeout(response[1])
+        raise IOError(response[1])
+
+
+if __name__ == '__main__':
+    import Scanner
+
+    USAGE = "usage: %prog [options] archive url"
+    EPILOGUE = """Replay a scan recorded with --record (BlindElephant.py or Scanner.py) under
+               the profiler and print the hottest functions."""
+
+    parser = OptionParser(usage=USAGE, epilog=EPILOGUE)
+    parser.add_option("-p", "--plugins", action="store_true", help="Detect and fingerprint plugins too")
+    parser.add_option("-r", "--repeat", type='int', default=1, help="Replay the scan this many times")
+    parser.add_option("-s", "--sort", default="cumulative", help="pstats sort key. Default: %default")
+    parser.add_option("-n", "--lines", type='int', default=30, help="Number of functions to print. Default: %default")
+    parser.add_option("-o", "--output", help="Also save raw profile data to this file")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 2:
+        parser.print_help()
+        quit()
+
+    transport = ReplayTransport(args[0])
+    profiler = cProfile.Profile()
+    for _ in range(options.repeat):
+        s = Scanner.Scanner(args[1].strip("/"), options.plugins, transport=transport)
+        profiler.runcall(s.scan)
+    print(s.result)
+    print("Requests not in archive:", transport.misses)
+    if options.output:
+        profiler.dump_stats(options.output)
+    pstats.Stats(profiler).sort_stats(options.sort).print_stats(options.lines)
@@ -0,0 +1,172 @@
+import hashlib
+import hmac
+import io
+import json
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import DbUpdater
+
+KEY = b"test key"
+
+
+def sign(data):
+    return hmac.new(KEY, data, hashlib.sha256).digest()
+
+
+def verify(data, signature):
+    if not hmac.compare_digest(sign(data), signature or b""):
+        raise DbUpdater.UpdateError("bad manifest signature")
+
+
+def write(dirname, files):
+    for name, content in files.items():
+        path = os.path.join(dirname, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+
+
+def read(dirname):
+    return {name: pathlib.Path(dirname, name).read_bytes() for name in DbUpdater._db_files(dirname)}
+
+
+class UpdaterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.dir, "source")
+        self.db_dir = os.path.join(self.dir, "dbs")
+        self.log = io.StringIO()
+        write(self.db_dir, {"a.pkl": b"old a", "b.pkl": b"b", "gone.pkl": b"gone", "x-plugins/p.pkl": b"old p"})
+        write(self.source, {"a.pkl": b"new a", "b.pkl": b"b", "x-plugins/p.pkl": b"new p", "c.pkl": b"c"})
+        self.before = read(self.db_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def assertUnchanged(self):
+        self.assertEqual(read(self.db_dir), self.before)
+        self.assertNoLeftovers()
+
+    def assertNoLeftovers(self):
+        self.assertEqual(sorted(name for name in os.listdir(self.dir) if name.startswith("dbs")), ["dbs"])
+
+
+class UpdateTest(UpdaterTestCase):
+
+    def update(self, **kwargs):
+        return DbUpdater.update(self.source, self.db_dir, log=self.log, **kwargs)
+
+    def test_signed_update_fetches_changed_files(self):
+        DbUpdater.publish(self.source, sign)
+        self.assertEqual(self.update(verify=verify, prune=True), ["a.pkl", "c.pkl", "x-plugins/p.pkl", "gone.pkl"])
+        self.assertEqual(read(self.db_dir), read(self.source))
+        # the staging and old directories are gone
+        self.assertNoLeftovers()
+        self.assertEqual(self.update(verify=verify), [])
+
+    def test_unchanged_files_are_not_rewritten(self):
+        DbUpdater.publish(self.source, sign)
+        inode = os.stat(os.path.join(self.db_dir, "b.pkl")).st_ino
+        self.update(verify=verify)
+        self.assertEqual(os.stat(os.path.join(self.db_dir, "b.pkl")).st_ino, inode)
+
+    def test_bad_signature_is_rejected(self):
+        DbUpdater.publish(self.source, lambda data: b"forged")
+        with self.assertRaisesRegex(DbUpdater.UpdateError, "bad manifest signature"):
+            self.update(verify=verify)
+        self.assertUnchanged()
+
+    def test_missing_signature_is_rejected(self):
+        DbUpdater.publish(self.source)
+        with self.assertRaises(DbUpdater.UpdateError):
+            self.update(verify=verify)
+        self.assertUnchanged()
+
+    def test_file_not_matching_the_manifest_is_rejected(self):
+        DbUpdater.publish(self.source, sign)
+        write(self.source, {"x-plugins/p.pkl": b"tampered"})
+        with self.assertRaisesRegex(DbUpdater.UpdateError, "x-plugins/p.pkl doesn't match the manifest"):
+            self.update(verify=verify, prune=True)
+        self.assertUnchanged()
+
+    def test_bad_file_name_in_manifest_is_rejected(self):
+        DbUpdater.publish(self.source, sign)
+        manifest = DbUpdater.build_manifest(self.source)
+        manifest["files"]["../evil.pkl"] = manifest["files"]["a.pkl"]
+        data = json.dumps(manifest).encode()
+        write(self.source, {DbUpdater.MANIFEST_NAME: data, DbUpdater.SIGNATURE_NAME: sign(data)})
+        with self.assertRaisesRegex(DbUpdater.UpdateError, "bad file name"):
+            self.update(verify=verify)
+        self.assertUnchanged()
+
+    def test_unsigned_update_needs_to_be_allowed(self):
+        DbUpdater.publish(self.source)
+        with self.assertRaises(DbUpdater.UnsignedError):
+            self.update()
+        self.assertUnchanged()
+        self.update(allow_unsigned=True)
+        self.assertIn("WARN", self.log.getvalue())
+        self.assertEqual(read(self.db_dir)["a.pkl"], b"new a")
+
+    def test_interrupted_swap_is_undone(self):
+        DbUpdater.publish(self.source, sign)
+        os.rename(self.db_dir, self.db_dir + DbUpdater.OLD_SUFFIX)
+        write(self.db_dir + DbUpdater.STAGING_SUFFIX, {"a.pkl": b"half done"})
+        self.update(verify=verify)
+        self.assertEqual(read(self.db_dir)["a.pkl"], b"new a")
+        self.assertEqual(read(self.db_dir)["gone.pkl"], b"gone")
+        self.assertNoLeftovers()
+
+
+class TarballUpdateTest(UpdaterTestCase):
+
+    def tarball(self, extra=()):
+        filename = os.path.join(self.dir, "tarball.tar.gz")
+        with tarfile.open(filename, "w:gz") as tar:
+            tar.add(self.source, arcname="dbs")
+            for name, content in extra:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            link = tarfile.TarInfo("dbs/link.pkl")
+            link.type = tarfile.SYMTYPE
+            link.linkname = "/etc/passwd"
+            tar.addfile(link)
+        return pathlib.Path(filename).as_uri()
+
+    def test_tarball_is_refused_unless_allowed(self):
+        with self.assertRaises(DbUpdater.UnsignedError):
+            DbUpdater.update_from_tarball(self.tarball(), self.db_dir, log=self.log)
+        self.assertUnchanged()
+
+    def test_only_db_files_under_dbs_are_taken(self):
+        url = self.tarball([("dbs/../escaped.pkl", b"x"), ("other/o.pkl", b"x"), ("dbs/readme.txt", b"x")])
+        updated = DbUpdater.update_from_tarball(url, self.db_dir, log=self.log, allow_unsigned=True)
+        self.assertEqual(sorted(updated), ["a.pkl", "c.pkl", "x-plugins/p.pkl"])
+        self.assertEqual(read(self.db_dir), dict(read(self.source), **{"gone.pkl": b"gone"}))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "escaped.pkl")))
+        self.assertFalse(os.path.exists(os.path.join(self.db_dir, "readme.txt")))
+        self.assertFalse(os.path.lexists(os.path.join(self.db_dir, "link.pkl")))
+        self.assertNoLeftovers()
+
+    def test_broken_tarball_changes_nothing(self):
+        filename = os.path.join(self.dir, "tarball.tar.gz")
+        with open(filename, "wb") as f:
+            f.write(b"not a tarball")
+        with self.assertRaises(DbUpdater.UpdateError):
+            DbUpdater.update_from_tarball(pathlib.Path(filename).as_uri(), self.db_dir, log=self.log,
+                                          allow_unsigned=True)
+        self.assertUnchanged()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import copy
+import gc
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import DifferencesTables
+
+DifferencesTables.DEBUG = False
+
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant", "dbs")
+
+# files of each version of a made-up app: path -> content
+VERSIONS = {
+    "1.0": {"readme.txt": "app 1.0", "a.js": "a", "b.js": "b", "css/c.css": "c1", "index.php": "",
+            "install/i.js": "i"},
+    "1.1": {"readme.txt": "app 1.1", "a.js": "a", "b.js": "b2", "css/c.css": "c1"},
+    "1.2": {"readme.txt": "app 1.2", "a.js": "a3", "b.js": "b2", "css/c.css": "c2"},
+    "1.3": {"readme.txt": "app 1.3", "a.js": "a3", "b.js": "b2", "css/c.css": "c2", "new.js": "n"},
+}
+
+
+def writeVersions(basepath, versions=VERSIONS):
+    for version, files in versions.items():
+        for path, content in files.items():
+            filename = os.path.join(basepath, "app-" + version, path)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "w") as f:
+                f.write(content)
+
+
+class TablesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.basepath = os.path.join(self.dir, "app")
+        writeVersions(self.basepath)
+        DifferencesTables.invalidateTables()
+
+    def tearDown(self):
+        DifferencesTables.invalidateTables()
+        shutil.rmtree(self.dir)
+
+    def computeTables(self, **kwargs):
+        return DifferencesTables.computeTables(self.basepath, r"app-(.*)", "install", r".*\.php$", **kwargs)
+
+    def saveTables(self, name="app.pkl", metadata=None):
+        filename = os.path.join(self.dir, name)
+        DifferencesTables.saveTables(filename, *self.computeTables(), metadata=metadata)
+        return filename
+
+
+class TableCacheTest(TablesTestCase):
+
+    def test_size_is_a_running_total(self):
+        cache = DifferencesTables.TableCache(budget=10 ** 9)
+        tables = DifferencesTables.freezeTables(*self.computeTables())
+        size = DifferencesTables.estimateTableSize(tables)
+        cache.put("a", tables)
+        cache.put("b", tables)
+        cache.put("a", tables)
+        self.assertEqual(cache.size, 2 * size)
+        cache.pop("a")
+        self.assertEqual(cache.size, size)
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+    def test_least_recently_used_tables_are_evicted(self):
+        tables = DifferencesTables.freezeTables(*self.computeTables())
+        size = DifferencesTables.estimateTableSize(tables)
+        cache = DifferencesTables.TableCache(budget=2 * size)
+        for name in ("a", "b", "c"):
+            cache.put(name, tables)
+            cache.get("a")
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.size, 2 * size)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_estimate_is_close_to_allocated_memory(self):
+        for name in ("drupal", "wordpress"):
+            filename = os.path.join(DB_DIR, name + ".pkl")
+            gc.collect()
+            tracemalloc.start()
+            DifferencesTables.loadTables(filename, printStats=False)
+            allocated = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            estimate = DifferencesTables.tableCacheStats()["sizes"][filename]
+            self.assertLess(abs(estimate - allocated), allocated * .3, name)
+            DifferencesTables.invalidateTables()
+
+
+class FrozenTablesTest(TablesTestCase):
+
+    def test_frozen_tables_match_computed_tables(self):
+        pathNodes, versionNodes, versions = self.computeTables()
+        frozenPathNodes, frozenVersionNodes, frozenVersions = DifferencesTables.loadTables(self.saveTables(),
+                                                                                           printStats=False)
+        self.assertEqual(list(frozenVersions), versions)
+        self.assertEqual(set(frozenPathNodes), {"/readme.txt", "/a.js", "/b.js", "/css/c.css", "/new.js"})
+        self.assertEqual(set(frozenPathNodes), set(pathNodes))
+        for path, hashes in pathNodes.items():
+            self.assertEqual(list(frozenPathNodes[path]), list(hashes))
+            for _hash, vers in hashes.items():
+                self.assertIn(_hash, frozenPathNodes[path])
+                self.assertEqual(list(frozenPathNodes[path][_hash]), vers)
+        self.assertEqual({key: list(nodes) for key, nodes in frozenVersionNodes.items()}, versionNodes)
+
+    def test_lookups_of_unknown_digests(self):
+        pathNodes = DifferencesTables.loadTables(self.saveTables(), printStats=False)[0]
+        self.assertNotIn("0" * 32, pathNodes["/a.js"])
+        self.assertNotIn("not a digest", pathNodes["/a.js"])
+        self.assertIsNone(pathNodes["/a.js"].get("0" * 32))
+        with self.assertRaises(KeyError):
+            pathNodes["/a.js"]["0" * 32]
+
+    def test_frozen_tables_are_read_only_and_share_values(self):
+        pathNodes, versionNodes, versions = DifferencesTables.loadTables(self.saveTables(), printStats=False)
+        with self.assertRaises(TypeError):
+            pathNodes["/a.js"]["0" * 32] = ()
+        with self.assertRaises(TypeError):
+            pathNodes["/x.js"] = {}
+        # readme.txt and new.js of 1.3 imply the same versions: one tuple
+        readme = pathNodes["/readme.txt"]
+        new = pathNodes["/new.js"]
+        self.assertIs(next(v for v in readme.values() if v == tuple(new.values())[0]), tuple(new.values())[0])
+        for key, nodes in versionNodes.items():
+            for path, _hash in nodes:
+                self.assertIs(next(p for p in pathNodes if p == path), path)
+                self.assertIn(_hash, pathNodes[path])
+
+    def test_frozen_values_can_be_pickled(self):
+        pathNodes = DifferencesTables.loadTables(self.saveTables(), printStats=False)[0]
+        hashes = {path: dict(hashes) for path, hashes in pathNodes.items()}
+        self.assertEqual(pickle.loads(pickle.dumps(hashes, -1)), hashes)
+
+
+class ExternalBuildTest(TablesTestCase):
+
+    def assertSameTables(self, expected, actual):
+        pathNodes, versionNodes, versions = expected
+        self.assertEqual([v.vstring for v in actual[2]], [v.vstring for v in versions])
+        # same paths, hashes and versions, in the same order
+        self.assertEqual([(path, [(h, [v.vstring for v in vers]) for h, vers in hashes.items()])
+                          for path, hashes in actual[0].items()],
+                         [(path, [(h, [v.vstring for v in vers]) for h, vers in hashes.items()])
+                          for path, hashes in pathNodes.items()])
+        self.assertEqual(list(actual[1].items()), list(versionNodes.items()))
+
+    def test_spilled_build_matches_in_memory_build(self):
+        expected = self.computeTables()
+        for memoryLimit in (DifferencesTables.BUILD_RECORD_SIZE, 3 * DifferencesTables.BUILD_RECORD_SIZE, 2 ** 30):
+            self.assertSameTables(expected, self.computeTables(memoryLimit=memoryLimit, tempDir=self.dir))
+
+    def test_multi_pass_merge_matches_in_memory_build(self):
+        versions = {f"2.{i}": {"readme.txt": f"app 2.{i}", "a.js": f"a{i // 3}", "b.js": f"b{i % 4}"}
+                    for i in range(20)}
+        writeVersions(self.basepath, versions)
+        expected = self.computeTables()
+        fanin = DifferencesTables.BUILD_MERGE_FANIN
+        DifferencesTables.BUILD_MERGE_FANIN = 3
+        try:
+            actual = self.computeTables(memoryLimit=DifferencesTables.BUILD_RECORD_SIZE * 2, tempDir=self.dir)
+        finally:
+            DifferencesTables.BUILD_MERGE_FANIN = fanin
+        self.assertSameTables(expected, actual)
+        # the run files are cleaned up
+        self.assertEqual(sorted(os.listdir(self.dir)), ["app"])
+
+
+class IndicatorFilesTest(TablesTestCase):
+
+    def test_cheap_files_covering_every_version_twice(self):
+        pathNodes, versionNodes, versions = self.computeTables()
+        # with the default miss rate every version needs two files; the .txt and .css are cheapest
+        self.assertEqual(DifferencesTables.computeIndicatorFiles(pathNodes, versions), ["/readme.txt", "/css/c.css"])
+        sizes = {"/css/c.css": 10 ** 6, "/b.js": 20000}
+        self.assertEqual(DifferencesTables.computeIndicatorFiles(pathNodes, versions, sizes), ["/readme.txt", "/a.js"])
+        self.assertEqual(DifferencesTables.computeIndicatorFiles(pathNodes, versions, maxFiles=1), ["/readme.txt"])
+
+    def test_versions_are_matched_by_name_when_not_shared(self):
+        pathNodes, versionNodes, versions = self.computeTables()
+        self.assertEqual(DifferencesTables.computeIndicatorFiles(pathNodes, copy.deepcopy(versions)),
+                         ["/readme.txt", "/css/c.css"])
+
+    def test_metadata_round_trip(self):
+        pathNodes, versionNodes, versions = self.computeTables()
+        indicatorFiles = DifferencesTables.computeIndicatorFiles(pathNodes, versions)
+        filename = self.saveTables(metadata={"indicatorFiles": indicatorFiles})
+        self.assertEqual(len(DifferencesTables.loadTables(filename, printStats=False)), 3)
+        self.assertEqual(DifferencesTables.loadMetadata(filename)["indicatorFiles"], tuple(indicatorFiles))
+        DifferencesTables.updateMetadata(filename, indicatorFiles=["/a.js"], note="x")
+        self.assertEqual(dict(DifferencesTables.loadMetadata(filename)), {"indicatorFiles": ("/a.js",), "note": "x"})
+        self.assertEqual(DifferencesTables.readTables(filename)[3], {"indicatorFiles": ["/a.js"], "note": "x"})
+
+    def test_db_without_metadata(self):
+        filename = self.saveTables()
+        self.assertEqual(len(DifferencesTables.readTables(filename)), 4)
+        self.assertEqual(dict(DifferencesTables.loadMetadata(filename)), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
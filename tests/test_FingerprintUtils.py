@@ -0,0 +1,75 @@
+import os
+import subprocess
+import sys
+import unittest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant")
+sys.path.insert(0, SRC)
+
+import FingerprintUtils
+
+ERROR_PAGE = ("<html><body><div id='main'><p>Sorry, %s could not be found.</p>"
+              "<p><a href='/'>Home</a> <a href='/search'>Search</a></p></div></body></html>")
+TAGLESS_ERROR_PAGE = "Not found"
+ARTICLE = "<div>" + "<p>Some text. <a href='/x'>link</a></p>" * 40 + "</div>"
+
+
+def features(page):
+    return FingerprintUtils.fingerprint_error_page(page)
+
+
+def is_error_page(error_pages, page):
+    return FingerprintUtils.compare_to_error_page([features(p) for p in error_pages], page)
+
+
+class PageFeaturesTest(unittest.TestCase):
+
+    def test_tags_counted_in_lower_and_upper_case(self):
+        page = "</div></DIV></Div></a></A></tr><p></p></P></p>"
+        self.assertEqual(features(page).tags, (2, 2, 1, 3))
+        self.assertEqual(features(page).tags,
+                         tuple(page.count(tag) + page.count(tag.upper()) for tag in FingerprintUtils.ERROR_PAGE_TAGS))
+        self.assertEqual(features(page).length, len(page))
+
+    def test_simhash_is_the_same_in_every_process(self):
+        code = "import FingerprintUtils; print(FingerprintUtils.fingerprint_error_page(%r).simhash)" % ERROR_PAGE
+        values = set()
+        for seed in ("1", "2"):
+            env = dict(os.environ, PYTHONHASHSEED=seed, PYTHONPATH=SRC)
+            values.add(int(subprocess.check_output([sys.executable, "-W", "ignore", "-c", code], env=env)))
+        self.assertEqual(values, {features(ERROR_PAGE).simhash})
+
+    def test_simhash_distance(self):
+        a = features(ERROR_PAGE % "/some/page.html").simhash
+        b = features(ERROR_PAGE % "/other.js").simhash
+        c = features(ARTICLE).simhash
+        self.assertLessEqual((a ^ b).bit_count(), FingerprintUtils.SIMHASH_MAX_DISTANCE)
+        self.assertGreater((a ^ c).bit_count(), FingerprintUtils.SIMHASH_MAX_DISTANCE)
+
+
+class CompareToErrorPageTest(unittest.TestCase):
+
+    def test_error_page_for_another_path(self):
+        error_pages = [ERROR_PAGE % "/should/not/exist.html", ERROR_PAGE % "/should/not/exist.gif"]
+        self.assertTrue(is_error_page(error_pages, ERROR_PAGE % "/wp-content/plugins/akismet/readme.txt"))
+        self.assertTrue(is_error_page(error_pages, (ERROR_PAGE % "/x").upper()))
+
+    def test_page_with_other_tag_counts(self):
+        self.assertFalse(is_error_page([ERROR_PAGE % "/x"], ARTICLE))
+
+    def test_parking_page(self):
+        page = ARTICLE + FingerprintUtils.PARKING_PHRASES[0]
+        self.assertTrue(is_error_page([ERROR_PAGE % "/x"], page))
+
+    def test_no_error_page(self):
+        self.assertFalse(FingerprintUtils.compare_to_error_page(None, ERROR_PAGE))
+        self.assertFalse(FingerprintUtils.compare_to_error_page([], ERROR_PAGE))
+
+    def test_tagless_file_is_not_a_tagless_error_page(self):
+        script = "function f(a, b) { return a < b ? a : b; }\n" * 50
+        self.assertFalse(is_error_page([TAGLESS_ERROR_PAGE], script))
+        self.assertTrue(is_error_page([TAGLESS_ERROR_PAGE], "Not found: /x.js"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+from contextlib import redirect_stderr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import Loggers
+
+
+class BlockingFile(io.StringIO):
+    """Output whose writes wait for release; the first failures of them fail"""
+
+    def __init__(self, failures=0):
+        super().__init__()
+        self.failures = failures
+        self.writing = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, data):
+        self.writing.set()
+        self.release.wait()
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disk full")
+        return super().write(data)
+
+
+class StructuredLoggerTest(unittest.TestCase):
+
+    def events(self, out):
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_concurrent_scans_log_their_own_url(self):
+        out = io.StringIO()
+        logger = Loggers.StructuredLogger(out)
+
+        def scan(url):
+            for i in range(200):
+                logger.logStartFingerprint(url, "app")
+                logger.logFileHit("/%d.js" % i, None, None, "error", True, url)
+                logger.logFinishFingerprint([], None, url)
+
+        threads = [threading.Thread(target=scan, args=("http://h%d" % n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        logger.close()
+        events = self.events(out)
+        self.assertEqual(len(events), 4 * 200 * 3)
+        for n in range(4):
+            hits = [e for e in events if e["event"] == "file_hit" and e["url"] == "http://h%d" % n]
+            self.assertEqual(len(hits), 200)
+
+    def test_full_queue_drops_and_reports(self):
+        out = BlockingFile()
+        logger = Loggers.StructuredLogger(out, max_queued=5)
+        logger.logExtraInfo("first")
+        out.writing.wait()
+        for i in range(100):
+            logger.logExtraInfo(i)
+        out.release.set()
+        logger.close()
+        self.assertEqual(logger.dropped, 95)
+        messages = [e["message"] for e in self.events(out)]
+        self.assertEqual(messages, ["first", "0", "1", "2", "3", "4", "95 log events dropped (queue full)"])
+
+    def test_writer_survives_write_errors(self):
+        out = BlockingFile(failures=1)
+        logger = Loggers.StructuredLogger(out)
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            logger.logExtraInfo("lost")
+            out.writing.wait()
+            out.release.set()
+            logger.logExtraInfo("kept")
+            logger.close()
+        self.assertIn("disk full", stderr.getvalue())
+        self.assertEqual(logger.dropped, 1)
+        self.assertEqual([e["message"] for e in self.events(out)], ["kept"])
+
+
+if __name__ == '__main__':
+    unittest.main()
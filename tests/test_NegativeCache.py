@@ -0,0 +1,55 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import NegativeCache
+
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = NegativeCache.NegativeCache(clock=lambda: self.now)
+
+    def test_denied_top_level_directories_dont_kill_the_host(self):
+        for path in ("/administrator/x.js", "/wp-admin/y.js", "/.git/HEAD"):
+            self.cache.record_error("http://h" + path, 403)
+        self.assertIsNone(self.cache.lookup("http://h/misc/drupal.js"))
+        self.assertEqual(self.cache.stats()["dead_prefixes"], 0)
+
+    def test_denied_plugin_directories_kill_the_plugins_root(self):
+        for plugin in ("a", "b", "c"):
+            self.cache.record_error(f"http://h/wp-content/plugins/{plugin}/readme.txt", 403)
+        self.assertEqual(self.cache.lookup("http://h/wp-content/plugins/d/readme.txt"), 403)
+        self.assertIsNone(self.cache.lookup("http://h/wp-content/themes/x/style.css"))
+
+    def test_distant_ancestor_is_not_killed(self):
+        for path in ("/a/b/c/x.js", "/a/d/e/y.js", "/a/f/g/z.js"):
+            self.cache.record_error("http://h" + path, 403)
+        self.assertIsNone(self.cache.lookup("http://h/a/other.js"))
+
+    def test_protected_base_url_is_never_killed(self):
+        self.cache.protect("http://h/drupal")
+        for name in ("CHANGELOG.txt", "INSTALL.txt", "LICENSE.txt"):
+            self.cache.record_error("http://h/drupal/" + name, 403)
+        self.assertIsNone(self.cache.lookup("http://h/drupal/misc/drupal.js"))
+        self.assertEqual(self.cache.lookup("http://h/drupal/INSTALL.txt"), 403)
+
+    def test_served_file_revives_directory(self):
+        for name in ("x", "y", "z"):
+            self.cache.record_error(f"http://h/files/{name}/a.js", 403)
+        self.assertEqual(self.cache.lookup("http://h/files/w/a.js"), 403)
+        self.cache.record_found("http://h/files/v/a.js")
+        self.assertIsNone(self.cache.lookup("http://h/files/w/a.js"))
+
+    def test_entries_expire(self):
+        self.cache.record_error("http://h/missing.js", 404)
+        self.assertEqual(self.cache.lookup("http://h/missing.js"), 404)
+        self.now += NegativeCache.NEGATIVE_CACHE_TTL + 1
+        self.assertIsNone(self.cache.lookup("http://h/missing.js"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import hashlib
+import os
+import sys
+import threading
+import unittest
+import urllib.error
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import ResponseMemo
+
+
+def digest(body, path):
+    return hashlib.md5((body + path).encode('utf-8')).hexdigest()
+
+
+class MemoEntryTest(unittest.TestCase):
+
+    def test_direct_match(self):
+        entry = ResponseMemo.MemoEntry.from_data("body\n")
+        path_nodes = {"/a.js": {digest("body\n", "/a.js"): ["1.0"]}}
+        self.assertEqual(entry.match("/a.js", path_nodes), (["1.0"], False))
+        self.assertEqual(entry.match("/b.js", path_nodes), (None, False))
+
+    def test_massaged_match_drops_body(self):
+        entry = ResponseMemo.MemoEntry.from_data("line\r\n")
+        self.assertIsNotNone(entry._data)
+        path_nodes = {"/a.js": {digest("line\n", "/a.js"): ["1.0"]}}
+        self.assertEqual(entry.match("/a.js", path_nodes), (["1.0"], True))
+        self.assertIsNone(entry._data)
+        self.assertEqual(entry.match("/a.js", path_nodes), (["1.0"], True))
+
+    def test_big_body_is_not_kept(self):
+        body = "x" * ResponseMemo.KEPT_BODY_LIMIT + "\r\n"
+        entry = ResponseMemo.MemoEntry.from_data(body)
+        self.assertIsNone(entry._data)
+        path_nodes = {"/a.js": {digest(body.replace("\r\n", "\n"), "/a.js"): ["1.0"]}}
+        self.assertEqual(entry.match("/a.js", path_nodes), (["1.0"], True))
+
+
+class FetchEntryTest(unittest.TestCase):
+
+    def test_concurrent_fetches_share_one_and_forget_the_lock(self):
+        memo = ResponseMemo.ResponseMemo()
+        started, release = threading.Event(), threading.Event()
+        fetched = []
+
+        def fetch(url):
+            fetched.append(url)
+            started.set()
+            release.wait()
+            return "body"
+
+        entries = []
+        threads = [threading.Thread(target=lambda: entries.append(ResponseMemo.fetch_entry(memo, fetch, "http://h/a")))
+                   for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(fetched, ["http://h/a"])
+        self.assertEqual(len({id(e) for e in entries}), 1)
+        self.assertEqual(memo._fetching, {})
+
+    def test_failed_fetch_forgets_the_lock(self):
+        memo = ResponseMemo.ResponseMemo()
+
+        def fetch(url):
+            raise urllib.error.HTTPError(url, 404, "Not Found", {}, None)
+
+        for _ in range(2):
+            with self.assertRaises(urllib.error.HTTPError):
+                ResponseMemo.fetch_entry(memo, fetch, "http://h/missing")
+        self.assertEqual(memo._fetching, {})
+        self.assertEqual(memo.get("http://h/missing").code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
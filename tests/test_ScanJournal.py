@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import ScanJournal
+
+
+RESULT = {"url": "http://h", "apps": {"wordpress": ["3.0.1", "3.0.2"]},
+          "plugins": {"wordpress": {"akismet": ["2.4.0"]}}}
+
+
+class ScanJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "scan.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def reopen(self, journal):
+        journal.close()
+        return ScanJournal.ScanJournal(self.filename, sync=False)
+
+    def test_replay_restores_records(self):
+        journal = ScanJournal.ScanJournal(self.filename, sync=False)
+        journal.record(("app", "http://h", "wordpress"), ["3.0.1"])
+        journal.mark_done("http://h")
+        journal = self.reopen(journal)
+        self.assertEqual(journal["app", "http://h", "wordpress"], ["3.0.1"])
+        self.assertTrue(journal.is_done("http://h"))
+        self.assertFalse(journal.is_done("http://other"))
+        journal.close()
+
+    def test_torn_last_line_is_dropped(self):
+        journal = ScanJournal.ScanJournal(self.filename, sync=False)
+        journal.record(("apps", "http://h"), ["wordpress"])
+        journal.close()
+        size = os.path.getsize(self.filename)
+        with open(self.filename, "a") as f:
+            f.write('[["app", "http://h", "word')
+        journal = ScanJournal.ScanJournal(self.filename, sync=False)
+        self.assertEqual(os.path.getsize(self.filename), size)
+        self.assertNotIn(("app", "http://h", "wordpress"), journal)
+        # later records land on a line of their own
+        journal.record(("app", "http://h", "wordpress"), ["3.0.1"])
+        journal = self.reopen(journal)
+        self.assertEqual(journal["apps", "http://h"], ["wordpress"])
+        self.assertEqual(journal["app", "http://h", "wordpress"], ["3.0.1"])
+        journal.close()
+
+    def test_last_line_missing_its_newline_is_dropped(self):
+        with open(self.filename, "w") as f:
+            f.write(json.dumps([["apps", "http://h"], ["wordpress"]]) + "\n")
+            f.write(json.dumps([["done", "http://h"], True]))
+        journal = ScanJournal.ScanJournal(self.filename, sync=False)
+        self.assertFalse(journal.is_done("http://h"))
+        journal.mark_done("http://h")
+        journal = self.reopen(journal)
+        self.assertTrue(journal.is_done("http://h"))
+        journal.close()
+
+    def test_results_round_trip(self):
+        journal = ScanJournal.ScanJournal(self.filename, sync=False)
+        journal.record_result(RESULT)
+        journal.record(("apps", "http://unfinished"), ["joomla"])
+        journal = self.reopen(journal)
+        self.assertEqual(journal.results(), [RESULT])
+        report = os.path.join(self.dir, "report.json")
+        journal.compact(report)
+        with open(report) as f:
+            self.assertEqual(json.load(f), [RESULT])
+        self.assertFalse(os.path.exists(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
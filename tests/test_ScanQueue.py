@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "blindelephant"))
+
+import ScanQueue
+
+
+class ScanQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "queue.db")
+        self.queue = ScanQueue.ScanQueue(self.filename)
+        self.queue.add_targets(["http://a", "http://b"])
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.dir)
+
+    def test_new_queue_uses_rollback_journal(self):
+        mode = self.queue._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode.lower(), "delete")
+
+    def test_targets_are_queued_once(self):
+        self.assertEqual(self.queue.add_targets(["http://a", "http://c"]), 1)
+        self.assertEqual(self.queue.counts()[ScanQueue.PENDING], 3)
+
+    def test_job_is_leased_to_one_worker(self):
+        first = self.queue.lease("w1")
+        second = self.queue.lease("w2")
+        self.assertEqual(first[1], "http://a")
+        self.assertEqual(second[1], "http://b")
+        self.assertIsNone(self.queue.lease("w3"))
+
+    def test_expired_lease_is_reclaimed(self):
+        job_id, target, _ = self.queue.lease("w1", lease_seconds=-1)
+        self.assertEqual(self.queue.lease("w2")[:2], (job_id, target))
+        # the first worker lost the job, so its result is dropped
+        self.assertFalse(self.queue.renew(job_id, "w1"))
+        self.assertFalse(self.queue.complete(job_id, "w1", {"apps": {}}))
+        self.assertTrue(self.queue.complete(job_id, "w2", {"apps": {"wordpress": ["3.0"]}}))
+        self.assertEqual(list(self.queue.results()), [(target, ScanQueue.DONE, {"apps": {"wordpress": ["3.0"]}}, None)])
+
+    def test_job_fails_after_max_attempts(self):
+        for attempt in range(ScanQueue.MAX_ATTEMPTS):
+            job_id, target, _ = self.queue.lease("w%d" % attempt)
+            self.assertEqual(target, "http://a")
+            self.assertTrue(self.queue.fail(job_id, "w%d" % attempt, "boom"))
+        self.assertEqual(self.queue.lease("w")[1], "http://b")
+        self.assertEqual(list(self.queue.results()), [("http://a", ScanQueue.FAILED, None, "boom")])
+
+    def test_expired_leases_count_as_attempts(self):
+        for attempt in range(ScanQueue.MAX_ATTEMPTS):
+            self.assertEqual(self.queue.lease("w%d" % attempt, lease_seconds=-1)[1], "http://a")
+        self.assertEqual(self.queue.lease("w")[1], "http://b")
+        self.assertEqual(self.queue.counts()[ScanQueue.FAILED], 1)
+
+    def test_queue_survives_reopening(self):
+        job_id, _, _ = self.queue.lease("w1")
+        self.queue.close()
+        self.queue = ScanQueue.ScanQueue(self.filename)
+        self.assertTrue(self.queue.complete(job_id, "w1", {}))
+        self.assertEqual(self.queue.counts()[ScanQueue.DONE], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()